@@ -1,21 +1,41 @@
-import os
-from datetime import datetime
-
-from photonai.photonlogger import logger
+import importlib
 
 from .util import register_photonai_neuro
 
 
 # REGISTRATION
-current_path = os.path.dirname(os.path.abspath(__file__))
-registered_file = os.path.join(current_path, "registered")
-logger.info("Checking Neuro Module Registration")
-if not os.path.isfile(registered_file):
-    logger.info("Registering Neuro Module")
-    register_photonai_neuro()
-    with open(os.path.join(registered_file), "w") as f:
-        f.write(str(datetime.now()))
-
-from .atlas_mapper import AtlasMapper
-from .brain_atlas import BrainMask, BrainAtlas, AtlasLibrary
-from .neuro_branch import NeuroBranch
\ No newline at end of file
+register_photonai_neuro()
+
+# public objects are imported from their submodules on first access (PEP 562),
+# so that importing photonai_neuro does not pull in nilearn, pandas, joblib etc.
+_LAZY_OBJECTS = {
+    'AtlasMapper': '.atlas_mapper',
+    'RoiScreening': '.roi_screening',
+    'RoiTaskQueue': '.task_queue',
+    'RidgeEngine': '.ridge_engine',
+    'SearchlightMapper': '.searchlight',
+    'BrainMask': '.brain_atlas',
+    'BrainAtlas': '.brain_atlas',
+    'AtlasLibrary': '.brain_atlas',
+    'MultiAtlas': '.brain_atlas',
+    'RoiConnectivity': '.connectivity',
+    'SharedAtlasStore': '.shared_atlas',
+    'FeatureStore': '.feature_store',
+    'NeuroBranch': '.neuro_branch',
+    'set_precision': '.precision',
+    'get_precision': '.precision',
+}
+
+__all__ = list(_LAZY_OBJECTS.keys())
+
+
+def __getattr__(name):
+    if name not in _LAZY_OBJECTS:
+        raise AttributeError("module {} has no attribute {}".format(__name__, name))
+    value = getattr(importlib.import_module(_LAZY_OBJECTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
@@ -1,20 +1,31 @@
+import copy
+import hashlib
 import json
 import os
+import shutil
+import threading
+from collections import OrderedDict, namedtuple
+from collections.abc import MutableMapping
+from contextlib import contextmanager
 from glob import glob
 from typing import Union
 
 import joblib
-import matplotlib.pylab as plt
 import numpy as np
 import pandas as pd
-from nilearn import datasets, surface, plotting
 
 from photonai.base import PipelineElement, Hyperpipe
 from photonai.photonlogger.logger import logger
 from photonai.processing import ResultsHandler
+from photonai.processing.metrics import Scorer
 
 from photonai_neuro.brain_atlas import BrainAtlas, AtlasLibrary
+from photonai_neuro.feature_store import FeatureStore
 from photonai_neuro.neuro_branch import NeuroBranch
+from photonai_neuro.ridge_engine import RidgeEngine
+from photonai_neuro.roi_screening import RoiScreening
+from photonai_neuro.task_queue import RoiTaskQueue
+from photonai_neuro.util import dump_json
 
 
 class AtlasMapper:
@@ -27,7 +38,7 @@ class AtlasMapper:
         Neuro processing in front of hyperpipe.
 
     * `hyperpipe` [photonai.base.Hyperpipe]
-        Hyperpipe to fit.
+        Hyperpipe to fit. Optional if the AtlasMapper is fitted with a RidgeEngine.
 
     * `folder` [str]:
         Output path for created hyperpipes and other results.
@@ -35,20 +46,27 @@ class AtlasMapper:
     * `create_surface_plots` [bool]:
         Enable/Disable plotting.
 
+    * `n_jobs` [int]:
+        Number of processes fitting the ROI hyperpipes concurrently. -1 uses all cores.
+        With n_jobs != 1 the hyperpipes are forced to nr_of_processes=1 and BLAS threads are limited to one per
+        process in order to prevent nested oversubscription.
+
     """
 
     def __init__(self,
                  neuro_element: Union[NeuroBranch, PipelineElement],
                  hyperpipe: Hyperpipe = None,
                  folder: str = "./tmp/",
-                 create_surface_plots: bool = False):
+                 create_surface_plots: bool = False,
+                 n_jobs: int = 1):
 
         self.folder = folder
         if not os.path.exists(self.folder):
             os.makedirs(self.folder)
 
         self.neuro_element = neuro_element
-        self.rois, self.atlas = self._find_brain_atlas(self.neuro_element)
+        self.rois, self.atlas, self.atlas_element = self._find_brain_atlas(self.neuro_element)
+        self.roi_offsets = None
 
         self.hyperpipe_infos = None
         self.hyperpipe = hyperpipe
@@ -56,6 +74,7 @@ class AtlasMapper:
 
         self.roi_indices = {}
         self.create_surface_plots = create_surface_plots
+        self.n_jobs = n_jobs
 
     def _generate_mappings(self):
         """
@@ -70,17 +89,35 @@ class AtlasMapper:
             copy_of_hyperpipe.output_settings.project_folder = self.folder
             copy_of_hyperpipe.output_settings.overwrite_results = True
             copy_of_hyperpipe.output_settings.save_output = True
+            copy_of_hyperpipe.verbosity = self.hyperpipe.verbosity
+            if self.n_jobs != 1 and copy_of_hyperpipe.nr_of_processes != 1:
+                logger.warning("AtlasMapper fits ROIs in parallel: setting nr_of_processes of hyperpipe {} "
+                               "to 1.".format(new_pipe_name))
+                copy_of_hyperpipe.nr_of_processes = 1
             self.hyperpipes_to_fit[roi_name] = copy_of_hyperpipe
         return
 
-    def fit(self, X, y=None, **kwargs):
+    def fit(self, X, y=None, resume: bool = False, screening: RoiScreening = None, engine: RidgeEngine = None,
+            feature_store: FeatureStore = None, subject_ids: list = None, **kwargs):
         """
         Transform data on NeuroElement and fit hyperpipes.
+        The extracted ROI data and a completion record per ROI are written to the folder as the fit goes on.
         :param X: input data
         :param y: targets
+        :param resume: bool, reuse the extracted ROI data and skip all ROIs with a valid completion record and
+                       model file from a previous, interrupted fit into the same folder
+        :param screening: RoiScreening, screen the ROIs with a cheap proxy model first and fit the hyperpipe on the
+                          surviving ROIs only. Screened out ROIs are reported with their proxy score.
+        :param engine: RidgeEngine, cross-validate a closed-form ridge model on all ROIs at once instead of
+                       fitting the hyperpipe per ROI. No models are saved.
+        :param feature_store: FeatureStore, only extract subjects that are new to the store or whose input changed,
+                              the ROI data of all other subjects is read from the store
+        :param subject_ids: list, ID of every subject in X for the feature store, None uses the file paths
         :param kwargs:
         :return:
         """
+        if engine is not None:
+            return self._fit_engine(X, y, engine, feature_store=feature_store, subject_ids=subject_ids)
 
         # disable fitting with loading from file/folder
         if not self.hyperpipes_to_fit and self.hyperpipe:
@@ -90,67 +127,603 @@ class AtlasMapper:
             logger.error(msg)
             raise ValueError(msg)
 
-        # Get data from BrainAtlas first and save to .npz
         # ToDo: currently not supported for hyperparameters inside neurobranch
         self.neuro_element.fit(X)
 
-        # extract regions
-        X_extracted, _, _ = self.neuro_element.transform(X)
-        X_extracted = AtlasMapper._reshape_roi_data(X_extracted)
+        # extract regions or reuse the regions extracted by the interrupted fit
+        X_extracted = self._load_roi_data(X, y) if resume else None
+        checkpoint_folder = os.path.join(self.folder, 'atlas_mapper_checkpoints')
+        if X_extracted is None:
+            # without matching ROI data the checkpoints belong to models of other data
+            if resume:
+                logger.info("AtlasMapper: no ROI data of the same input, fitting all ROIs again.")
+            shutil.rmtree(checkpoint_folder, ignore_errors=True)
+            resume = False
+            X_extracted = self._extract_all(X, feature_store, subject_ids)
+            self._save_roi_data(X_extracted, X, y)
+        os.makedirs(checkpoint_folder, exist_ok=True)
 
         # save neuro element to file
         joblib.dump(self.neuro_element, os.path.join(self.folder, 'neuro_element.pkl'), compress=1)
 
+        screened_results = dict()
+        if screening is not None:
+            metric = self.hyperpipe.optimization.best_config_metric
+            survivors, proxy_results = screening.screen(
+                X_extracted, {roi_name: self._roi_columns(roi_index) for roi_name, roi_index in self.roi_indices.items()},
+                y, metric)
+            for roi_name in list(self.hyperpipes_to_fit.keys()):
+                if roi_name not in survivors:
+                    del self.hyperpipes_to_fit[roi_name]
+                    screened_results[roi_name] = proxy_results[roi_name]
+
+        fitted = self._load_checkpoints(checkpoint_folder) if resume else list()
+        finished_rois = [roi_name for roi_name, _, _ in fitted]
+        if finished_rois:
+            logger.info("AtlasMapper: resuming, skipping {} finished ROIs".format(len(finished_rois)))
+        hyperpipes_to_fit = {roi_name: hyperpipe for roi_name, hyperpipe in self.hyperpipes_to_fit.items()
+                             if roi_name not in finished_rois}
+
+        if self.n_jobs == 1:
+            fitted += [_fit_roi_hyperpipe(roi_name, hyperpipe, X_extracted, y,
+                                          roi_columns=self._roi_columns(self.roi_indices[roi_name]),
+                                          checkpoint_folder=checkpoint_folder, **kwargs)
+                       for roi_name, hyperpipe in hyperpipes_to_fit.items()]
+        else:
+            fitted += self._fit_parallel(hyperpipes_to_fit, y, checkpoint_folder, **kwargs)
+
+        if screening is not None:
+            for _, _, roi_results in fitted:
+                roi_results['screening_round'] = len(screening.n_splits)
+        self._write_results(fitted, screened_results)
+
+    def publish(self, X, y=None):
+        """
+        Prepare a distributed fit: extract the ROI data once and publish one fitting task per ROI to a queue
+        in the folder. Workers on any node with access to the folder run AtlasMapper.run_worker(folder),
+        AtlasMapper.merge(folder) assembles the results once all tasks are done.
+        :param X: input data
+        :param y: targets
+        :return: RoiTaskQueue
+        """
+        if not self.hyperpipes_to_fit and self.hyperpipe:
+            self._generate_mappings()
+        else:
+            msg = "Cannot publish AtlasMapper with hyperpipe as NoneType."
+            logger.error(msg)
+            raise ValueError(msg)
+
+        checkpoint_folder = os.path.join(self.folder, 'atlas_mapper_checkpoints')
+        shutil.rmtree(checkpoint_folder, ignore_errors=True)
+        os.makedirs(checkpoint_folder)
+        task_folder = os.path.join(self.folder, 'atlas_mapper_tasks')
+        shutil.rmtree(task_folder, ignore_errors=True)
+        os.makedirs(task_folder)
+
+        self.neuro_element.fit(X)
+        X_extracted, self.roi_offsets = self._extract(X)
+        self._save_roi_data(X_extracted, X, y)
+        joblib.dump(self.neuro_element, os.path.join(self.folder, 'neuro_element.pkl'), compress=1)
+        joblib.dump(y, os.path.join(task_folder, 'targets.pkl'))
+
+        tasks = list()
+        # the workers' fits create new log file handlers
+        with _without_log_handlers(self.hyperpipes_to_fit.values()):
+            for roi_name, hyperpipe in self.hyperpipes_to_fit.items():
+                hyperpipe_file = os.path.join(task_folder, hyperpipe.name + '.pkl')
+                joblib.dump(hyperpipe, hyperpipe_file)
+                roi_index = self.roi_indices[roi_name]
+                tasks.append((roi_name, roi_index, os.path.basename(hyperpipe_file)) + self._roi_columns(roi_index))
+        dump_json({'analysis_name': self.hyperpipe.name,
+                    'best_config_metric': self.hyperpipe.optimization.best_config_metric,
+                    'roi_indices': self.roi_indices},
+                   os.path.join(task_folder, 'atlas_mapper.json'))
+
+        queue = RoiTaskQueue(os.path.join(self.folder, 'atlas_mapper_queue.db'))
+        queue.publish(tasks)
+        logger.info("AtlasMapper: published {} ROI tasks to {}".format(len(tasks), queue.file))
+        return queue
+
+    @staticmethod
+    def run_worker(folder: str, worker: str = None, max_tasks: int = None,
+                   stale_after: float = RoiTaskQueue.STALE_AFTER, **kwargs):
+        """
+        Claim and fit published ROI tasks until the queue is empty.
+        :param folder: str, folder of the published AtlasMapper
+        :param worker: str, name of the worker in the queue, None uses host and process id
+        :param max_tasks: int, stop after this many tasks, None runs until the queue is empty
+        :param stale_after: float, seconds after which tasks claimed by other workers count as abandoned,
+                            None never takes over tasks of other workers
+        :param kwargs: passed to the fit of the hyperpipes
+        :return: int, number of tasks fitted successfully
+        """
+        queue = RoiTaskQueue(os.path.join(folder, 'atlas_mapper_queue.db'))
+        task_folder = os.path.join(folder, 'atlas_mapper_tasks')
+        data_file = os.path.join(folder, 'roi_data.npy')
+        y = joblib.load(os.path.join(task_folder, 'targets.pkl'))
+        worker = worker if worker is not None else RoiTaskQueue.worker_name()
+
+        n_done = 0
+        n_claimed = 0
+        while max_tasks is None or n_claimed < max_tasks:
+            task = queue.claim(worker, stale_after=stale_after)
+            if task is None:
+                break
+            n_claimed += 1
+            try:
+                hyperpipe = joblib.load(os.path.join(task_folder, task['hyperpipe_file']))
+                _fit_roi_hyperpipe(task['roi_name'], hyperpipe, data_file, y, roi_columns=task['roi_columns'],
+                                   checkpoint_folder=os.path.join(folder, 'atlas_mapper_checkpoints'), **kwargs)
+            except Exception as e:
+                queue.fail(task['roi_name'], worker, repr(e))
+                continue
+            queue.finish(task['roi_name'], worker)
+            n_done += 1
+        logger.info("AtlasMapper worker {}: fitted {} ROIs".format(worker, n_done))
+        return n_done
+
+    @staticmethod
+    def merge(folder: str, max_models_in_memory: int = None):
+        """
+        Assemble meta JSON, results CSV and performance NIfTI of a distributed fit.
+        :param folder: str, folder of the published AtlasMapper
+        :param max_models_in_memory: int, see load_from_file
+        :return: fitted AtlasMapper
+        """
+        queue = RoiTaskQueue(os.path.join(folder, 'atlas_mapper_queue.db'))
+        status = queue.status()
+        if status[RoiTaskQueue.PENDING] > 0 or status[RoiTaskQueue.RUNNING] > 0:
+            msg = "Cannot merge AtlasMapper, tasks are not finished: {}. Tasks of crashed workers are handed " \
+                  "out again after stale_after seconds or by RoiTaskQueue.requeue.".format(status)
+            logger.error(msg)
+            raise ValueError(msg)
+        for roi_name, _, worker, _, error in queue.tasks(RoiTaskQueue.FAILED):
+            logger.warning("AtlasMapper: ROI {} failed on worker {} and is left out: {}".format(roi_name, worker,
+                                                                                             error))
+
+        with open(os.path.join(folder, 'atlas_mapper_tasks', 'atlas_mapper.json'), 'r') as f:
+            settings = json.load(f)
+        with open(os.path.join(folder, 'roi_data.json'), 'r') as f:
+            roi_meta = json.load(f)
+
+        atlas_mapper = AtlasMapper(neuro_element=joblib.load(os.path.join(folder, 'neuro_element.pkl')),
+                                   folder=folder)
+        atlas_mapper.roi_indices = settings['roi_indices']
+        atlas_mapper._restore_roi_layout(roi_meta)
+
+        fitted = list()
+        for roi_name, _, _, _, _ in queue.tasks(RoiTaskQueue.DONE):
+            with open(os.path.join(folder, 'atlas_mapper_checkpoints',
+                                   settings['analysis_name'] + '_Atlas_Mapper_' + roi_name + '.json'), 'r') as f:
+                record = json.load(f)
+            fitted.append((roi_name, record['hyperpipe_infos'], record['hyperpipe_results']))
+        if not fitted:
+            msg = "Cannot merge AtlasMapper, no ROI has been fitted."
+            logger.error(msg)
+            raise ValueError(msg)
+        atlas_mapper._write_results(fitted, analysis_name=settings['analysis_name'],
+                                    metric=settings['best_config_metric'])
+
+        return AtlasMapper._load(os.path.join(folder, settings['analysis_name'] + '_atlas_mapper_meta.json'),
+                                 max_models_in_memory)
+
+    def _fit_engine(self, X, y, engine: RidgeEngine, feature_store: FeatureStore = None, subject_ids: list = None):
+        """
+        Cross-validate the closed-form models of all ROIs with the RidgeEngine.
+        """
+        engine = self._configure_engine(engine)
+        self.roi_indices = {roi_name: roi_index for roi_index, roi_name in enumerate(self.rois)}
+
+        self.neuro_element.fit(X)
+        X_extracted = self._extract_all(X, feature_store, subject_ids)
+        self._save_roi_data(X_extracted, X, y)
+        joblib.dump(self.neuro_element, os.path.join(self.folder, 'neuro_element.pkl'), compress=1)
+
+        logger.info("AtlasMapper: cross-validating {} ROIs with RidgeEngine".format(len(self.roi_indices)))
+        results = engine.fit(X_extracted, [self._roi_columns(roi_index) for roi_index in self.roi_indices.values()], y)
+
+        self._write_results(list(), dict(zip(self.roi_indices.keys(), results)),
+                            analysis_name=self._analysis_name(), metric=engine.best_config_metric)
+
+    def permutation_test(self, X, y, n_permutations: int = 1000, engine: RidgeEngine = None,
+                         alpha_level: float = 0.05, permutation_batch_size: int = 100, random_state: int = 42):
+        """
+        Permutation test of the RidgeEngine performance of every ROI, with family-wise error correction across
+        ROIs by the maximum statistic. All permutations share the ROI data extracted by fit and one fixed
+        cross-validation split.
+        Writes atlas_mapper_pvalues.nii.gz, atlas_mapper_pvalues_corrected.nii.gz (FWE corrected) and
+        atlas_mapper_significant.nii.gz (performance of the ROIs with corrected p < alpha_level, 0 elsewhere).
+        :param X: input data
+        :param y: targets
+        :param n_permutations: int, number of label permutations
+        :param engine: RidgeEngine, None uses RidgeEngine() with the settings of the hyperpipe
+        :param alpha_level: float, significance level of the corrected p-values
+        :param permutation_batch_size: int, number of permutations solved at once
+        :param random_state: int, seed of the permutations
+        :return: pd.DataFrame, performance, p-value and corrected p-value by ROI label
+        """
+        engine = self._configure_engine(engine if engine is not None else RidgeEngine())
+        metric = engine.best_config_metric
+        self.roi_indices = {roi_name: roi_index for roi_index, roi_name in enumerate(self.rois)}
+
+        X_extracted = self._load_roi_data(X, y)
+        if X_extracted is None:
+            self.neuro_element.fit(X)
+            X_extracted, self.roi_offsets = self._extract(X)
+            self._save_roi_data(X_extracted, X, y)
+
+        logger.info("AtlasMapper: testing {} ROIs with {} permutations".format(len(self.roi_indices),
+                                                                               n_permutations))
+        scores, null_scores = engine.permutation_scores(
+            X_extracted, [self._roi_columns(roi_index) for roi_index in self.roi_indices.values()], y, metric,
+            n_permutations=n_permutations, permutation_batch_size=permutation_batch_size,
+            random_state=random_state)
+
+        # orient the statistic: larger is better
+        if not Scorer.greater_is_better_distinction(metric):
+            scores, null_scores = -scores, -null_scores
+        p_values = (1 + np.sum(null_scores >= scores[None, :], axis=0)) / (1 + n_permutations)
+        max_null = null_scores.max(axis=1)
+        p_values_corrected = (1 + np.sum(max_null[:, None] >= scores[None, :], axis=0)) / (1 + n_permutations)
+        if not Scorer.greater_is_better_distinction(metric):
+            scores = -scores
+
+        results = pd.DataFrame({metric: scores, 'p_value': p_values, 'p_value_corrected': p_values_corrected},
+                               index=list(self.roi_indices.keys())).T
+        results.to_csv(os.path.join(self.folder, self._analysis_name() + '_atlas_mapper_permutations.csv'))
+
+        self._write_roi_map(p_values, 'atlas_mapper_pvalues.nii.gz')
+        self._write_roi_map(p_values_corrected, 'atlas_mapper_pvalues_corrected.nii.gz')
+        self._write_roi_map(np.where(p_values_corrected < alpha_level, scores, 0), 'atlas_mapper_significant.nii.gz')
+        return results
+
+    def _configure_engine(self, engine: RidgeEngine):
+        """
+        Copy of the engine with the settings it leaves open taken from the hyperpipe.
+        """
+        engine = copy.copy(engine)
+        if self.hyperpipe is not None:
+            if engine.metrics is None:
+                engine.metrics = self.hyperpipe.optimization.metrics
+            if engine.best_config_metric is None:
+                engine.best_config_metric = self.hyperpipe.optimization.best_config_metric
+            if engine.cv is None:
+                engine.cv = getattr(self.hyperpipe.cross_validation, 'outer_cv', None)
+            if engine.task is None:
+                engine.task = {'classifier': 'classification', 'regressor': 'regression'}.get(
+                    getattr(self.hyperpipe.elements[-1], '_estimator_type', None)) if self.hyperpipe.elements else None
+        if not engine.metrics or engine.best_config_metric is None:
+            msg = "RidgeEngine needs metrics and best_config_metric if the AtlasMapper has no hyperpipe."
+            logger.error(msg)
+            raise ValueError(msg)
+        if engine.best_config_metric not in engine.metrics:
+            engine.metrics = list(engine.metrics) + [engine.best_config_metric]
+        return engine
+
+    def _analysis_name(self):
+        return self.hyperpipe.name if self.hyperpipe is not None else 'ridge_engine'
+
+    def _write_results(self, fitted: list, screened_results: dict = None, analysis_name: str = None,
+                       metric: str = None):
+        """
+        Write meta JSON, results CSV and the performance NIfTI.
+        :param fitted: list of (roi_name, hyperpipe_infos, hyperpipe_results)
+        :param screened_results: dict, results of ROIs without hyperpipe by ROI label
+        :param analysis_name: str, prefix of the result files, None uses the hyperpipe name
+        :param metric: str, metric written to the NIfTI, None uses the best_config_metric of the hyperpipe
+        """
+        if analysis_name is None:
+            analysis_name = self.hyperpipe.name
+        if metric is None:
+            metric = self.hyperpipe.optimization.best_config_metric
+
         hyperpipe_infos = dict()
         hyperpipe_results = dict()
-
-        # ToDo: parallel fitting
-        for roi_name, hyperpipe in self.hyperpipes_to_fit.items():
-            hyperpipe.verbosity = self.hyperpipe.verbosity
-            hyperpipe.fit(X_extracted[self.roi_indices[roi_name]], y, **kwargs)
-            hyperpipe_infos[roi_name] = {'hyperpipe_name': hyperpipe.name,
-                                         'model_filename': os.path.join(os.path.basename(hyperpipe.output_settings.results_folder),
-                                                                        'photon_best_model.photon'),
-                                         'roi_index': self.roi_indices[roi_name]}
-            hyperpipe_results[roi_name] = ResultsHandler(hyperpipe.results).get_performance_outer_folds()
+        for roi_name, roi_infos, roi_results in sorted(fitted, key=lambda f: self.roi_indices[f[0]]):
+            roi_infos['roi_index'] = self.roi_indices[roi_name]
+            hyperpipe_infos[roi_name] = roi_infos
+            hyperpipe_results[roi_name] = roi_results
+        if screened_results:
+            hyperpipe_results.update(screened_results)
+            hyperpipe_results = {roi_name: hyperpipe_results[roi_name] for roi_name in
+                                 sorted(hyperpipe_results.keys(), key=lambda r: self.roi_indices[r])}
 
         self.hyperpipe_infos = hyperpipe_infos
 
-        # write results
-        with open(os.path.join(self.folder, self.hyperpipe.name + '_atlas_mapper_meta.json'), 'w') as fp:
-            json.dump(self.hyperpipe_infos, fp)
+        # write results, the meta file only lists saved models
+        if self.hyperpipe_infos:
+            with open(os.path.join(self.folder, analysis_name + '_atlas_mapper_meta.json'), 'w') as fp:
+                json.dump(self.hyperpipe_infos, fp)
         df = pd.DataFrame(hyperpipe_results)
-        df.to_csv(os.path.join(self.folder, self.hyperpipe.name + '_atlas_mapper_results.csv'))
+        df.to_csv(os.path.join(self.folder, analysis_name + '_atlas_mapper_results.csv'))
 
         # write performance to atlas niftis
-        performances = list()
-
+        performances = np.zeros(len(self.rois))
         for roi_name, roi_res in hyperpipe_results.items():
-            n_voxels = len(X_extracted[self.roi_indices[roi_name]][0])
-            performances.append(np.repeat(roi_res[self.hyperpipe.optimization.best_config_metric], n_voxels))
-
-        backmapped_img, _, _ = self.neuro_element.inverse_transform(performances)
-        backmapped_img.to_filename(os.path.join(self.folder, 'atlas_mapper_performances.nii.gz'))
+            performances[self.roi_indices[roi_name]] = roi_res[metric]
+        backmapped_img = self._write_roi_map(performances, 'atlas_mapper_performances.nii.gz')
 
         if self.create_surface_plots:
             self.surface_plots(backmapped_img)
 
-    def predict(self, X, **kwargs):
+    def _write_roi_map(self, roi_values, filename: str):
+        """
+        Write one value per ROI to a NIfTI in the folder.
+        :param roi_values: np.ndarray, values in the order of the ROIs
+        :param filename: str
+        :return: Nifti1Image
+        """
+        # one value per voxel in the layout of the extracted ROI data
+        voxel_values = np.repeat(np.asarray(roi_values, dtype=np.float64), np.diff(self.roi_offsets))
+        backmapped_img, _, _ = self.neuro_element.inverse_transform(voxel_values)
+        backmapped_img.to_filename(os.path.join(self.folder, filename))
+        return backmapped_img
+
+    def _fit_parallel(self, hyperpipes_to_fit: dict, y, checkpoint_folder: str = None, **kwargs):
+        """
+        Fit the ROI hyperpipes in a process pool. The workers memory map the saved ROI data
+        instead of receiving a pickled copy for every task.
+        :return: list of (roi_name, hyperpipe_infos, hyperpipe_results)
+        """
+        data_file = os.path.join(self.folder, 'roi_data.npy')
+
+        n_jobs = joblib.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        logger.info("AtlasMapper: fitting {} ROIs in {} processes".format(len(hyperpipes_to_fit), n_jobs))
+        # one BLAS thread per worker: the ROIs are the unit of parallelism
+        with joblib.parallel_backend('loky', inner_max_num_threads=1), \
+                _without_log_handlers(hyperpipes_to_fit.values()):
+            fitted = joblib.Parallel(n_jobs=n_jobs)(
+                joblib.delayed(_fit_roi_hyperpipe)(roi_name, hyperpipe, data_file, y,
+                                                   roi_columns=self._roi_columns(self.roi_indices[roi_name]),
+                                                   checkpoint_folder=checkpoint_folder, **kwargs)
+                for roi_name, hyperpipe in hyperpipes_to_fit.items())
+
+        # the fitted hyperpipes only exist in the workers, reload the best models for prediction
+        for roi_name, roi_infos, _ in fitted:
+            self.hyperpipes_to_fit[roi_name] = Hyperpipe.load_optimum_pipe(
+                os.path.join(self.folder, roi_infos['model_filename']))
+        return fitted
+
+    def _save_roi_data(self, X_extracted, X, y):
+        """
+        Persist the extracted ROI data. The meta file is written last, so its existence marks complete data.
+        """
+        data_file = os.path.join(self.folder, 'roi_data.npy')
+        meta_file = os.path.join(self.folder, 'roi_data.json')
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+        np.save(data_file, X_extracted)
+        meta = {'fingerprint': self._fingerprint(X, y)}
+        meta.update(self._roi_layout())
+        dump_json(meta, meta_file)
+
+    def _roi_layout(self):
+        """
+        State of the BrainAtlas needed for inverse_transform, see _restore_roi_layout.
+        """
+        return {'roi_offsets': [int(o) for o in self.roi_offsets],
+                'affine': np.asarray(self.atlas_element.affine).tolist(),
+                'shape': [int(i) for i in self.atlas_element.shape]}
+
+    def _load_roi_data(self, X, y):
+        """
+        Load the ROI data persisted by a previous fit on the same data.
+        :return: memory mapped ROI data or None if there is no (matching) data
+        """
+        data_file = os.path.join(self.folder, 'roi_data.npy')
+        meta_file = os.path.join(self.folder, 'roi_data.json')
+        try:
+            with open(meta_file, 'r') as f:
+                meta = json.load(f)
+            X_extracted = np.load(data_file, mmap_mode='c')
+        except (OSError, ValueError):
+            return None
+        if meta['fingerprint'] != self._fingerprint(X, y) or X_extracted.shape[1] != meta['roi_offsets'][-1]:
+            logger.info("AtlasMapper: input data changed, extracting ROIs again.")
+            return None
+
+        logger.info("AtlasMapper: reusing extracted ROI data from {}".format(data_file))
+        self._restore_roi_layout(meta)
+        return X_extracted
+
+    def _restore_roi_layout(self, meta: dict):
+        """
+        Restore the state of the BrainAtlas needed for inverse_transform from the ROI data meta file.
+        """
+        self.roi_offsets = np.asarray(meta['roi_offsets'])
+        self.atlas_element.roi_offsets = self.roi_offsets
+        self.atlas_element.affine = np.asarray(meta['affine'])
+        self.atlas_element.shape = tuple(meta['shape'])
+
+    def _load_checkpoints(self, checkpoint_folder: str):
+        """
+        Load the completion records of all ROIs whose record and model file are valid.
+        :return: list of (roi_name, hyperpipe_infos, hyperpipe_results)
+        """
+        finished = list()
+        for roi_name, hyperpipe in self.hyperpipes_to_fit.items():
+            try:
+                with open(os.path.join(checkpoint_folder, hyperpipe.name + '.json'), 'r') as f:
+                    record = json.load(f)
+                roi_infos, roi_results = record['hyperpipe_infos'], record['hyperpipe_results']
+                model_file = os.path.join(self.folder, roi_infos['model_filename'])
+                valid = roi_infos['hyperpipe_name'] == hyperpipe.name and os.path.isfile(model_file) \
+                    and self.hyperpipe.optimization.best_config_metric in roi_results
+            except (OSError, ValueError, KeyError, TypeError):
+                valid = False
+            if valid:
+                self.hyperpipes_to_fit[roi_name] = Hyperpipe.load_optimum_pipe(model_file)
+                finished.append((roi_name, roi_infos, roi_results))
+        return finished
+
+    @staticmethod
+    def _fingerprint(X, y):
+        """
+        Cheap identity of the input: file paths with size and modification time or the raw data, and the targets.
+        """
+        sha = hashlib.sha1()
+        for x in (X if isinstance(X, (list, np.ndarray)) else [X]):
+            if isinstance(x, str):
+                stat = os.stat(x)
+                sha.update("{}:{}:{}".format(x, stat.st_size, stat.st_mtime).encode())
+            else:
+                sha.update(np.ascontiguousarray(np.asarray(getattr(x, 'dataobj', x))).tobytes())
+        if y is not None:
+            sha.update(np.asarray(y).astype(str).tobytes())
+        return sha.hexdigest()
+
+    def predict(self, X, rois: list = None, **kwargs):
+        """
+        Predict with the hyperpipe of every ROI.
+        :param X: input data
+        :param rois: list, ROI labels to predict with, None uses all ROIs
+        :param kwargs:
+        :return: predictions: dict, predictions by ROI label
+        """
+        X_extracted, roi_offsets = self._extract(self._check_predict(X))
+        roi_names = self._prediction_rois(rois)
+        roi_predictions = self._predict_rois(X_extracted, roi_offsets, roi_names, **kwargs)
+        return dict(zip(roi_names, roi_predictions))
+
+    def predict_batch(self, X, rois: list = None, n_jobs: int = 1, backend: str = 'threading', **kwargs):
+        """
+        Predict with the models of all ROIs concurrently.
+        :param X: input data
+        :param rois: list, ROI labels to predict with, None uses all ROIs
+        :param n_jobs: int, number of threads/processes predicting ROIs, -1 uses all cores
+        :param backend: str, 'threading' or 'loky' (processes)
+        :param kwargs: passed to predict of the ROI models
+        :return: RoiPredictions(predictions, rois): (n_subjects, n_rois) array and the ROI label of every column.
+                 The columns follow the order of the ROIs in the atlas, not the order of rois.
+        """
+        X_extracted, roi_offsets = self._extract(self._check_predict(X))
+        roi_names = self._prediction_rois(rois)
+        roi_predictions = self._predict_rois(X_extracted, roi_offsets, roi_names, n_jobs, backend, **kwargs)
+        return RoiPredictions(np.column_stack(roi_predictions), roi_names)
+
+    def predict_stream(self, X, batch_size: int = 100, rois: list = None, n_jobs: int = 1,
+                       backend: str = 'threading', **kwargs):
+        """
+        Generator version of predict_batch for subject lists too large to be extracted at once.
+        :param X: list of input data
+        :param batch_size: int, number of subjects extracted and predicted at once
+        :return: yields RoiPredictions for every batch of subjects, in the order of X
+        """
+        self._check_predict(X)
+        for start in range(0, len(X), batch_size):
+            yield self.predict_batch(X[start:start + batch_size], rois=rois, n_jobs=n_jobs, backend=backend, **kwargs)
+
+    def _check_predict(self, X):
         if len(self.hyperpipes_to_fit) == 0:
             msg = "No hyperpipes to predict. Did you remember to fit or load the Atlas Mapper?"
             logger.error(msg)
             raise Exception(msg)
+        return X
+
+    def _prediction_rois(self, rois: list = None):
+        return [roi for roi in self.hyperpipe_infos.keys() if rois is None or roi in rois]
 
+    def _predict_rois(self, X_extracted, roi_offsets, roi_names: list, n_jobs: int = 1, backend: str = 'threading',
+                      **kwargs):
+        """
+        Predict every ROI in roi_names on its column block of X_extracted.
+        :return: list of predictions in the order of roi_names
+        """
+        roi_columns = [self._roi_columns(self.hyperpipe_infos[roi]['roi_index'], roi_offsets) for roi in roi_names]
+
+        if n_jobs == 1:
+            return [_predict_roi(self.hyperpipes_to_fit[roi], X_extracted, columns, **kwargs)
+                    for roi, columns in zip(roi_names, roi_columns)]
+
+        if backend == 'threading':
+            models = [self.hyperpipes_to_fit[roi] for roi in roi_names]
+        elif backend == 'loky':
+            # processes load models from file themselves instead of receiving pickled copies
+            model_paths = getattr(self.hyperpipes_to_fit, 'model_paths', dict())
+            loaded = getattr(self.hyperpipes_to_fit, 'loaded', list())
+            models = [model_paths[roi] if roi in model_paths and roi not in loaded
+                      else self.hyperpipes_to_fit[roi] for roi in roi_names]
+        else:
+            msg = "Backend {} not supported. Use 'threading' or 'loky'.".format(backend)
+            logger.error(msg)
+            raise ValueError(msg)
+
+        # X_extracted is memory mapped once for all process workers by joblib
+        return joblib.Parallel(n_jobs=n_jobs, backend=backend)(
+            joblib.delayed(_predict_roi)(model, X_extracted, columns, **kwargs)
+            for model, columns in zip(models, roi_columns))
+
+    def _extract(self, X):
+        """
+        Transform X with the neuro element.
+        :param X: input data
+        :return: (roi_data, roi_offsets): one (n_subjects, n_voxels) matrix, ROI i in columns roi_offsets[i]:roi_offsets[i+1]
+        """
+        self.atlas_element.roi_offsets = None
         X_extracted, _, _ = self.neuro_element.transform(X)
-        X_extracted = AtlasMapper._reshape_roi_data(X_extracted)
+        roi_offsets = self.atlas_element.roi_offsets
+
+        if roi_offsets is None:
+            # the BrainAtlas ran in other processes (nr_of_processes > 1): get the layout from a single subject
+            single_element = self.neuro_element.copy_me()
+            if isinstance(single_element, NeuroBranch):
+                single_element.nr_of_processes = 1
+            _, _, single_atlas = AtlasMapper._find_brain_atlas(single_element)
+            single_element.transform(X[:1] if isinstance(X, (list, np.ndarray)) else X)
+            roi_offsets = single_atlas.roi_offsets
+            # inverse_transform runs in this process and needs the layout of the data grid
+            self.atlas_element.roi_offsets = roi_offsets
+            self.atlas_element.affine, self.atlas_element.shape = single_atlas.affine, single_atlas.shape
+        return np.atleast_2d(X_extracted), roi_offsets
+
+    def _extract_all(self, X, feature_store: FeatureStore = None, subject_ids: list = None):
+        """
+        Extract the ROI data of all subjects, with a feature store only of the subjects it does not hold yet.
+        Sets self.roi_offsets.
+        :return: np.ndarray, (n_subjects, n_voxels) ROI data in the order of X
+        """
+        if feature_store is None:
+            X_extracted, self.roi_offsets = self._extract(X)
+            return X_extracted
+
+        # a store of other element parameters is extracted again
+        feature_store.invalidate(self.neuro_element)
+        indices, subject_ids, hashes = feature_store.diff(X, subject_ids)
+        if not indices:
+            # all subjects are stored: one subject has to give the stored layout, e.g. the same atlas file
+            X_first, self.roi_offsets = self._extract([X[0]])
+            if self._store_layout(X_first) != feature_store.layout:
+                logger.info("AtlasMapper: the features in the store do not match the neuro element, extracting "
+                            "all subjects again.")
+                feature_store.clear()
+                indices = list(range(len(X)))
+        if indices:
+            logger.info("AtlasMapper: extracting {} new or changed subjects".format(len(indices)))
+            X_new, self.roi_offsets = self._extract([X[i] for i in indices])
+            feature_store.add([subject_ids[i] for i in indices], [hashes[i] for i in indices], X_new,
+                              layout=self._store_layout(X_new))
+        else:
+            self._restore_roi_layout(feature_store.layout)
+        return feature_store.load(subject_ids)
 
-        predictions = dict()
-        for roi, infos in self.hyperpipe_infos.items():
-            roi_index = infos['roi_index']
-            predictions[roi] = self.hyperpipes_to_fit[roi].predict(X_extracted[roi_index], **kwargs)
-        return predictions
+    def _store_layout(self, X_extracted):
+        """
+        Layout of extracted ROI data in a FeatureStore, see FeatureStore.describe.
+        """
+        layout = FeatureStore.describe(self.neuro_element, X_extracted.shape[1])
+        layout.update(self._roi_layout())
+        return layout
+
+    def _roi_columns(self, roi_index: int, roi_offsets=None):
+        if roi_offsets is None:
+            roi_offsets = self.roi_offsets
+        return int(roi_offsets[roi_index]), int(roi_offsets[roi_index + 1])
 
     def surface_plots(self, perf_img):
+        # plotting dependencies are heavy to import and only needed here
+        import matplotlib.pylab as plt
+        from nilearn import datasets, surface, plotting
+
         print('Creating surface plots')
 
         figure, axes = plt.subplots(2, 2, subplot_kw={'projection': '3d'}, figsize=(12, 12))
@@ -180,21 +753,24 @@ class AtlasMapper:
     @staticmethod
     def _find_brain_atlas(neuro_element: Union[NeuroBranch, PipelineElement]):
         """
-        Find BrainAtlas and returns its rois and atlas_object.
+        Find BrainAtlas and returns its rois, atlas_object and the BrainAtlas itself.
         :param neuro_element: NeuroElement
-        :return: (roi_list, atlas_obj)
+        :return: (roi_list, atlas_obj, brain_atlas)
         """
         roi_list = list()
         atlas_obj = list()
+        brain_atlas = None
         if isinstance(neuro_element, NeuroBranch):
             for element in neuro_element.elements:
                 if isinstance(element.base_element, BrainAtlas):
                     element.base_element.collection_mode = 'list'
                     roi_list, atlas_obj = AtlasMapper._find_rois(element)
+                    brain_atlas = element.base_element
         elif isinstance(neuro_element.base_element, BrainAtlas):
             neuro_element.base_element.collection_mode = 'list'
             roi_list, atlas_obj = AtlasMapper._find_rois(neuro_element)
-        return roi_list, atlas_obj
+            brain_atlas = neuro_element.base_element
+        return roi_list, atlas_obj, brain_atlas
 
     @staticmethod
     def _find_rois(element):
@@ -204,23 +780,29 @@ class AtlasMapper:
         return [roi.label for roi in roi_objects], atlas_obj
 
     @staticmethod
-    def _reshape_roi_data(X):
-        roi_data = [list() for _ in range(len(X[0]))]
-        for roi_i in range(len(X[0])):
-            for sub_i in range(len(X)):
-                roi_data[roi_i].append(X[sub_i][roi_i])
-
-        return roi_data
-
-    @staticmethod
-    def load_from_file(file: str):
+    def load_from_file(file: str, max_models_in_memory: int = None):
+        """
+        Load a fitted AtlasMapper. The ROI models are loaded on first use.
+        :param file: str, path to the *_atlas_mapper_meta.json
+        :param max_models_in_memory: int, number of ROI models kept in memory (least recently used are dropped),
+                                     None keeps all models once they are loaded
+        :return: AtlasMapper
+        """
         if not os.path.exists(file):
             raise FileNotFoundError("Couldn't find atlas mapper meta file")
 
-        return AtlasMapper._load(file)
+        return AtlasMapper._load(file, max_models_in_memory)
 
     @staticmethod
-    def load_from_folder(folder: str, analysis_name: str = None):
+    def load_from_folder(folder: str, analysis_name: str = None, max_models_in_memory: int = None):
+        """
+        Load a fitted AtlasMapper. The ROI models are loaded on first use.
+        :param folder: str, results folder of the AtlasMapper
+        :param analysis_name: str, name of the hyperpipe if there are several AtlasMappers in the folder
+        :param max_models_in_memory: int, number of ROI models kept in memory (least recently used are dropped),
+                                     None keeps all models once they are loaded
+        :return: AtlasMapper
+        """
         if not os.path.exists(folder):
             raise NotADirectoryError("{} is not a directory".format(folder))
 
@@ -234,10 +816,10 @@ class AtlasMapper:
         elif len(meta_file) > 1:
             raise ValueError("Found multiple atlas_mapper_meta.json files in {}".format(folder))
 
-        return AtlasMapper._load(meta_file[0])
+        return AtlasMapper._load(meta_file[0], max_models_in_memory)
 
     @staticmethod
-    def _load(file):
+    def _load(file, max_models_in_memory: int = None):
         # load neuro branch
         folder = os.path.split(file)[0]
         neuro_element = joblib.load(os.path.join(folder, 'neuro_element.pkl'))
@@ -245,13 +827,143 @@ class AtlasMapper:
         with open(file, "r") as read_file:
             hyperpipe_infos = json.load(read_file)
 
-        roi_models = dict()
+        # only register the model paths, the models are loaded on first use
+        model_paths = dict()
         for roi_name, infos in hyperpipe_infos.items():
-            model_path = os.path.join(os.path.join(folder, infos['hyperpipe_name'] + "_results"),
-                                      os.path.basename(infos['model_filename']))
-            roi_models[roi_name] = Hyperpipe.load_optimum_pipe(model_path)
-            hyperpipes_to_fit = roi_models
+            model_paths[roi_name] = os.path.join(os.path.join(folder, infos['hyperpipe_name'] + "_results"),
+                                                 os.path.basename(infos['model_filename']))
+        hyperpipes_to_fit = RoiModelCache(model_paths, max_models=max_models_in_memory)
         atlas_mapper = AtlasMapper(neuro_element=neuro_element, folder=folder)
         atlas_mapper.hyperpipes_to_fit = hyperpipes_to_fit
         atlas_mapper.hyperpipe_infos = hyperpipe_infos
         return atlas_mapper
+
+
+RoiPredictions = namedtuple('RoiPredictions', ['predictions', 'rois'])
+
+
+class RoiModelCache(MutableMapping):
+    """
+    Dict of ROI models by ROI label that loads the models lazily from their model files
+    and keeps at most max_models of them in memory, dropping the least recently used ones.
+    Models assigned directly (without a model file) are never dropped.
+    """
+
+    def __init__(self, model_paths: dict = None, max_models: int = None):
+        if max_models is not None and max_models < 1:
+            msg = "RoiModelCache needs max_models >= 1 or None."
+            logger.error(msg)
+            raise ValueError(msg)
+        self.model_paths = OrderedDict(model_paths if model_paths else {})
+        self.max_models = max_models
+        self._models = OrderedDict()
+        self._pinned = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __getitem__(self, roi_name):
+        with self._lock:
+            if roi_name in self._pinned:
+                return self._pinned[roi_name]
+            if roi_name in self._models:
+                self._models.move_to_end(roi_name)
+                return self._models[roi_name]
+            model_path = self.model_paths[roi_name]
+
+        logger.debug("Loading model of ROI {}".format(roi_name))
+        model = Hyperpipe.load_optimum_pipe(model_path)
+
+        with self._lock:
+            self._models[roi_name] = model
+            self._models.move_to_end(roi_name)
+            while self.max_models is not None and len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+        return model
+
+    def __setitem__(self, roi_name, model):
+        with self._lock:
+            self._models.pop(roi_name, None)
+            self._pinned[roi_name] = model
+
+    def __delitem__(self, roi_name):
+        with self._lock:
+            if roi_name not in self:
+                raise KeyError(roi_name)
+            self.model_paths.pop(roi_name, None)
+            self._models.pop(roi_name, None)
+            self._pinned.pop(roi_name, None)
+
+    def __contains__(self, roi_name):
+        return roi_name in self.model_paths or roi_name in self._pinned
+
+    def __iter__(self):
+        return iter(list(self.model_paths.keys()) + [r for r in self._pinned.keys() if r not in self.model_paths])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    @property
+    def loaded(self):
+        """
+        Labels of the ROIs whose models are currently in memory.
+        """
+        with self._lock:
+            return list(self._pinned.keys()) + list(self._models.keys())
+
+
+@contextmanager
+def _without_log_handlers(hyperpipes):
+    """
+    Detach the log file handlers of the hyperpipes, e.g. while they are pickled for other processes.
+    A FileHandler cannot be pickled, the hyperpipe creates a new one when it is fitted.
+    """
+    handlers = [(hyperpipe, hyperpipe.output_settings.logging_file_handler) for hyperpipe in hyperpipes]
+    for hyperpipe, _ in handlers:
+        hyperpipe.output_settings.logging_file_handler = None
+    try:
+        yield
+    finally:
+        for hyperpipe, handler in handlers:
+            hyperpipe.output_settings.logging_file_handler = handler
+
+
+def _fit_roi_hyperpipe(roi_name: str, hyperpipe: Hyperpipe, X, y, roi_columns: tuple = None,
+                       checkpoint_folder: str = None, **kwargs):
+    """
+    Fit the hyperpipe of a single ROI.
+    :param roi_name: str, ROI label
+    :param hyperpipe: Hyperpipe, copy of the AtlasMapper hyperpipe
+    :param X: ROI data matrix or path to the ROI data matrix saved with np.save
+    :param y: targets
+    :param roi_columns: (start, stop), columns of the ROI in X. The ROI data is a view on X, not a copy.
+    :param checkpoint_folder: str, folder for the completion record of the ROI
+    :return: (roi_name, hyperpipe_infos, hyperpipe_results)
+    """
+    if isinstance(X, str):
+        # copy on write: the hyperpipe may not change the shared data
+        X = np.load(X, mmap_mode='c')
+    if roi_columns is not None:
+        X = X[:, roi_columns[0]:roi_columns[1]]
+    hyperpipe.fit(X, y, **kwargs)
+    hyperpipe_infos = {'hyperpipe_name': hyperpipe.name,
+                       'model_filename': os.path.join(os.path.basename(hyperpipe.output_settings.results_folder),
+                                                      'photon_best_model.photon')}
+    # one value per metric, the mean over the outer folds, as in the results of screened and engine-fitted ROIs
+    hyperpipe_results = {metric: float(np.mean(values)) for metric, values
+                         in ResultsHandler(hyperpipe.results).get_performance_outer_folds().items()}
+    if checkpoint_folder is not None:
+        dump_json({'hyperpipe_infos': hyperpipe_infos, 'hyperpipe_results': hyperpipe_results},
+                   os.path.join(checkpoint_folder, hyperpipe.name + '.json'))
+    return roi_name, hyperpipe_infos, hyperpipe_results
+
+
+def _predict_roi(model, X, roi_columns: tuple, **kwargs):
+    """
+    Predict a single ROI.
+    :param model: fitted ROI model or path to its model file
+    :param X: ROI data matrix
+    :param roi_columns: (start, stop), columns of the ROI in X
+    :return: predictions
+    """
+    if isinstance(model, str):
+        model = Hyperpipe.load_optimum_pipe(model)
+    return model.predict(X[:, roi_columns[0]:roi_columns[1]], **kwargs)
@@ -1,7 +1,11 @@
 import glob
-import inspect
+import hashlib
+import os
+import threading
 import time
 import warnings
+from collections import OrderedDict
+from collections.abc import MutableMapping
 from os import path
 from pathlib import Path
 from typing import Union
@@ -9,6 +13,7 @@ from typing import Union
 import nibabel as nib
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from nilearn import image, masking, _utils
 from nilearn.input_data import NiftiMasker
 from sklearn.base import BaseEstimator
@@ -16,6 +21,274 @@ from sklearn.base import BaseEstimator
 from photonai.photonlogger.logger import logger
 
 from photonai_neuro.objects import MaskObject, AtlasObject, RoiObject, NiftiConverter
+from photonai_neuro.precision import Precision
+from photonai_neuro.shared_atlas import SharedAtlasStore
+
+
+class AtlasCatalogue:
+    """
+    Process-wide index of the bundled and the registered custom atlases and masks.
+    The atlas folder is walked once on first use, afterwards every lookup is a dictionary access without
+    filesystem traffic.
+
+    Parameter
+    ---------
+    * `atlas_dictionary` [dict]:
+        Bundled atlases, atlas name by file name.
+
+    * `mask_dictionary` [dict]:
+        Bundled masks, mask name by file name.
+
+    * `atlas_folder` [str]:
+        Folder of the bundled atlas files.
+
+    """
+
+    def __init__(self, atlas_dictionary: dict, mask_dictionary: dict, atlas_folder: str):
+        self.atlas_dictionary = atlas_dictionary
+        self.mask_dictionary = mask_dictionary
+        self.atlas_folder = atlas_folder
+        self._atlases = None
+        self._masks = None
+        self._hashes = dict()
+        self._lock = threading.RLock()
+
+    @property
+    def atlases(self):
+        """
+        :return: dict, AtlasObject by atlas name
+        """
+        if self._atlases is None:
+            self._build()
+        return self._atlases
+
+    @property
+    def masks(self):
+        """
+        :return: dict, MaskObject by mask name
+        """
+        if self._masks is None:
+            self._build()
+        return self._masks
+
+    def _build(self):
+        with self._lock:
+            if self._atlases is not None:
+                return
+            # one walk over the atlas folder instead of one glob per atlas
+            files = dict()
+            for root, dirnames, filenames in os.walk(self.atlas_folder):
+                # precomputed bundles are not atlas files
+                dirnames[:] = [d for d in dirnames if d != AtlasLibrary.BUNDLE_FOLDER_NAME]
+                for filename in filenames:
+                    files.setdefault(filename, path.join(root, filename))
+
+            atlases, masks = dict(), dict()
+            for atlas_id, atlas_info in self.atlas_dictionary.items():
+                if atlas_info not in files:
+                    logger.debug("Atlas file {} of {} is not available.".format(atlas_info, atlas_id))
+                    continue
+                atlas_file = files[atlas_info]
+                labels_file = path.join(path.dirname(atlas_file), path.basename(atlas_file)[:-7] + '_labels.txt')
+                atlases[atlas_id] = AtlasObject(name=atlas_id, path=atlas_file, labels_file=labels_file)
+            for mask_id, mask_info in self.mask_dictionary.items():
+                if mask_info not in files:
+                    logger.debug("Mask file {} of {} is not available.".format(mask_info, mask_id))
+                    continue
+                masks[mask_id] = MaskObject(name=mask_id, mask_file=files[mask_info])
+            self._masks = masks
+            self._atlases = atlases
+
+    def get_atlas(self, atlas_name: str):
+        """
+        Catalogue entry of a bundled or custom atlas. Custom atlas files are checked once and then registered.
+        :param atlas_name: str, name of a bundled or registered atlas or path to an atlas file
+        :return: AtlasObject
+        """
+        atlas_object = self.atlases.get(atlas_name)
+        if atlas_object is None:
+            logger.debug("Checking custom atlas")
+            atlas_object = AtlasLibrary._check_custom_atlas(atlas_name)
+            with self._lock:
+                self._atlases[atlas_name] = atlas_object
+        return atlas_object
+
+    def get_mask(self, mask_name: str):
+        """
+        Catalogue entry of a bundled or custom mask. Custom mask files are checked once and then registered.
+        :param mask_name: str, name of a bundled or registered mask or path to a mask file
+        :return: MaskObject
+        """
+        mask_object = self.masks.get(mask_name)
+        if mask_object is None:
+            logger.debug("Checking custom mask")
+            mask_object = AtlasLibrary._check_custom_mask(mask_name)
+            with self._lock:
+                self._masks[mask_name] = mask_object
+        return mask_object
+
+    def register_atlas(self, atlas_name: str, atlas_file: str, labels_file: str = None):
+        """
+        Register a custom atlas under a name.
+        :param atlas_name: str, name the atlas is looked up by
+        :param atlas_file: str, path to the nifti label map
+        :param labels_file: str, path to the labels file (index and label per line), None uses the ROI indices
+        """
+        atlas_object = AtlasLibrary._check_custom_atlas(atlas_file)
+        atlas_object.name = atlas_name
+        if labels_file is not None:
+            atlas_object.labels_file = labels_file
+        with self._lock:
+            self.atlases[atlas_name] = atlas_object
+            self._hashes.pop(atlas_file, None)
+
+    def register_mask(self, mask_name: str, mask_file: str):
+        """
+        Register a custom mask under a name.
+        :param mask_name: str, name the mask is looked up by
+        :param mask_file: str, path to the nifti mask
+        """
+        mask_object = AtlasLibrary._check_custom_mask(mask_file)
+        mask_object.name = mask_name
+        with self._lock:
+            self.masks[mask_name] = mask_object
+            self._hashes.pop(mask_file, None)
+
+    def content_hash(self, name: str):
+        """
+        Hash of the content of an atlas or mask file, computed once per file.
+        :param name: str, name of an atlas or mask in the catalogue or path to a file
+        :return: str
+        """
+        if name in self.atlases:
+            file = self.atlases[name].path
+        elif name in self.masks:
+            file = self.masks[name].mask_file
+        else:
+            file = name
+        if file not in self._hashes:
+            sha = hashlib.sha1()
+            with open(file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+            self._hashes[file] = sha.hexdigest()
+        return self._hashes[file]
+
+
+class LibraryCache(MutableMapping):
+    """
+    LRU cache of the resampled atlases and masks of the AtlasLibrary.
+    The least recently used entries are dropped as soon as the entries together exceed max_bytes.
+
+    Parameter
+    ---------
+    * `max_bytes` [int] - [default: None]:
+        Memory budget of the cached atlases and masks in bytes, None never drops an entry.
+
+    """
+
+    def __init__(self, max_bytes: int = None):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._sizes = dict()
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._sizes[key] = LibraryCache.object_nbytes(value)
+            self._evict(keep=key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._entries[key]
+            del self._sizes[key]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries.keys()))
+
+    def peek(self, key):
+        """
+        Entry of a key without counting a hit or changing the order of eviction.
+        """
+        return self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return sum(self._sizes.values())
+
+    def set_memory_budget(self, max_bytes: int = None):
+        """
+        :param max_bytes: int, memory budget in bytes, None never drops an entry
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self, keep=None):
+        while self.max_bytes is not None and self.nbytes > self.max_bytes and len(self._entries) > 0:
+            key = next(iter(self._entries))
+            if key == keep:
+                # the newest entry stays even if it alone exceeds the budget
+                if len(self._entries) == 1:
+                    break
+                self._entries.move_to_end(key)
+                continue
+            logger.debug("AtlasLibrary: dropping {} from the library.".format(key[1]))
+            del self[key]
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+
+    def stats(self):
+        """
+        :return: dict, number of entries, memory size, hits, misses and evictions
+        """
+        with self._lock:
+            return {'entries': len(self._entries), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    @staticmethod
+    def object_nbytes(obj):
+        """
+        Memory of the arrays held by an AtlasObject or MaskObject. Memory maps of a SharedAtlasStore do not count.
+        """
+        arrays = list()
+        if isinstance(obj, AtlasObject):
+            arrays.append(obj.map)
+            if obj.weights is not None:
+                arrays += [obj.weights.data, obj.weights.indices, obj.weights.indptr]
+            if obj.atlas is not None:
+                arrays.append(obj.atlas.dataobj)
+            for roi in obj.roi_list:
+                arrays.append(roi.voxel_indices)
+                if roi._mask is not None:
+                    arrays.append(roi._mask.dataobj)
+        elif isinstance(obj, MaskObject) and obj.mask is not None:
+            arrays.append(obj.mask.dataobj)
+        return int(sum(a.nbytes for a in arrays if isinstance(a, np.ndarray) and not isinstance(a, np.memmap)))
 
 
 class AtlasLibrary:
@@ -54,38 +327,214 @@ class AtlasLibrary:
                        'MNI_ICBM152_WholeBrain': 'mni_icbm152_t1_tal_nlin_sym_09a_mask.nii.gz',
                        'Cerebellum': 'P_08_Cere.nii.gz'}
 
-    LIBRARY = dict()
+    LIBRARY = LibraryCache()
+
+    # affines equal up to this number of decimals share one library entry
+    GRID_DECIMALS = 4
+
+    # precomputed atlases for standard grids, next to the bundled atlases or in the user cache
+    BUNDLE_FOLDER_NAME = 'bundles'
+    CACHE_ENVIRONMENT_VARIABLE = 'PHOTONAI_NEURO_ATLAS_CACHE'
+
+    # process-wide catalogue of the atlas files, built on first lookup
+    CATALOGUE = None
 
     def __init__(self):
-        self.photon_atlases = self._load_photon_atlases()
-        self.photon_masks = self._load_photon_masks()
+        self.catalogue = AtlasLibrary.get_catalogue()
 
-    def _load_photon_atlases(self):
+    @classmethod
+    def get_catalogue(cls):
         """
-        Intern function for creating AtlasObjects for every available Atlas in the ATLAS_DICTIONARY.
-        :return: photon_atlases: dict, dict atlas by atlas_id
+        :return: AtlasCatalogue, shared by all AtlasLibrary instances of the process
         """
-        dir_atlases = path.join(path.dirname(inspect.getfile(BrainAtlas)), 'atlases')
-        photon_atlases = dict()
-        for atlas_id, atlas_info in self.ATLAS_DICTIONARY.items():
-            atlas_file = glob.glob(path.join(dir_atlases, path.join('*', atlas_info)))[0]
-            atlas_basename = path.basename(atlas_file)[:-7]
-            atlas_dir = path.dirname(atlas_file)
-            photon_atlases[atlas_id] = AtlasObject(name=atlas_id, path=atlas_file,
-                                                   labels_file=path.join(atlas_dir, atlas_basename + '_labels.txt'))
-        return photon_atlases
+        if cls.CATALOGUE is None:
+            cls.CATALOGUE = AtlasCatalogue(cls.ATLAS_DICTIONARY, cls.MASK_DICTIONARY,
+                                           path.join(path.dirname(path.abspath(__file__)), 'atlases'))
+        return cls.CATALOGUE
 
-    def _load_photon_masks(self):
+    @staticmethod
+    def grid_key(target_affine=None, target_shape=None, decimals: int = None):
+        """
+        Canonical key of a spatial grid: the rounded affine and the 3D shape.
+        :param target_affine: affine of the grid or None
+        :param target_shape: shape of the grid or None
+        :param decimals: int, rounding of the affine, None uses AtlasLibrary.GRID_DECIMALS
+        :return: tuple
+        """
+        decimals = AtlasLibrary.GRID_DECIMALS if decimals is None else decimals
+        affine_key = None
+        if target_affine is not None:
+            # + 0. turns -0. into 0.
+            affine_key = tuple((np.round(np.asarray(target_affine, dtype=np.float64), decimals) + 0.).ravel().tolist())
+        shape_key = None if target_shape is None else tuple(int(s) for s in tuple(target_shape)[:3])
+        return affine_key, shape_key
+
+    @staticmethod
+    def library_key(kind: str, name: str, target_affine=None, target_shape=None, mask_threshold=None):
         """
-        Intern function for creating MaskObjects for every available Mask in the MASK_DICTIONARY.
-        :return: photon_masks: dict, Mask by mask_id
+        Key of an atlas ('atlas') or mask ('mask') in the library.
         """
-        dir_atlases = path.join(path.dirname(inspect.getfile(BrainAtlas)), 'atlases')
-        photon_masks = dict()
-        for mask_id, mask_info in self.MASK_DICTIONARY.items():
-            mask_file = glob.glob(path.join(dir_atlases, path.join('*', mask_info)))[0]
-            photon_masks[mask_id] = MaskObject(name=mask_id, mask_file=mask_file)
-        return photon_masks
+        threshold_key = None if mask_threshold is None else round(float(mask_threshold), AtlasLibrary.GRID_DECIMALS)
+        return (kind, name) + AtlasLibrary.grid_key(target_affine, target_shape) + (threshold_key,)
+
+    @staticmethod
+    def set_memory_budget(max_bytes: int = None):
+        """
+        Limit the memory of the cached atlases and masks, the least recently used ones are dropped.
+        :param max_bytes: int, memory budget in bytes, None never drops an entry
+        """
+        AtlasLibrary.LIBRARY.set_memory_budget(max_bytes)
+
+    @staticmethod
+    def cache_stats():
+        """
+        :return: dict, number of entries, memory size, hits, misses and evictions of the library
+        """
+        return AtlasLibrary.LIBRARY.stats()
+
+    @staticmethod
+    def clear_cache():
+        AtlasLibrary.LIBRARY.clear()
+
+    @staticmethod
+    def share(folder: str):
+        """
+        Publish all atlases and masks of the library as memory mapped bundles. Worker processes started afterwards
+        attach to them read-only instead of building their own copies.
+        Load the atlases first, e.g. with get_atlas(atlas_name, affine, shape) on the grid of the data.
+        :param folder: str, folder of the bundles
+        :return: SharedAtlasStore
+        """
+        store = SharedAtlasStore(folder)
+        for key in AtlasLibrary.LIBRARY:
+            store.publish(key, AtlasLibrary.LIBRARY.peek(key))
+        store.activate()
+        return store
+
+    @staticmethod
+    def bundle_folders():
+        """
+        Folders searched for precomputed atlases: the user cache and the folder next to the bundled atlases.
+        :return: list of str
+        """
+        return [AtlasLibrary.user_bundle_folder(),
+                path.join(path.dirname(path.abspath(__file__)), 'atlases', AtlasLibrary.BUNDLE_FOLDER_NAME)]
+
+    @staticmethod
+    def user_bundle_folder():
+        if os.environ.get(AtlasLibrary.CACHE_ENVIRONMENT_VARIABLE):
+            return os.environ[AtlasLibrary.CACHE_ENVIRONMENT_VARIABLE]
+        cache_home = os.environ.get('XDG_CACHE_HOME') or path.join(path.expanduser('~'), '.cache')
+        return path.join(cache_home, 'photonai_neuro', 'atlas_bundles')
+
+    @staticmethod
+    def mni152_grid(voxel_size: float):
+        """
+        MNI152 grid (FSL orientation and origin) of an isotropic voxel size, e.g. 2 gives the 91 x 109 x 91 grid.
+        :param voxel_size: float, voxel size in mm
+        :return: (affine, shape)
+        """
+        voxel_size = float(voxel_size)
+        affine = np.array([[-voxel_size, 0., 0., 90.],
+                           [0., voxel_size, 0., -126.],
+                           [0., 0., voxel_size, -72.],
+                           [0., 0., 0., 1.]])
+        shape = tuple(int(np.floor(extent / voxel_size + 1e-6)) + 1 for extent in (181., 217., 181.))
+        return affine, shape
+
+    @staticmethod
+    def _resolve_grid(grid):
+        # voxel size of an MNI152 grid, reference image or (affine, shape)
+        if isinstance(grid, (int, float)):
+            return AtlasLibrary.mni152_grid(grid)
+        if isinstance(grid, str):
+            img = nib.load(grid)
+            return img.affine, img.shape[:3]
+        return grid[0], tuple(grid[1])
+
+    @staticmethod
+    def precompute(grids: list, atlases: list = None, masks: list = None, folder: str = None,
+                   mask_threshold: float = 0.5):
+        """
+        Resample atlases and masks to target grids once and store them as bundles.
+        get_atlas and get_mask attach to these bundles whenever the grid of the data matches.
+        :param grids: list of voxel sizes of MNI152 grids, reference nifti files or (affine, shape)
+        :param atlases: list of atlas names, None precomputes all bundled atlases
+        :param masks: list of mask names, None precomputes all bundled masks
+        :param folder: str, folder of the bundles, None uses the user cache (see bundle_folders)
+        :param mask_threshold: float, threshold of the masks
+        :return: list of the precomputed library keys
+        """
+        folder = folder if folder is not None else AtlasLibrary.user_bundle_folder()
+        store = SharedAtlasStore(folder)
+        library = AtlasLibrary()
+        atlases = list(library.photon_atlases.keys()) if atlases is None else atlases
+        masks = list(library.photon_masks.keys()) if masks is None else masks
+
+        keys = list()
+        for grid in grids:
+            affine, shape = AtlasLibrary._resolve_grid(grid)
+            for atlas_name in atlases:
+                key = library.library_key('atlas', atlas_name, affine, shape, None)
+                logger.info("AtlasLibrary: precomputing {} on grid {}".format(atlas_name, shape))
+                atlas_object = library._add_atlas_to_library(atlas_name, affine, shape, None)
+                store.publish(key, atlas_object, source_hash=library.catalogue.content_hash(atlas_name))
+                # do not keep every precomputed atlas in memory
+                del AtlasLibrary.LIBRARY[key]
+                keys.append(key)
+            for mask_name in masks:
+                key = library.library_key('mask', mask_name, affine, shape, mask_threshold)
+                logger.info("AtlasLibrary: precomputing {} on grid {}".format(mask_name, shape))
+                mask_object = library._add_mask_to_library(mask_name, affine, shape, mask_threshold)
+                store.publish(key, mask_object, source_hash=library.catalogue.content_hash(mask_name))
+                del AtlasLibrary.LIBRARY[key]
+                keys.append(key)
+        return keys
+
+    def _attach_shared(self, key: tuple):
+        # a store shared by the parent process, then the precomputed bundles of standard grids
+        obj = None
+        store = SharedAtlasStore.active()
+        if store is not None:
+            obj = store.attach(key)
+        if obj is None:
+            for folder in AtlasLibrary.bundle_folders():
+                if not path.isdir(folder):
+                    continue
+                store = SharedAtlasStore(folder)
+                if store.has(key):
+                    obj = store.attach(key, source_hash=self.catalogue.content_hash(key[1]))
+                    if obj is not None:
+                        break
+        if obj is not None:
+            logger.debug("AtlasLibrary: attached {} from {}.".format(key[1], store.folder))
+            AtlasLibrary.LIBRARY[key] = obj
+        return obj
+
+    @property
+    def photon_atlases(self):
+        return self.catalogue.atlases
+
+    @property
+    def photon_masks(self):
+        return self.catalogue.masks
+
+    def register_atlas(self, atlas_name: str, atlas_file: str, labels_file: str = None):
+        """
+        Register a custom atlas, afterwards it can be used by name like the bundled atlases.
+        :param atlas_name: str, name of the atlas
+        :param atlas_file: str, path to the nifti label map
+        :param labels_file: str, path to the labels file, None uses the ROI indices as labels
+        """
+        self.catalogue.register_atlas(atlas_name, atlas_file, labels_file)
+
+    def register_mask(self, mask_name: str, mask_file: str):
+        """
+        Register a custom mask, afterwards it can be used by name like the bundled masks.
+        :param mask_name: str, name of the mask
+        :param mask_file: str, path to the nifti mask
+        """
+        self.catalogue.register_mask(mask_name, mask_file)
 
     def list_rois(self, atlas: str):
         """
@@ -93,7 +542,7 @@ class AtlasLibrary:
         :param atlas: str, atlas name
         :return: roi_names: list, list of ROIs
         """
-        if atlas not in self.ATLAS_DICTIONARY.keys():
+        if atlas not in self.photon_atlases:
             msg = 'Atlas {} is not supported.'.format(atlas)
             logger.warning(msg)
             warnings.warn(msg)
@@ -114,12 +563,8 @@ class AtlasLibrary:
 
         Todo: find solution for multiprocessing spaming
         """
-        # load atlas object from photon_atlasses
-        if atlas_name in self.photon_atlases.keys():
-            original_atlas_object = self.photon_atlases[atlas_name]
-        else:
-            logger.debug("Checking custom atlas")
-            original_atlas_object = self._check_custom_atlas(atlas_name)
+        # look up the atlas file in the catalogue
+        original_atlas_object = self.catalogue.get_atlas(atlas_name)
 
         # now create new atlas object with different affine, shape and mask_threshold
         atlas_object = AtlasObject(name=original_atlas_object.name,
@@ -131,17 +576,28 @@ class AtlasLibrary:
 
         # load atlas
         img = image.load_img(atlas_object.path)
-        resampled_img = self._resample(img, target_affine=target_affine, target_shape=target_shape)
-        atlas_object.atlas = resampled_img
-        atlas_object.map = np.asarray(atlas_object.atlas.get_fdata())
-
-        # apply mask threshold
-        if mask_threshold is not None:
-            atlas_object.map[atlas_object.map < mask_threshold] = 0
-            atlas_object.map = atlas_object.map.astype(int)
-
-        # now get indices
-        atlas_object.indices = list(np.unique(atlas_object.map))
+        if len(img.shape) == 4 and img.shape[3] > 1:
+            # probabilistic atlas: one volume of probabilities per ROI
+            roi_voxels = self._load_probabilistic_atlas(atlas_object, img, target_affine, target_shape,
+                                                        mask_threshold)
+        else:
+            resampled_img = self._resample(img, target_affine=target_affine, target_shape=target_shape)
+            atlas_object.atlas = resampled_img
+            # label maps are integers: float32 is exact and avoids the float64 copy of get_fdata()
+            atlas_object.map = np.asarray(atlas_object.atlas.get_fdata(dtype=np.float32))
+
+            # apply mask threshold
+            if mask_threshold is not None:
+                atlas_object.map[atlas_object.map < mask_threshold] = 0
+                atlas_object.map = atlas_object.map.astype(int)
+
+            # sort the voxels by label once: ROI sizes and voxel indices without one pass over the map per ROI
+            flat_map = atlas_object.map.ravel()
+            voxel_order = np.argsort(flat_map, kind='stable')
+            indices, starts, sizes = np.unique(flat_map[voxel_order], return_index=True, return_counts=True)
+            atlas_object.indices = list(indices)
+            roi_voxels = {index: voxel_order[start:start + size]
+                          for index, start, size in zip(indices, starts, sizes)}
 
         # check labels
         if Path(atlas_object.labels_file).is_file():  # if we have a file with indices and labels
@@ -161,45 +617,36 @@ class AtlasLibrary:
                 {}
                 File: 
                 {}
-                """.format(str(sorted(self.indices)), str(sorted(list(labels_dict.keys())))))
+                """.format(str(sorted(atlas_object.indices)), str(sorted(list(labels_dict.keys())))))
 
-                atlas_object.roi_list = [RoiObject(index=i, label=str(i), size=np.sum(i == atlas_object.map)) for i in
-                                         atlas_object.indices]
+                atlas_object.roi_list = [RoiObject(index=i, label=str(i), size=roi_voxels[i].size,
+                                                   voxel_indices=roi_voxels[i]) for i in atlas_object.indices]
             else:
                 for i in range(len(atlas_object.indices)):
                     roi_index = atlas_object.indices[i]
                     new_roi = RoiObject(index=roi_index, label=labels_dict[roi_index].replace('\n', ''),
-                                        size=np.sum(roi_index == atlas_object.map))
+                                        size=roi_voxels[roi_index].size, voxel_indices=roi_voxels[roi_index])
                     atlas_object.roi_list.append(new_roi)
 
         else:  # if we don't have a labels file, we just use str(indices) as labels
-            atlas_object.roi_list = [RoiObject(index=i, label=str(i), size=np.sum(i == atlas_object.map)) for i in
-                                     atlas_object.indices]
+            atlas_object.roi_list = [RoiObject(index=i, label=str(i), size=roi_voxels[i].size,
+                                               voxel_indices=roi_voxels[i]) for i in atlas_object.indices]
 
-        # check for empty ROIs and create roi mask
+        # the ROI masks are built from the voxel indices on first use
         for roi in atlas_object.roi_list:
-
-            if roi.size == 0:
-                continue
-
-            roi.mask = image.new_img_like(atlas_object.path, atlas_object.map == roi.index)
-
-            # check if roi is empty
-            if np.sum(roi.mask.dataobj != 0) == 0:
-                roi.is_empty = True
+            roi.atlas = atlas_object
+            roi.is_empty = roi.size == 0
 
         # finally add atlas to atlas library
-        AtlasLibrary.LIBRARY[(atlas_name, str(target_affine), str(target_shape), str(mask_threshold))] = atlas_object
+        AtlasLibrary.LIBRARY[self.library_key('atlas', atlas_name, target_affine, target_shape,
+                                              mask_threshold)] = atlas_object
         logger.debug("BrainAtlas: Done adding atlas to library!")
+        return atlas_object
 
     def _add_mask_to_library(self, mask_name: str = '', target_affine=None, target_shape=None, mask_threshold=0.5):
         # Todo: find solution for multiprocessing spaming
 
-        if mask_name in self.photon_masks.keys():
-            original_mask_object = self.photon_masks[mask_name]
-        else:
-            logger.debug("Checking custom mask")
-            original_mask_object = self._check_custom_mask(mask_name)
+        original_mask_object = self.catalogue.get_mask(mask_name)
 
         mask_object = MaskObject(name=mask_name, mask_file=original_mask_object.mask_file)
 
@@ -216,25 +663,131 @@ class AtlasLibrary:
             logger.error(msg)
             raise ValueError(msg)
 
-        AtlasLibrary.LIBRARY[(mask_object.name, str(target_affine), str(target_shape), str(mask_threshold))] = mask_object
+        AtlasLibrary.LIBRARY[self.library_key('mask', mask_name, target_affine, target_shape,
+                                              mask_threshold)] = mask_object
         logger.debug("BrainMask: Done adding mask to library!")
+        return mask_object
 
     def get_atlas(self, atlas_name, target_affine=None, target_shape=None, mask_threshold=None):
-        if (atlas_name, str(target_affine), str(target_shape), str(mask_threshold)) not in AtlasLibrary.LIBRARY:
-            self._add_atlas_to_library(atlas_name, target_affine, target_shape, mask_threshold)
-
-        return AtlasLibrary.LIBRARY[(atlas_name, str(target_affine), str(target_shape), str(mask_threshold))]
+        key = self.library_key('atlas', atlas_name, target_affine, target_shape, mask_threshold)
+        atlas_object = AtlasLibrary.LIBRARY.get(key)
+        if atlas_object is None:
+            atlas_object = self._attach_shared(key)
+        if atlas_object is None:
+            atlas_object = self._add_atlas_to_library(atlas_name, target_affine, target_shape, mask_threshold)
+        return atlas_object
 
     def get_mask(self, mask_name, target_affine=None, target_shape=None, mask_threshold=0.5):
-        if (mask_name, str(target_affine), str(target_shape)) not in AtlasLibrary.LIBRARY:
-            self._add_mask_to_library(mask_name, target_affine, target_shape, mask_threshold)
+        key = self.library_key('mask', mask_name, target_affine, target_shape, mask_threshold)
+        mask_object = AtlasLibrary.LIBRARY.get(key)
+        if mask_object is None:
+            mask_object = self._attach_shared(key)
+        if mask_object is None:
+            mask_object = self._add_mask_to_library(mask_name, target_affine, target_shape, mask_threshold)
+        return mask_object
+
+    def crop_atlas(self, atlas_name, target_affine, target_shape, window: tuple, mask_threshold=None):
+        """
+        Window of an atlas on a grid, added to the library under the key of the window's grid.
+        The ROIs are taken from the atlas on the full grid: a window holds only some of the atlas indices,
+        resolving the atlas on the window itself would lose the labels.
+        :param window: tuple of three slices into the grid
+        :return: AtlasObject of the window
+        """
+        window = tuple(slice(*w.indices(n)) for w, n in zip(window, tuple(target_shape)[:3]))
+        window_affine = np.array(target_affine, dtype=np.float64)
+        window_affine[:3, 3] = window_affine[:3, :3] @ [w.start for w in window] + window_affine[:3, 3]
+        window_shape = tuple(w.stop - w.start for w in window)
+        key = self.library_key('atlas', atlas_name, window_affine, window_shape, mask_threshold)
+        atlas_object = AtlasLibrary.LIBRARY.get(key)
+        if atlas_object is not None:
+            return atlas_object
+
+        full_object = self.get_atlas(atlas_name, target_affine, target_shape, mask_threshold)
+        atlas_object = AtlasObject(name=full_object.name, path=full_object.path,
+                                   labels_file=full_object.labels_file, mask_threshold=mask_threshold,
+                                   affine=window_affine, shape=window_shape, indices=list(full_object.indices))
+        atlas_object.atlas = full_object.atlas.slicer[window]
+        atlas_object.map = np.array(full_object.map[window])
+        # flat voxel indices of the full grid in the window, in C-order as the voxel indices of the window
+        window_voxels = np.arange(int(np.prod(full_object.map.shape))).reshape(full_object.map.shape)[window].ravel()
+        if full_object.weights is not None:
+            atlas_object.weights = full_object.weights[window_voxels].tocsc()
+            atlas_object.weights.sort_indices()
+        to_window = np.full(int(np.prod(full_object.map.shape)), -1)
+        to_window[window_voxels] = np.arange(window_voxels.size)
+        for roi in full_object.roi_list:
+            voxel_indices = to_window[roi.voxel_indices]
+            voxel_indices = voxel_indices[voxel_indices >= 0]
+            new_roi = RoiObject(index=roi.index, label=roi.label, size=voxel_indices.size,
+                                voxel_indices=voxel_indices, atlas=atlas_object)
+            new_roi.is_empty = new_roi.size == 0
+            atlas_object.roi_list.append(new_roi)
+
+        AtlasLibrary.LIBRARY[key] = atlas_object
+        return atlas_object
+
+    def _load_probabilistic_atlas(self, atlas_object, img, target_affine, target_shape, mask_threshold):
+        """
+        Load a 4D probabilistic atlas into a sparse (n_voxels, n_rois) weight matrix. Volume i is ROI i + 1,
+        the map holds the most probable ROI of every voxel.
+        Linear interpolation keeps the probabilities in the range of their neighbours, a spline would ring
+        into small negative and positive values around every ROI.
+        :param mask_threshold: float, probabilities below are set to 0
+        :return: roi_voxels: dict, voxels with a probability > 0 by ROI index
+        """
+        resampled_img = self._resample(img, target_affine=target_affine, target_shape=target_shape,
+                                       interpolation='linear')
+        probabilities = np.asarray(resampled_img.get_fdata(dtype=np.float32))
+        probabilities = np.clip(probabilities.reshape(-1, probabilities.shape[-1]), 0, 1)
+        probabilities[probabilities < (mask_threshold if mask_threshold is not None else 0)] = 0
+        atlas_object.weights = sparse.csc_matrix(probabilities)
+        atlas_object.weights.sort_indices()
+
+        has_roi = probabilities.max(axis=1) > 0
+        flat_map = np.where(has_roi, probabilities.argmax(axis=1) + 1, 0).astype(np.float32)
+        atlas_object.map = flat_map.reshape(resampled_img.shape[:3])
+        atlas_object.atlas = image.new_img_like(resampled_img, atlas_object.map)
+
+        weights = atlas_object.weights
+        n_rois = weights.shape[1]
+        atlas_object.indices = ([0] if not np.all(has_roi) else []) + list(range(1, n_rois + 1))
+        roi_voxels = {i + 1: weights.indices[weights.indptr[i]:weights.indptr[i + 1]].astype(int)
+                      for i in range(n_rois)}
+        if not np.all(has_roi):
+            roi_voxels[0] = np.flatnonzero(~has_roi)
+        return roi_voxels
 
-        return AtlasLibrary.LIBRARY[(mask_name, str(target_affine), str(target_shape), str(mask_threshold))]
+    @staticmethod
+    def roi_weights(atlas_obj: AtlasObject, roi_objects: list, binary: bool = False):
+        """
+        Sparse (n_voxels, n_rois) matrix whose columns average the voxels of the ROIs: one sparse-dense product
+        extracts the means of all ROIs, overlapping ROIs included.
+        :param atlas_obj: AtlasObject
+        :param roi_objects: list of RoiObject
+        :param binary: bool, equal weights for all voxels of a ROI instead of the probabilities
+                       of a probabilistic atlas
+        :return: scipy.sparse.csc_matrix
+        """
+        n_voxels = int(np.prod(atlas_obj.map.shape))
+        if atlas_obj.weights is not None and not binary:
+            # probabilistic atlas: ROI i + 1 is column i
+            weights = atlas_obj.weights[:, [int(roi.index) - 1 for roi in roi_objects]].tocsc()
+        else:
+            sizes = [roi.voxel_indices.size for roi in roi_objects]
+            rows = np.concatenate([roi.voxel_indices for roi in roi_objects]) if roi_objects else np.array([], int)
+            columns = np.repeat(np.arange(len(roi_objects)), sizes)
+            weights = sparse.csc_matrix((np.ones(rows.size, dtype=np.float32), (rows, columns)),
+                                        shape=(n_voxels, len(roi_objects)))
+        column_sums = np.asarray(weights.sum(axis=0)).ravel()
+        column_sums[column_sums == 0] = 1
+        return (weights @ sparse.diags(1. / column_sums)).astype(np.float32).tocsc()
 
     @staticmethod
-    def _resample(mask, target_affine, target_shape):
+    def _resample(mask, target_affine, target_shape, interpolation: str = 'nearest'):
         if target_affine is not None and target_shape is not None:
-            mask = image.resample_img(mask, target_affine=target_affine, target_shape=target_shape, interpolation='nearest')
+            mask = image.resample_img(mask, target_affine=target_affine, target_shape=target_shape,
+                                      interpolation=interpolation)
             # check orientations
             orient_data = ''.join(nib.aff2axcodes(target_affine))
             orient_roi = ''.join(nib.aff2axcodes(mask.affine))
@@ -274,7 +827,7 @@ class AtlasLibrary:
         :param query_list: serach after the ROI labels
         :return:
         """
-        return [i for i in atlas_obj.roi_list if i.label in query_list]
+        return atlas_obj.rois_by_label(query_list)
 
     @staticmethod
     def find_rois_by_index(atlas_obj: AtlasObject, query_list: list):
@@ -284,7 +837,7 @@ class AtlasLibrary:
         :param query_list: serach after the ROI index
         :return:
         """
-        return [i for i in atlas_obj.roi_list if i.index in query_list]
+        return atlas_obj.rois_by_index(query_list)
 
     @staticmethod
     def get_nii_files_from_folder(folder_path: str, extension: str=".nii.gz"):
@@ -307,24 +860,36 @@ class BrainAtlas(BaseEstimator):
         Name of specific Atlas. Possible values can be looked up in AtlasLibrary.
     * `extract_mode`: [str] - [default: 'vec']:
         The mode performing on ROI. Possible values: ['vec', 'mean', 'box', 'img']
+        'mean' extracts one (weighted) mean per ROI with one sparse-dense product.
     * `mask_threshold`: [str]:
         Mask Threshold. value < mask_threshold => value = 0
+        For probabilistic (4D) atlases the threshold applies to the probabilities.
     * `background_id`: [str]:
         The background ID for ROI.
+    * `roi_weighting`: [str] - [default: 'probability']:
+        Weights of the voxels in extract_mode 'mean' for probabilistic (4D) atlases: 'probability' for the
+        probability weighted mean, 'binary' for the plain mean of all voxels above mask_threshold.
+    * `dtype`: [str] - [default: None]:
+        Precision of the extraction ('float32' or 'float64'). None falls back to photonai_neuro.set_precision
+        and finally to float32.
+    * `storage_dtype`: [str] - [default: None]:
+        Precision of the extracted features ('float64', 'float32', 'float16', 'int16').
+        None falls back to photonai_neuro.set_precision and finally to the extraction precision.
 
     # ToDo
         #   + check RAS vs. LPS view-type and provide warning
         #  - unit tests
-        #  Later
-        #  - add support for overlapping ROIs and probabilistic atlases using 4d-nii
-        #  - add support for 4d resting-state data using nilearn
+        #  4d resting-state data: see RoiConnectivity
     """
     def __init__(self,
                  atlas_name: str,
                  extract_mode: str = 'vec',
                  mask_threshold: float = None,
                  background_id: int = 0,
-                 rois: Union[list, str] = 'all'):
+                 rois: Union[list, str] = 'all',
+                 dtype: str = None,
+                 storage_dtype: str = None,
+                 roi_weighting: str = 'probability'):
 
 
         self.atlas_name = atlas_name
@@ -334,9 +899,14 @@ class BrainAtlas(BaseEstimator):
         self.mask_threshold = mask_threshold
         self.background_id = background_id
         self.rois = rois
+        self.dtype = dtype
+        self.storage_dtype = storage_dtype
+        self.roi_weighting = roi_weighting
+        self.storage_scale = None
         self.box_shape = []
         self.is_transformer = True
         self.mask_indices = None
+        self.roi_offsets = None
         self.affine = None
         self.shape = None
         self.needs_y = False
@@ -372,38 +942,54 @@ class BrainAtlas(BaseEstimator):
         atlas_obj = AtlasLibrary().get_atlas(self.atlas_name, self.affine, self.shape, self.mask_threshold)
         roi_objects = self._get_rois(atlas_obj, which_rois=self.rois, background_id=self.background_id)
 
-        roi_data = [list() for i in range(n_subjects)]
-        roi_data_concat = list()
         t1 = time.time()
 
         # convert to series and C ordering since this will speed up the masking process
-        series = _utils.as_ndarray(_utils.niimg._safe_get_data(X), dtype='float32', order="C", copy=True)
-        mask_indices = list()
+        dtype = Precision.compute_dtype(self.dtype, default='float32')
+        series = _utils.as_ndarray(_utils.niimg._safe_get_data(X), dtype=dtype, order="C", copy=True)
+
+        storage_dtype = Precision.resolve_storage_dtype(self.storage_dtype)
+        if storage_dtype == 'int16' and self.storage_scale is None:
+            self.storage_scale = Precision.int16_scale(series)
 
-        # calculate roi_data for every ROI object by looping
+        # gather the voxels of all ROIs at once into one contiguous (n_subjects, n_voxels) matrix,
+        # ROI i lives in the columns roi_offsets[i]:roi_offsets[i+1]
         for i, roi in enumerate(roi_objects):
             self.roi_allocation[roi.label] = i
-
-            logger.debug("Extracting ROI {}".format(roi.label))
-            # simply call apply_mask to extract one roi
-            extraction = self.apply_mask(series, roi.mask)
-            if collection_mode == 'list':
-                for sub_i in range(extraction.shape[0]):
-                    roi_data[sub_i].append(extraction[sub_i])
-                mask_indices.append(i)
-            else:
-                roi_data_concat.append(extraction)
-                mask_indices.append(np.ones(extraction[0].size) * i)
-
-        if self.collection_mode == 'concat':
-            if n_subjects > 1:
-                roi_data = np.concatenate(roi_data_concat, axis=1)
-                self.mask_indices = np.concatenate(mask_indices)
+        if self.extract_mode == 'mean':
+            # one value per ROI: all (overlapping) ROIs in one sparse-dense product
+            if self.roi_weighting not in ['probability', 'binary']:
+                msg = "roi_weighting {} is not supported. Use 'probability' or 'binary'.".format(self.roi_weighting)
+                logger.error(msg)
+                raise ValueError(msg)
+            roi_sizes = [1] * len(roi_objects)
+            weights = AtlasLibrary.roi_weights(atlas_obj, roi_objects, binary=self.roi_weighting == 'binary')
+            flat_series = series.reshape(-1, series.shape[-1]) if series.ndim > 3 else series.reshape(-1, 1)
+            extraction = np.ascontiguousarray(np.asarray(weights.T @ flat_series, dtype=dtype).T)
+            if series.ndim == 3:
+                extraction = extraction[0]
+        else:
+            roi_sizes = [roi.voxel_indices.size for roi in roi_objects]
+            voxel_indices = np.concatenate([roi.voxel_indices for roi in roi_objects]) \
+                if roi_objects else np.array([], dtype=int)
+            if series.ndim > 3:
+                extraction = np.ascontiguousarray(series.reshape(-1, series.shape[-1])[voxel_indices].T)
             else:
-                roi_data = np.array(roi_data_concat)
-                self.mask_indices = mask_indices
+                extraction = series.reshape(-1)[voxel_indices]
+        self.roi_offsets = np.concatenate([[0], np.cumsum(roi_sizes)]).astype(int)
+        extraction, self.storage_scale = Precision.to_storage(extraction, storage_dtype, self.storage_scale)
+
+        if collection_mode == 'list':
+            roi_data = np.atleast_2d(extraction)
+            self.mask_indices = list(range(len(roi_objects)))
+        elif n_subjects > 1:
+            roi_data = extraction
+            self.mask_indices = np.repeat(np.arange(len(roi_objects), dtype=float), roi_sizes)
         else:
-            self.mask_indices = mask_indices
+            roi_data_concat = [extraction[..., self.roi_offsets[i]:self.roi_offsets[i + 1]]
+                               for i in range(len(roi_objects))]
+            roi_data = np.array(roi_data_concat)
+            self.mask_indices = [np.ones(extraction_i[0].size) * i for i, extraction_i in enumerate(roi_data_concat)]
 
         elapsed_time = time.time() - t1
         logger.debug("Time for extracting {} ROIs in {} subjects: {} seconds".format(len(roi_objects),
@@ -432,24 +1018,27 @@ class BrainAtlas(BaseEstimator):
         :param kwargs:
         :return:
         """
-        X = np.asarray(X)
+        X = Precision.from_storage(X, self.storage_scale)
 
         # get ROI masks
         atlas_obj = AtlasLibrary().get_atlas(self.atlas_name, self.affine, self.shape, self.mask_threshold)
         roi_objects = self._get_rois(atlas_obj, which_rois=self.rois, background_id=self.background_id)
 
-        unmasked = np.squeeze(np.zeros_like(atlas_obj.map, dtype='float32'))
+        # in list mode X is either one vector in the layout of transform() or one entry per ROI
+        roi_vector = self.collection_mode == 'list' and self.roi_offsets is not None and X.ndim == 1 \
+            and X.dtype != object and X.size == self.roi_offsets[-1]
 
-        for i, roi in enumerate(roi_objects):
-            mask, mask_affine = masking._load_mask_img(roi.mask)
-            mask_img = image.new_img_like(roi.mask, mask, mask_affine)
-            mask_data = _utils.as_ndarray(mask_img.get_fdata(), dtype=np.bool)
+        unmasked = np.zeros(atlas_obj.map.size, dtype='float32')
 
-            if self.collection_mode == 'list':
-                unmasked[mask_data] = X[i]
+        for i, roi in enumerate(roi_objects):
+            if roi_vector:
+                unmasked[roi.voxel_indices] = X[self.roi_offsets[i]:self.roi_offsets[i + 1]]
+            elif self.collection_mode == 'list':
+                unmasked[roi.voxel_indices] = Precision.from_storage(X[i], self.storage_scale)
             else:
-                unmasked[mask_data] = X[self.mask_indices == i]
+                unmasked[roi.voxel_indices] = X[self.mask_indices == i]
 
+        unmasked = np.squeeze(unmasked.reshape(atlas_obj.map.shape))
         new_image = image.new_img_like(atlas_obj.atlas, unmasked)
         return new_image
 
@@ -464,30 +1053,198 @@ class BrainAtlas(BaseEstimator):
             if which_rois == 'all':
                 return [roi for roi in atlas_obj.roi_list if roi.index != background_id]
             else:
-                return AtlasLibrary().find_rois_by_label(atlas_obj, [which_rois])
+                return AtlasLibrary.find_rois_by_label(atlas_obj, [which_rois])
 
         elif isinstance(which_rois, int):
-            return AtlasLibrary().find_rois_by_index(atlas_obj, [which_rois])
+            return AtlasLibrary.find_rois_by_index(atlas_obj, [which_rois])
 
         elif isinstance(which_rois, list):
             if isinstance(which_rois[0], str):
                 if which_rois[0].lower() == 'all':
                     return [roi for roi in atlas_obj.roi_list if roi.index != background_id]
                 else:
-                    return AtlasLibrary().find_rois_by_label(atlas_obj, which_rois)
+                    return AtlasLibrary.find_rois_by_label(atlas_obj, which_rois)
             else:
-                return AtlasLibrary().find_rois_by_index(atlas_obj, which_rois)
+                return AtlasLibrary.find_rois_by_index(atlas_obj, which_rois)
+
+
+class MultiAtlas(BaseEstimator):
+    """
+    Extracts the ROIs of several atlases in one pass over the data: every subject is loaded once and the ROIs
+    of all atlases are gathered from the same volume in memory.
+    The features of atlas i are the column block atlas_offsets[i]:atlas_offsets[i+1] of the output,
+    ROI j of all atlases lives in the columns roi_offsets[j]:roi_offsets[j+1] and is labeled roi_labels[j].
+    Within the block of an atlas the ROIs follow the order of the atlas, not the order of its rois.
+
+    Parameter
+    ---------
+    * `atlases` [list]:
+        Atlas names or dicts with the key atlas_name and optionally extract_mode, rois, mask_threshold and
+        roi_weighting (see BrainAtlas),
+        e.g. ['AAL', {'atlas_name': 'Schaefer2018_400Parcels_7Networks', 'extract_mode': 'mean'}].
+    * `extract_mode` [str] - [default: 'vec']:
+        Default mode of the atlases: 'vec' (all voxels of the ROIs) or 'mean' (one mean value per ROI).
+    * `background_id` [int] - [default: 0]:
+        The background ID of the atlases.
+    * `subject_batch_size` [int] - [default: None]:
+        Number of subjects loaded at once, None loads all subjects together.
+    * `dtype`: [str] - [default: None]:
+        Precision of the extraction, see BrainAtlas.
+    * `storage_dtype`: [str] - [default: None]:
+        Precision of the extracted features, see BrainAtlas.
+
+    """
+    EXTRACT_MODES = ['vec', 'mean']
+
+    def __init__(self,
+                 atlases: list,
+                 extract_mode: str = 'vec',
+                 background_id: int = 0,
+                 subject_batch_size: int = None,
+                 dtype: str = None,
+                 storage_dtype: str = None):
+        self.atlases = atlases
+        self.extract_mode = extract_mode
+        self.background_id = background_id
+        self.subject_batch_size = subject_batch_size
+        self.dtype = dtype
+        self.storage_dtype = storage_dtype
+        self.storage_scale = None
+        self.atlas_names = None
+        self.atlas_offsets = None
+        self.roi_labels = None
+        self.roi_offsets = None
+        self.affine = None
+        self.shape = None
+        self.needs_y = False
+        self.needs_covariates = False
+
+    def fit(self, X, y=None):
+        return self
+
+    def _atlas_specs(self):
+        specs = list()
+        for atlas in self.atlases:
+            spec = {'atlas_name': atlas} if isinstance(atlas, str) else dict(atlas)
+            spec.setdefault('extract_mode', self.extract_mode)
+            spec.setdefault('rois', 'all')
+            spec.setdefault('mask_threshold', None)
+            spec.setdefault('roi_weighting', 'probability')
+            if spec['extract_mode'] not in MultiAtlas.EXTRACT_MODES:
+                msg = "MultiAtlas extract_mode {} is not supported. Use one of {}.".format(spec['extract_mode'],
+                                                                                       MultiAtlas.EXTRACT_MODES)
+                logger.error(msg)
+                raise ValueError(msg)
+            specs.append(spec)
+        return specs
+
+    def _gather_plan(self):
+        # voxel indices, mean weights and ROI sizes of every atlas on the grid of the data
+        plan = list()
+        self.atlas_names, self.roi_labels = list(), list()
+        atlas_offsets, roi_offsets = [0], [0]
+        for spec in self._atlas_specs():
+            atlas_obj = AtlasLibrary().get_atlas(spec['atlas_name'], self.affine, self.shape, spec['mask_threshold'])
+            roi_objects = BrainAtlas._get_rois(atlas_obj, which_rois=spec['rois'], background_id=self.background_id)
+            sizes = np.array([roi.voxel_indices.size for roi in roi_objects], dtype=int)
+            voxel_indices = np.concatenate([roi.voxel_indices for roi in roi_objects]) \
+                if roi_objects else np.array([], dtype=int)
+            # mean features: one sparse-dense product, probability weighted for probabilistic atlases
+            weights = AtlasLibrary.roi_weights(atlas_obj, roi_objects, binary=spec['roi_weighting'] == 'binary') \
+                if spec['extract_mode'] == 'mean' else None
+            plan.append((spec['extract_mode'], voxel_indices, weights, sizes))
+
+            n_features = int(sizes.sum()) if spec['extract_mode'] == 'vec' else len(roi_objects)
+            roi_widths = sizes if spec['extract_mode'] == 'vec' else np.ones(len(roi_objects), dtype=int)
+            self.atlas_names.append(spec['atlas_name'])
+            self.roi_labels += ["{}/{}".format(spec['atlas_name'], roi.label) for roi in roi_objects]
+            atlas_offsets.append(atlas_offsets[-1] + n_features)
+            roi_offsets += list(roi_offsets[-1] + np.cumsum(roi_widths))
+        self.atlas_offsets = np.asarray(atlas_offsets, dtype=int)
+        self.roi_offsets = np.asarray(roi_offsets, dtype=int)
+        return plan
+
+    def transform(self, X, y=None, **kwargs):
+        """
+        :param X: input data
+        :param y: targets
+        :param kwargs:
+        :return: features: np.ndarray, (n_subjects, n_features), the atlases are column blocks
+        """
+        self.affine, self.shape = BrainMask.get_format_info_from_first_image(X)
+        plan = self._gather_plan()
+        dtype = Precision.compute_dtype(self.dtype, default='float32')
+        storage_dtype = Precision.resolve_storage_dtype(self.storage_dtype)
+
+        if isinstance(X, (list, np.ndarray)) and self.subject_batch_size is not None:
+            batches = [X[i:i + self.subject_batch_size] for i in range(0, len(X), self.subject_batch_size)]
+        else:
+            batches = [X]
+
+        t1 = time.time()
+        features = list()
+        for batch in batches:
+            # every subject of the batch is loaded once for all atlases
+            batch_img, n_subjects = NiftiConverter.transform(batch)
+            series = _utils.as_ndarray(_utils.niimg._safe_get_data(batch_img), dtype=dtype, order="C")
+            series = series.reshape(-1, series.shape[-1]) if series.ndim > 3 else series.reshape(-1, 1)
+            batch_features = np.empty((series.shape[1], self.atlas_offsets[-1]), dtype=dtype)
+            for i, (extract_mode, voxel_indices, weights, sizes) in enumerate(plan):
+                block = batch_features[:, self.atlas_offsets[i]:self.atlas_offsets[i + 1]]
+                if extract_mode == 'vec':
+                    block[:] = series[voxel_indices].T
+                else:
+                    block[:] = np.asarray(weights.T @ series).T
+            features.append(batch_features)
+        features = np.concatenate(features) if len(features) > 1 else features[0]
+
+        if storage_dtype == 'int16' and self.storage_scale is None:
+            self.storage_scale = Precision.int16_scale(features)
+        features, self.storage_scale = Precision.to_storage(features, storage_dtype, self.storage_scale)
+        logger.debug("Time for extracting {} atlases in {} subjects: {} seconds".format(
+            len(plan), features.shape[0], time.time() - t1))
+        return features
+
+    def blocks(self, X):
+        """
+        Split extracted features into the blocks of the atlases.
+        :param X: np.ndarray, output of transform
+        :return: dict, feature block (a view on X) by atlas name
+        """
+        return {atlas_name: X[..., self.atlas_offsets[i]:self.atlas_offsets[i + 1]]
+                for i, atlas_name in enumerate(self.atlas_names)}
+
+    def inverse_transform(self, X, y=None, **kwargs):
+        """
+        Reconstruct one image per atlas from a feature vector, mean features fill their whole ROI.
+        :param X: np.ndarray, one value per feature
+        :return: list of Nifti1Image, one per atlas
+        """
+        X = np.asarray(Precision.from_storage(X, self.storage_scale)).ravel()
+        images = list()
+        for i, (extract_mode, voxel_indices, _, sizes) in enumerate(self._gather_plan()):
+            atlas_obj = AtlasLibrary().get_atlas(self.atlas_names[i], self.affine, self.shape,
+                                                 self._atlas_specs()[i]['mask_threshold'])
+            block = X[self.atlas_offsets[i]:self.atlas_offsets[i + 1]]
+            unmasked = np.zeros(atlas_obj.map.size, dtype='float32')
+            unmasked[voxel_indices] = block if extract_mode == 'vec' else np.repeat(block, sizes)
+            images.append(image.new_img_like(atlas_obj.atlas, unmasked.reshape(atlas_obj.map.shape)))
+        return images
 
 
 class BrainMask(BaseEstimator):
 
-    def __init__(self, mask_image='MNI_ICBM152_WholeBrain', affine=None, shape=None, mask_threshold=0.5, extract_mode='vec'):
+    def __init__(self, mask_image='MNI_ICBM152_WholeBrain', affine=None, shape=None, mask_threshold=0.5, extract_mode='vec',
+                 dtype: str = None, storage_dtype: str = None):
         self.mask_image = mask_image
         self.affine = affine
         self.shape = shape
         self.masker = None
         self.extract_mode = extract_mode
         self.mask_threshold = mask_threshold
+        self.dtype = dtype
+        self.storage_dtype = storage_dtype
+        self.storage_scale = None
 
     @staticmethod
     def get_format_info_from_first_image(X):
@@ -508,18 +1265,18 @@ class BrainMask(BaseEstimator):
             raise ValueError(msg)
 
     @staticmethod
-    def _get_box(in_imgs, roi):
+    def _get_box(in_imgs, roi, dtype='float32'):
         # get ROI infos
-        map = roi.mask.get_fdata()
+        map = np.asanyarray(roi.mask.dataobj)
         true_points = np.argwhere(map)
         corner1 = true_points.min(axis=0)
         corner2 = true_points.max(axis=0)
         box = []
         for img in in_imgs:
             if isinstance(img, str):
-                data = image.load_img(img).get_fdata()
+                data = image.load_img(img).get_fdata(dtype=dtype)
             else:
-                data = img.get_fdata()
+                data = img.get_fdata(dtype=dtype)
             tmp = data[corner1[0]:corner2[0] + 1, corner1[1]:corner2[1] + 1, corner1[2]:corner2[2] + 1]
             box.append(tmp)
         return np.asarray(box)
@@ -538,8 +1295,10 @@ class BrainMask(BaseEstimator):
             pass
 
         if not self.mask_image.is_empty:
+            dtype = Precision.compute_dtype(self.dtype, default='float32')
+            storage_dtype = Precision.resolve_storage_dtype(self.storage_dtype)
             self.masker = NiftiMasker(mask_img=self.mask_image.mask, target_affine=self.affine,
-                                      target_shape=self.shape, dtype='float32')
+                                      target_shape=self.shape, dtype=dtype)
             try:
                 single_roi = self.masker.fit_transform(X)
             except BaseException as e:
@@ -548,13 +1307,15 @@ class BrainMask(BaseEstimator):
 
             if single_roi is not None:
                 if self.extract_mode == 'vec':
-                    return np.asarray(single_roi)
+                    single_roi, self.storage_scale = Precision.to_storage(np.asarray(single_roi), storage_dtype,
+                                                                          self.storage_scale)
+                    return single_roi
 
                 elif self.extract_mode == 'mean':
                     return np.mean(single_roi, axis=1)
 
                 elif self.extract_mode == 'box':
-                    return BrainMask._get_box(X, self.mask_image)
+                    return BrainMask._get_box(X, self.mask_image, dtype=dtype)
 
                 elif self.extract_mode == 'img':
                     return self.masker.inverse_transform(single_roi)
@@ -583,4 +1344,4 @@ class BrainMask(BaseEstimator):
             logger.error(msg)
             raise NotImplementedError(msg)
 
-        return self.masker.inverse_transform(X)
+        return self.masker.inverse_transform(Precision.from_storage(X, self.storage_scale))
@@ -0,0 +1,269 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from glob import glob
+
+import joblib
+import nibabel as nib
+import numpy as np
+
+from photonai.base import PipelineElement
+from photonai.photonlogger.logger import logger
+
+from photonai_neuro.brain_atlas import AtlasLibrary
+from photonai_neuro.feature_store import FeatureStore
+from photonai_neuro.neuro_branch import NeuroBranch
+
+
+def parse_step(step: str):
+    """
+    Parse a step specification "Name:param=value,param=value" into (name, params).
+    Values are read as JSON if possible, e.g. fwhm=[6,6,6] or rois=["Hippocampus_L","Hippocampus_R"].
+    """
+    name, _, param_string = step.partition(':')
+    params = dict()
+    for item in _split_params(param_string):
+        key, sep, value = item.partition('=')
+        if not sep:
+            raise argparse.ArgumentTypeError("Invalid parameter '{}' in step '{}'".format(item, step))
+        try:
+            params[key.strip()] = json.loads(value)
+        except ValueError:
+            params[key.strip()] = value
+    return name.strip(), params
+
+
+def _split_params(param_string: str):
+    # split at commas outside of brackets and quotes
+    items, depth, quoted, current = list(), 0, False, ''
+    for char in param_string:
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char in '[{':
+            depth += 1
+        elif not quoted and char in ']}':
+            depth -= 1
+        if char == ',' and depth == 0 and not quoted:
+            items.append(current)
+            current = ''
+        else:
+            current += char
+    if current:
+        items.append(current)
+    return [item for item in items if item.strip()]
+
+
+def read_subjects(source: str, pattern: str = '*.nii*'):
+    """
+    Collect the input files.
+    :param source: str, directory (searched recursively for pattern) or manifest: a CSV with the columns path and
+                   optional subject_id, or a text file with one path per line. Relative paths are relative to the
+                   manifest.
+    :return: (files, subject_ids)
+    """
+    if os.path.isdir(source):
+        files = sorted(glob(os.path.join(source, '**', pattern), recursive=True))
+        return files, [os.path.relpath(f, source) for f in files]
+
+    base_folder = os.path.dirname(os.path.abspath(source))
+    with open(source, 'r', newline='') as f:
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    if lines and 'path' in [c.strip() for c in lines[0].split(',')]:
+        rows = list(csv.DictReader(lines))
+        files = [row['path'].strip() for row in rows]
+        subject_ids = [row['subject_id'].strip() if row.get('subject_id') else path for row, path in zip(rows, files)]
+    else:
+        files = [line.strip() for line in lines]
+        subject_ids = list(files)
+    files = [f if os.path.isabs(f) else os.path.join(base_folder, f) for f in files]
+    return files, subject_ids
+
+
+def build_neuro_branch(steps: list):
+    """
+    :param steps: list of (name, params)
+    :return: NeuroBranch
+    """
+    neuro_branch = NeuroBranch('extraction')
+    for name, params in steps:
+        neuro_branch += PipelineElement(name, **params)
+    return neuro_branch
+
+
+def batch_size_for_budget(file: str, memory_budget: float, n_jobs: int, copies: int = 4):
+    """
+    Number of subjects per batch so that all workers together stay within the memory budget.
+    :param file: str, representative input file
+    :param memory_budget: float, bytes
+    :param n_jobs: int, number of workers
+    :param copies: int, float32 copies of an image a transformation holds at once
+    :return: int
+    """
+    subject_bytes = int(np.prod(nib.load(file).shape)) * 4 * copies
+    return max(1, int(memory_budget // (max(n_jobs, 1) * subject_bytes)))
+
+
+def parse_memory(memory: str):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    memory = memory.strip().upper().rstrip('B')
+    if memory and memory[-1] in units:
+        return float(memory[:-1]) * units[memory[-1]]
+    return float(memory)
+
+
+def _extract_batch(neuro_branch: NeuroBranch, files: list):
+    """
+    Extract a batch of subjects in a worker.
+    :return: (features, layout)
+    """
+    neuro_branch.fit(files)
+    features, _, _ = neuro_branch.transform(files)
+    features = np.asarray(features).reshape(len(files), -1)
+    return features, FeatureStore.describe(neuro_branch, features.shape[1])
+
+
+def extract(files: list, subject_ids: list, steps: list, store_folder: str, n_jobs: int = 1,
+            memory_budget: float = 4 * 1024 ** 3, batch_size: int = None, compress: bool = False, out=None):
+    """
+    Extract all subjects that are not in the feature store yet.
+    Every batch is committed to the store when it is done, an interrupted run resumes with the missing subjects.
+    :return: int, number of extracted subjects
+    """
+    out = out if out is not None else sys.stdout
+    store = FeatureStore(store_folder, compress=compress)
+    neuro_branch = build_neuro_branch(steps)
+    # features of other steps are extracted again
+    store.invalidate(neuro_branch)
+    indices, subject_ids, hashes = store.diff(files, subject_ids)
+    print("{} subjects, {} in the store, {} to extract".format(len(files), len(files) - len(indices), len(indices)),
+          file=out)
+    if not indices:
+        return 0
+
+    n_jobs = joblib.cpu_count() if n_jobs == -1 else n_jobs
+    if batch_size is None:
+        batch_size = batch_size_for_budget(files[indices[0]], memory_budget, n_jobs)
+    batches = [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+    print("batch size {}, {} batches, {} workers".format(batch_size, len(batches), n_jobs), file=out)
+
+    start_time = time.time()
+    n_done, n_bytes = 0, 0
+    with joblib.parallel_backend('loky', inner_max_num_threads=1), joblib.Parallel(n_jobs=n_jobs) as parallel:
+        # one wave of batches per worker pool round, every finished wave is committed to the store
+        for wave_start in range(0, len(batches), n_jobs):
+            wave = batches[wave_start:wave_start + n_jobs]
+            results = parallel(joblib.delayed(_extract_batch)(neuro_branch.copy_me(), [files[i] for i in batch])
+                               for batch in wave)
+            for batch, (features, layout) in zip(wave, results):
+                store.add([subject_ids[i] for i in batch], [hashes[i] for i in batch], features, layout=layout)
+                n_done += len(batch)
+                n_bytes += sum(os.path.getsize(files[i]) for i in batch)
+            elapsed = time.time() - start_time
+            rate = n_done / max(elapsed, 1e-9)
+            print("{}/{} subjects, {:.2f} subjects/s, {:.1f} MB/s, ETA {:.0f}s".format(
+                n_done, len(indices), rate, n_bytes / 1024 ** 2 / max(elapsed, 1e-9),
+                (len(indices) - n_done) / rate), file=out)
+
+    elapsed = time.time() - start_time
+    print("extracted {} subjects in {:.1f}s ({:.2f} subjects/s) into {}".format(
+        n_done, elapsed, n_done / max(elapsed, 1e-9), store_folder), file=out)
+    return n_done
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='photonai-neuro-extract',
+        description="Extract features from NIfTI files with photonai_neuro elements into a FeatureStore. "
+                    "Subjects already in the store are skipped, so an interrupted run can simply be restarted.")
+    parser.add_argument('source', help="directory of NIfTI files or manifest (CSV with columns path[,subject_id] "
+                                       "or one path per line)")
+    parser.add_argument('-o', '--output', required=True, help="folder of the feature store")
+    parser.add_argument('-s', '--step', action='append', type=parse_step, dest='steps',
+                        help="neuro element, repeatable and applied in order, "
+                             "e.g. SmoothImages:fwhm=6 or BrainAtlas:atlas_name=AAL,extract_mode=mean")
+    parser.add_argument('--spec', help="JSON file with a list of {\"name\": ..., \"params\": {...}} steps, "
+                                       "instead of --step")
+    parser.add_argument('--pattern', default='*.nii*', help="file pattern in directories [default: *.nii*]")
+    parser.add_argument('-j', '--n-jobs', type=int, default=1, help="number of worker processes, -1 for all cores")
+    parser.add_argument('-m', '--memory', type=parse_memory, default='4G',
+                        help="memory budget of all workers together, e.g. 16G [default: 4G]")
+    parser.add_argument('-b', '--batch-size', type=int, default=None,
+                        help="subjects per batch, derived from the memory budget by default")
+    parser.add_argument('--compress', action='store_true', help="write compressed chunks")
+    return parser
+
+
+def main(argv: list = None):
+    args = get_parser().parse_args(argv)
+
+    steps = args.steps or list()
+    if args.spec:
+        with open(args.spec, 'r') as f:
+            steps = [(step['name'], step.get('params', dict())) for step in json.load(f)]
+    if not steps:
+        msg = "No extraction steps given, use --step or --spec."
+        logger.error(msg)
+        print(msg, file=sys.stderr)
+        return 2
+
+    files, subject_ids = read_subjects(args.source, args.pattern)
+    if not files:
+        msg = "No input files found in {}".format(args.source)
+        logger.error(msg)
+        print(msg, file=sys.stderr)
+        return 1
+
+    extract(files, subject_ids, steps, args.output, n_jobs=args.n_jobs, memory_budget=args.memory,
+            batch_size=args.batch_size, compress=args.compress)
+    return 0
+
+
+def parse_grid(grid: str):
+    """
+    Voxel size of an MNI152 grid (e.g. 2 or 1.5) or path to a reference nifti.
+    """
+    try:
+        return float(grid)
+    except ValueError:
+        if not os.path.isfile(grid):
+            raise argparse.ArgumentTypeError("Grid {} is neither a voxel size nor a nifti file.".format(grid))
+        return grid
+
+
+def get_precompute_parser():
+    parser = argparse.ArgumentParser(
+        prog='photonai-neuro-atlases',
+        description="Resample atlases and masks to standard grids once. AtlasLibrary picks the precomputed "
+                    "atlases up automatically when the grid of the data matches.")
+    parser.add_argument('-g', '--grid', action='append', type=parse_grid, dest='grids', required=True,
+                        help="voxel size of an MNI152 grid or reference nifti, repeatable, e.g. -g 2 -g 3")
+    parser.add_argument('-a', '--atlas', action='append', dest='atlases',
+                        help="atlas name, repeatable [default: all bundled atlases]")
+    parser.add_argument('-k', '--mask', action='append', dest='masks',
+                        help="mask name, repeatable [default: all bundled masks]")
+    parser.add_argument('--mask-threshold', type=float, default=0.5, help="threshold of the masks [default: 0.5]")
+    parser.add_argument('-o', '--output', default=None,
+                        help="folder of the precomputed atlases [default: {}]".format(
+                            AtlasLibrary.user_bundle_folder()))
+    parser.add_argument('--package', action='store_true',
+                        help="store the precomputed atlases next to the bundled atlases of the package")
+    return parser
+
+
+def precompute_main(argv: list = None):
+    args = get_precompute_parser().parse_args(argv)
+    folder = args.output
+    if args.package:
+        folder = AtlasLibrary.bundle_folders()[-1]
+    keys = AtlasLibrary.precompute(args.grids, atlases=args.atlases, masks=args.masks, folder=folder,
+                                   mask_threshold=args.mask_threshold)
+    print("precomputed {} atlases and masks into {}".format(
+        len(keys), folder if folder is not None else AtlasLibrary.user_bundle_folder()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+import time
+
+import nibabel as nib
+import numpy as np
+from nibabel.nifti1 import Nifti1Image
+from sklearn.base import BaseEstimator
+
+from photonai.photonlogger.logger import logger
+
+from photonai_neuro.brain_atlas import AtlasLibrary, BrainAtlas
+from photonai_neuro.precision import Precision
+
+
+class RoiConnectivity(BaseEstimator):
+    """
+    Functional connectivity of 4D (e.g. resting-state) runs, one run per subject.
+    The ROI mean time series are extracted with one sparse ROI matrix product per chunk of volumes,
+    so only time_chunk_size volumes of a run are in memory at once. The connectivity matrices are computed
+    batched in float32 and returned as vectorised upper triangles.
+
+    Parameter
+    ---------
+    * `atlas_name` [str]:
+        Name of the atlas, see AtlasLibrary. Probabilistic (4D) atlases give weighted mean time series.
+    * `kind` [str] - [default: 'correlation']:
+        Connectivity measure: 'correlation', 'partial_correlation' or 'covariance'.
+    * `rois` [list, str] - [default: 'all']:
+        ROIs of the atlas, see BrainAtlas.
+    * `mask_threshold` [float] - [default: None]:
+        Mask threshold of the atlas, see BrainAtlas.
+    * `background_id` [int] - [default: 0]:
+        The background ID of the atlas.
+    * `roi_weighting` [str] - [default: 'probability']:
+        Voxel weights of probabilistic atlases, see BrainAtlas.
+    * `time_chunk_size` [int] - [default: 100]:
+        Number of volumes read at once.
+    * `fisher_z` [bool] - [default: False]:
+        Return Fisher z-transformed (partial) correlations.
+    * `storage_dtype`: [str] - [default: None]:
+        Precision of the returned features, see BrainAtlas.
+
+    """
+    KINDS = ['correlation', 'partial_correlation', 'covariance']
+
+    def __init__(self,
+                 atlas_name: str,
+                 kind: str = 'correlation',
+                 rois='all',
+                 mask_threshold: float = None,
+                 background_id: int = 0,
+                 roi_weighting: str = 'probability',
+                 time_chunk_size: int = 100,
+                 fisher_z: bool = False,
+                 storage_dtype: str = None):
+        self.atlas_name = atlas_name
+        self.kind = kind
+        self.rois = rois
+        self.mask_threshold = mask_threshold
+        self.background_id = background_id
+        self.roi_weighting = roi_weighting
+        self.time_chunk_size = time_chunk_size
+        self.fisher_z = fisher_z
+        self.storage_dtype = storage_dtype
+        self.storage_scale = None
+        self.roi_labels = None
+        self.affine = None
+        self.shape = None
+        self.needs_y = False
+        self.needs_covariates = False
+
+    def fit(self, X, y=None):
+        return self
+
+    @staticmethod
+    def _runs(X):
+        # one 4D run per subject, never concatenated into one image
+        if isinstance(X, (str, Nifti1Image)):
+            return [X]
+        return list(X)
+
+    def _roi_weights(self, run):
+        img = nib.load(run) if isinstance(run, str) else run
+        self.affine, self.shape = img.affine, img.shape[:3]
+        atlas_obj = AtlasLibrary().get_atlas(self.atlas_name, self.affine, self.shape, self.mask_threshold)
+        roi_objects = BrainAtlas._get_rois(atlas_obj, which_rois=self.rois, background_id=self.background_id)
+        self.roi_labels = [roi.label for roi in roi_objects]
+        return AtlasLibrary.roi_weights(atlas_obj, roi_objects, binary=self.roi_weighting == 'binary')
+
+    def time_series(self, run, weights=None):
+        """
+        ROI mean time series of one run, read in chunks of time_chunk_size volumes.
+        :param run: str or Nifti1Image, 4D run
+        :param weights: sparse ROI matrix, None builds it for the grid of the run
+        :return: np.ndarray, (n_volumes, n_rois) float32
+        """
+        weights = self._roi_weights(run) if weights is None else weights
+        img = nib.load(run) if isinstance(run, str) else run
+        n_volumes = img.shape[3] if len(img.shape) > 3 else 1
+        time_series = np.empty((n_volumes, weights.shape[1]), dtype=np.float32)
+        for start in range(0, n_volumes, self.time_chunk_size):
+            stop = min(start + self.time_chunk_size, n_volumes)
+            chunk = img.dataobj[..., start:stop] if len(img.shape) > 3 else img.dataobj[..., np.newaxis]
+            chunk = np.asarray(chunk, dtype=np.float32).reshape(-1, stop - start)
+            time_series[start:stop] = np.asarray(weights.T @ chunk).T
+        return time_series
+
+    def transform(self, X, y=None, **kwargs):
+        """
+        :param X: 4D run or list of 4D runs (paths or Nifti1Images)
+        :param y: targets
+        :param kwargs:
+        :return: np.ndarray, (n_subjects, n_edges) upper triangles of the connectivity matrices
+        """
+        if self.kind not in RoiConnectivity.KINDS:
+            msg = "RoiConnectivity kind {} is not supported. Use one of {}.".format(self.kind, RoiConnectivity.KINDS)
+            logger.error(msg)
+            raise ValueError(msg)
+
+        t1 = time.time()
+        runs = RoiConnectivity._runs(X)
+        weights = self._roi_weights(runs[0])
+        time_series = [self.time_series(run, weights) for run in runs]
+
+        # runs of equal length are one batch
+        matrices = np.empty((len(runs), weights.shape[1], weights.shape[1]), dtype=np.float32)
+        lengths = np.array([ts.shape[0] for ts in time_series])
+        for length in np.unique(lengths):
+            batch = np.flatnonzero(lengths == length)
+            matrices[batch] = RoiConnectivity.connectivity(np.stack([time_series[i] for i in batch]), self.kind)
+
+        features = RoiConnectivity.matrix_to_vector(matrices, diagonal=self.kind == 'covariance')
+        if self.fisher_z and self.kind != 'covariance':
+            features = np.arctanh(np.clip(features, -1 + 1e-7, 1 - 1e-7))
+
+        storage_dtype = Precision.resolve_storage_dtype(self.storage_dtype)
+        if storage_dtype == 'int16' and self.storage_scale is None:
+            self.storage_scale = Precision.int16_scale(features)
+        features, self.storage_scale = Precision.to_storage(features, storage_dtype, self.storage_scale)
+        logger.debug("Time for {} of {} runs: {} seconds".format(self.kind, len(runs), time.time() - t1))
+        return features
+
+    @staticmethod
+    def connectivity(time_series: np.ndarray, kind: str = 'correlation'):
+        """
+        Batched connectivity matrices.
+        :param time_series: np.ndarray, (n_subjects, n_volumes, n_rois)
+        :param kind: str, 'correlation', 'partial_correlation' or 'covariance'
+        :return: np.ndarray, (n_subjects, n_rois, n_rois) float32
+        """
+        time_series = np.asarray(time_series, dtype=np.float32)
+        centered = time_series - time_series.mean(axis=1, keepdims=True)
+        covariance = np.matmul(centered.transpose(0, 2, 1), centered) / max(time_series.shape[1] - 1, 1)
+        if kind == 'covariance':
+            return covariance
+        if kind == 'partial_correlation':
+            covariance = np.linalg.pinv(covariance).astype(np.float32)
+        std = np.sqrt(np.diagonal(covariance, axis1=1, axis2=2))
+        std = np.where(std > 0, std, 1)
+        matrices = covariance / (std[:, :, np.newaxis] * std[:, np.newaxis, :])
+        if kind == 'partial_correlation':
+            matrices = -matrices
+        idx = np.arange(matrices.shape[1])
+        matrices[:, idx, idx] = 1
+        return matrices
+
+    @staticmethod
+    def matrix_to_vector(matrices: np.ndarray, diagonal: bool = False):
+        """
+        :param matrices: np.ndarray, (n_subjects, n_rois, n_rois) symmetric matrices
+        :param diagonal: bool, include the diagonal
+        :return: np.ndarray, (n_subjects, n_edges) upper triangles
+        """
+        rows, columns = np.triu_indices(matrices.shape[-1], k=0 if diagonal else 1)
+        return np.ascontiguousarray(matrices[:, rows, columns])
+
+    @staticmethod
+    def vector_to_matrix(vectors: np.ndarray, n_rois: int, diagonal: bool = False):
+        """
+        Inverse of matrix_to_vector. Without diagonal, the diagonal is set to 1.
+        :return: np.ndarray, (n_subjects, n_rois, n_rois)
+        """
+        vectors = np.atleast_2d(vectors)
+        rows, columns = np.triu_indices(n_rois, k=0 if diagonal else 1)
+        matrices = np.zeros((vectors.shape[0], n_rois, n_rois), dtype=vectors.dtype)
+        if not diagonal:
+            matrices[:, np.arange(n_rois), np.arange(n_rois)] = 1
+        matrices[:, rows, columns] = vectors
+        matrices[:, columns, rows] = vectors
+        return matrices
+
+    def inverse_transform(self, X, y=None, **kwargs):
+        """
+        Connectivity matrices of vectorised upper triangles.
+        :param X: np.ndarray, (n_subjects, n_edges) or (n_edges,)
+        :return: np.ndarray, (n_subjects, n_rois, n_rois)
+        """
+        X = Precision.from_storage(np.asarray(X), self.storage_scale)
+        if self.fisher_z and self.kind != 'covariance':
+            X = np.tanh(X)
+        return RoiConnectivity.vector_to_matrix(X, len(self.roi_labels), diagonal=self.kind == 'covariance')
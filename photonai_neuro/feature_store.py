@@ -0,0 +1,489 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import Union
+
+import numpy as np
+import pandas as pd
+from nibabel.nifti1 import Nifti1Image
+
+from photonai.base import PipelineElement
+from photonai.photonlogger.logger import logger
+
+from photonai_neuro.brain_atlas import BrainAtlas, BrainMask, MultiAtlas
+from photonai_neuro.neuro_branch import NeuroBranch
+from photonai_neuro.util import dump_json
+
+
+class FeatureStore:
+    """
+    Persistent, columnar store of the features a neuro element extracted, keyed by subject ID and the content hash
+    of the subject's input. Only new or changed subjects have to be extracted, the features of all other subjects
+    are read from the store. Per-feature statistics are updated incrementally.
+
+    Rows are appended in blocks (one folder per update). Within a block the columns are split into chunks
+    along the ROI borders, so a subset of ROIs is read without loading the other columns.
+    Uncompressed chunks are memory mapped. Replaced subjects leave dead rows behind until compact() is called.
+
+    The meta file holds the subject IDs and the layout of the columns: ROI labels, ROI offsets, affine and shape
+    of the data grid and the parameters of the neuro element that produced the features.
+
+    Parameter
+    ---------
+    * `folder` [str]:
+        Folder of the store, created if it does not exist.
+
+    * `compress` [bool] - [default: False]:
+        Write compressed chunks. Compressed chunks are smaller, but are decompressed on read instead of
+        being memory mapped.
+
+    * `min_chunk_columns` [int] - [default: 1024]:
+        Consecutive small ROIs are grouped into chunks of at least this many columns.
+
+    """
+    META_FILE = 'feature_store.json'
+    STATISTICS_FILE = 'feature_store_statistics.npy'
+
+    def __init__(self, folder: str, compress: bool = False, min_chunk_columns: int = 1024):
+        self.folder = folder
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.compress = compress
+        self.min_chunk_columns = min_chunk_columns
+        self.meta = self._read_meta()
+
+    def _read_meta(self):
+        meta_file = os.path.join(self.folder, self.META_FILE)
+        if not os.path.isfile(meta_file):
+            return FeatureStore._empty_meta()
+        with open(meta_file, 'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def _empty_meta():
+        return {'n_features': None, 'layout': None, 'chunk_offsets': None, 'blocks': dict(), 'subjects': dict()}
+
+    def __len__(self):
+        return len(self.meta['subjects'])
+
+    def __contains__(self, subject_id):
+        return subject_id in self.meta['subjects']
+
+    @property
+    def subject_ids(self):
+        return list(self.meta['subjects'].keys())
+
+    @property
+    def layout(self):
+        """
+        Layout of the features as given on add: roi_labels, roi_offsets, affine, shape and params.
+        """
+        return self.meta['layout']
+
+    @property
+    def roi_labels(self):
+        if self.meta['layout'] and self.meta['layout'].get('roi_labels') is not None:
+            return self.meta['layout']['roi_labels']
+        return list(range(len(self._roi_offsets()) - 1))
+
+    def diff(self, X, subject_ids: list = None):
+        """
+        Find the subjects of X that are not in the store or whose input changed.
+        :param X: list of file paths or Nifti1Images
+        :param subject_ids: list, ID of every subject in X, None uses the file paths
+        :return: (indices, subject_ids, hashes): indices of the new or changed subjects in X,
+                 and ID and content hash of every subject in X
+        """
+        subject_ids = FeatureStore._subject_ids(X, subject_ids)
+        hashes = [FeatureStore.content_hash(x) for x in X]
+        indices = [i for i, (subject_id, content_hash) in enumerate(zip(subject_ids, hashes))
+                   if subject_id not in self.meta['subjects'] or self.meta['subjects'][subject_id][0] != content_hash]
+        return indices, subject_ids, hashes
+
+    def add(self, subject_ids: list, hashes: list, features, layout: dict = None):
+        """
+        Append the features of new subjects and replace those of changed subjects.
+        :param subject_ids: list, ID of every row of features
+        :param hashes: list, content hash of the input of every row
+        :param features: np.ndarray, (n_subjects, n_features)
+        :param layout: dict, json serializable description of the feature columns, see describe
+        """
+        features = np.atleast_2d(np.asarray(features))
+        if len(subject_ids) == 0:
+            return
+        if len(set(subject_ids)) != len(subject_ids) or len(subject_ids) != features.shape[0]:
+            msg = "FeatureStore expected one unique subject ID per row of features."
+            logger.error(msg)
+            raise ValueError(msg)
+        if self.meta['n_features'] is not None and (features.shape[1] != self.meta['n_features']
+                                                    or (layout is not None and layout != self.meta['layout'])):
+            msg = "FeatureStore: features do not match the features in the store."
+            logger.error(msg)
+            raise ValueError(msg)
+
+        if self.meta['n_features'] is None:
+            self.meta['n_features'] = int(features.shape[1])
+            self.meta['layout'] = layout
+            self.meta['chunk_offsets'] = self._group_chunks(self._roi_offsets())
+
+        # remove replaced subjects from the statistics before their rows are dropped
+        replaced = [subject_id for subject_id in subject_ids if subject_id in self.meta['subjects']]
+        statistics = self._read_statistics(features.shape[1])
+        if replaced:
+            statistics = FeatureStore._remove_rows(statistics, self.read(subject_ids=replaced))
+        statistics = FeatureStore._add_rows(statistics, features)
+
+        block = self._write_block(features)
+        FeatureStore._save_array(statistics, os.path.join(self.folder, self.STATISTICS_FILE))
+
+        for row, (subject_id, content_hash) in enumerate(zip(subject_ids, hashes)):
+            self.meta['subjects'][subject_id] = [content_hash, block, row]
+        # the meta file is written last, it defines the content of the store
+        dump_json(self.meta, os.path.join(self.folder, self.META_FILE))
+        logger.info("FeatureStore: added {} subjects, replaced {}".format(len(subject_ids) - len(replaced),
+                                                                           len(replaced)))
+
+    def update(self, X, neuro_element: Union[NeuroBranch, PipelineElement], subject_ids: list = None):
+        """
+        Extract the new or changed subjects of X with neuro_element and add them to the store.
+        :param X: list of file paths or Nifti1Images
+        :param neuro_element: NeuroElement, has to return one feature vector per subject
+        :param subject_ids: list, ID of every subject in X, None uses the file paths
+        :return: list, IDs of the extracted subjects
+        """
+        self.invalidate(neuro_element)
+        indices, subject_ids, hashes = self.diff(X, subject_ids)
+        if indices:
+            X_new = [X[i] for i in indices]
+            neuro_element.fit(X_new)
+            features, _, _ = neuro_element.transform(X_new)
+            # one row per subject, also for a single subject whose ROI features may come as (n_rois, 1, 1)
+            features = np.asarray(features).reshape(len(X_new), -1)
+            self.add([subject_ids[i] for i in indices], [hashes[i] for i in indices], features,
+                     layout=FeatureStore.describe(neuro_element, features.shape[1]))
+        return [subject_ids[i] for i in indices]
+
+    def read(self, rois: list = None, subject_ids: list = None):
+        """
+        Read the columns of some ROIs for some subjects. Only the chunks holding these ROIs are accessed.
+        :param rois: list, ROI labels or indices, None reads all columns
+        :param subject_ids: list, rows to read in this order, None reads all subjects
+        :return: np.ndarray, (n_subjects, n_columns) with the columns of the ROIs in the given order
+        """
+        subject_ids = self.subject_ids if subject_ids is None else list(subject_ids)
+        missing = [subject_id for subject_id in subject_ids if subject_id not in self.meta['subjects']]
+        if missing:
+            msg = "FeatureStore: subjects {} are not in the store.".format(str(missing[:10]))
+            logger.error(msg)
+            raise KeyError(msg)
+        column_ranges = self.roi_columns(rois)
+        n_columns = sum(stop - start for start, stop in column_ranges)
+
+        rows_by_block = dict()
+        for i, subject_id in enumerate(subject_ids):
+            _, block, row = self.meta['subjects'][subject_id]
+            rows_by_block.setdefault(block, ([], []))
+            rows_by_block[block][0].append(i)
+            rows_by_block[block][1].append(row)
+
+        features = None
+        for block, (positions, rows) in rows_by_block.items():
+            position = 0
+            for start, stop in column_ranges:
+                for chunk, chunk_start, chunk_stop in self._chunks(start, stop):
+                    data = self._read_chunk(block, chunk)
+                    if features is None:
+                        features = np.empty((len(subject_ids), n_columns), dtype=data.dtype)
+                    width = chunk_stop - chunk_start
+                    offset = self.meta['chunk_offsets'][chunk]
+                    features[positions, position:position + width] = \
+                        data[rows, chunk_start - offset:chunk_stop - offset]
+                    position += width
+        if features is None:
+            features = np.empty((len(subject_ids), n_columns), dtype=np.float32)
+        return features
+
+    def load(self, subject_ids: list = None):
+        """
+        Merged feature matrix of all columns.
+        :param subject_ids: list, rows to load in this order, None loads all subjects
+        :return: np.ndarray, (n_subjects, n_features)
+        """
+        return self.read(subject_ids=subject_ids)
+
+    def roi_columns(self, rois: list = None):
+        """
+        :param rois: list, ROI labels or indices, None returns a single range over all columns
+        :return: list of (start, stop) column ranges
+        """
+        if rois is None:
+            return [(0, self.meta['n_features'] or 0)]
+        roi_offsets = self._roi_offsets()
+        labels = self.roi_labels
+        column_ranges = list()
+        for roi in rois:
+            if roi in labels:
+                roi_index = labels.index(roi)
+            elif isinstance(roi, (int, np.integer)) and 0 <= roi < len(roi_offsets) - 1:
+                roi_index = int(roi)
+            else:
+                msg = "FeatureStore: ROI {} is not in the store.".format(roi)
+                logger.error(msg)
+                raise KeyError(msg)
+            column_ranges.append((int(roi_offsets[roi_index]), int(roi_offsets[roi_index + 1])))
+        return column_ranges
+
+    def _roi_offsets(self):
+        if self.meta['layout'] and self.meta['layout'].get('roi_offsets') is not None:
+            return self.meta['layout']['roi_offsets']
+        return [0, self.meta['n_features'] or 0]
+
+    def _group_chunks(self, roi_offsets: list):
+        """
+        Chunk borders at ROI borders, grouping consecutive ROIs until a chunk has min_chunk_columns.
+        """
+        chunk_offsets = [int(roi_offsets[0])]
+        for offset in roi_offsets[1:]:
+            if offset - chunk_offsets[-1] >= self.min_chunk_columns or offset == roi_offsets[-1]:
+                chunk_offsets.append(int(offset))
+        return chunk_offsets
+
+    def _chunks(self, start: int, stop: int):
+        """
+        :return: list of (chunk index, start, stop) of the chunks covering the columns start:stop
+        """
+        chunk_offsets = self.meta['chunk_offsets']
+        first = int(np.searchsorted(chunk_offsets, start, side='right')) - 1
+        chunks = list()
+        for chunk in range(max(first, 0), len(chunk_offsets) - 1):
+            if chunk_offsets[chunk] >= stop:
+                break
+            chunks.append((chunk, max(start, chunk_offsets[chunk]), min(stop, chunk_offsets[chunk + 1])))
+        return chunks
+
+    def _write_block(self, features):
+        block_numbers = [int(b.split('_')[1]) for b in self.meta['blocks']]
+        block = 'block_{:06d}'.format(max(block_numbers + [-1]) + 1)
+        block_folder = os.path.join(self.folder, block)
+        shutil.rmtree(block_folder, ignore_errors=True)
+        os.makedirs(block_folder)
+        chunk_offsets = self.meta['chunk_offsets']
+        for chunk in range(len(chunk_offsets) - 1):
+            data = np.ascontiguousarray(features[:, chunk_offsets[chunk]:chunk_offsets[chunk + 1]])
+            if self.compress:
+                np.savez_compressed(os.path.join(block_folder, 'chunk_{:05d}.npz'.format(chunk)), data=data)
+            else:
+                np.save(os.path.join(block_folder, 'chunk_{:05d}.npy'.format(chunk)), data)
+        self.meta['blocks'][block] = int(features.shape[0])
+        return block
+
+    def _read_chunk(self, block: str, chunk: int):
+        file = os.path.join(self.folder, block, 'chunk_{:05d}'.format(chunk))
+        if os.path.isfile(file + '.npy'):
+            return np.load(file + '.npy', mmap_mode='r')
+        with np.load(file + '.npz') as data:
+            return data['data']
+
+    def compact(self):
+        """
+        Rewrite all live rows into a single block, dropping the rows of replaced subjects.
+        """
+        if len(self.meta['blocks']) <= 1 and len(self) == sum(self.meta['blocks'].values()):
+            return
+        old_blocks = list(self.meta['blocks'].keys())
+        subject_ids = self.subject_ids
+        features = self.load(subject_ids)
+        block = self._write_block(features)
+        self.meta['blocks'] = {block: len(subject_ids)}
+        for row, subject_id in enumerate(subject_ids):
+            self.meta['subjects'][subject_id][1:] = [block, row]
+        dump_json(self.meta, os.path.join(self.folder, self.META_FILE))
+        for old_block in old_blocks:
+            shutil.rmtree(os.path.join(self.folder, old_block))
+
+    def invalidate(self, neuro_element: Union[NeuroBranch, PipelineElement]):
+        """
+        Drop all subjects if the features in the store were extracted by elements with other parameters,
+        e.g. another atlas, other ROIs, another smoothing kernel or voxel size.
+        :param neuro_element: NeuroElement
+        :return: bool, True if the subjects were dropped
+        """
+        if self.meta['layout'] is None \
+                or self.meta['layout'].get('params') == FeatureStore.element_params(neuro_element):
+            return False
+        logger.info("FeatureStore: the parameters of the neuro element changed, dropping {} subjects".format(
+            len(self)))
+        self.clear()
+        return True
+
+    def clear(self):
+        """
+        Remove all subjects and their features.
+        """
+        old_blocks = list(self.meta['blocks'].keys())
+        self.meta = FeatureStore._empty_meta()
+        # the meta file is written first, it defines the content of the store
+        dump_json(self.meta, os.path.join(self.folder, self.META_FILE))
+        for old_block in old_blocks:
+            shutil.rmtree(os.path.join(self.folder, old_block), ignore_errors=True)
+        statistics_file = os.path.join(self.folder, self.STATISTICS_FILE)
+        if os.path.isfile(statistics_file):
+            os.remove(statistics_file)
+
+    def statistics(self):
+        """
+        Mean and variance of every feature over all subjects in the store.
+        :return: dict with n, mean and var
+        """
+        n, mean, m2 = self._read_statistics(self.meta['n_features'] or 0)
+        return {'n': int(n[0]) if len(n) else 0, 'mean': mean, 'var': m2 / np.maximum(n, 1)}
+
+    def roi_statistics(self):
+        """
+        Statistics aggregated per ROI.
+        :return: pd.DataFrame with the mean signal and the mean voxel variance of every ROI
+        """
+        statistics = self.statistics()
+        offsets = np.asarray(self._roi_offsets())
+        sizes = np.maximum(np.diff(offsets), 1)
+        # sums over the columns of every ROI
+        mean = np.add.reduceat(statistics['mean'], offsets[:-1]) / sizes if len(statistics['mean']) else []
+        var = np.add.reduceat(statistics['var'], offsets[:-1]) / sizes if len(statistics['var']) else []
+        return pd.DataFrame({'mean': mean, 'voxel_var': var}, index=self.roi_labels)
+
+    def _read_statistics(self, n_features: int):
+        statistics_file = os.path.join(self.folder, self.STATISTICS_FILE)
+        if os.path.isfile(statistics_file) and self.meta['blocks']:
+            return np.load(statistics_file)
+        return np.zeros((3, n_features))
+
+    @staticmethod
+    def describe(neuro_element: Union[NeuroBranch, PipelineElement], n_features: int):
+        """
+        Layout of the features produced by a neuro element after transform.
+        :param neuro_element: NeuroElement
+        :param n_features: int, number of extracted features
+        :return: dict with roi_labels, roi_offsets, affine, shape and params
+        """
+        elements = FeatureStore._elements(neuro_element)
+        layout = {'roi_labels': None, 'roi_offsets': [0, int(n_features)], 'affine': None, 'shape': None,
+                  'params': FeatureStore.element_params(neuro_element)}
+
+        base_element = elements[-1].base_element if elements else None
+        if isinstance(base_element, BrainAtlas) and base_element.roi_offsets is not None:
+            roi_offsets = np.asarray(base_element.roi_offsets)
+            if base_element.extract_mode == 'mean':
+                roi_offsets = np.arange(len(roi_offsets))
+            if roi_offsets[-1] == n_features:
+                layout['roi_labels'] = list(base_element.roi_allocation.keys())
+                layout['roi_offsets'] = [int(o) for o in roi_offsets]
+        elif isinstance(base_element, MultiAtlas) and base_element.roi_offsets is not None \
+                and base_element.roi_offsets[-1] == n_features:
+            layout['roi_labels'] = list(base_element.roi_labels)
+            layout['roi_offsets'] = [int(o) for o in base_element.roi_offsets]
+        elif isinstance(base_element, BrainMask) and not isinstance(base_element.mask_image, str):
+            layout['roi_labels'] = [base_element.mask_image.label]
+        if base_element is not None and getattr(base_element, 'affine', None) is not None:
+            layout['affine'] = np.asarray(base_element.affine).tolist()
+            layout['shape'] = [int(i) for i in base_element.shape]
+        return layout
+
+    @staticmethod
+    def element_params(neuro_element: Union[NeuroBranch, PipelineElement]):
+        """
+        Parameters of all elements of a neuro element, the key of the features in the store.
+        :param neuro_element: NeuroElement
+        :return: dict {element name: {parameter: json serializable value}}
+        """
+        return {element.name: {key: FeatureStore._json_param(value)
+                               for key, value in element.base_element.get_params().items()}
+                for element in FeatureStore._elements(neuro_element)}
+
+    @staticmethod
+    def _elements(neuro_element):
+        elements = neuro_element.elements if isinstance(neuro_element, NeuroBranch) else [neuro_element]
+        return [element for element in elements if hasattr(element, 'base_element')]
+
+    @staticmethod
+    def _json_param(value):
+        if isinstance(value, (int, float, str, bool, type(None))):
+            return value
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return [FeatureStore._json_param(v) for v in value]
+        if isinstance(value, np.generic):
+            return value.item()
+        # e.g. the RoiObject or MaskObject replacing the mask name after transform
+        return getattr(value, 'label', getattr(value, 'name', type(value).__name__))
+
+    @staticmethod
+    def _add_rows(statistics, rows):
+        """
+        Merge the count, mean and sum of squared deviations of rows into statistics (Chan et al.).
+        """
+        n_a, mean_a, m2_a = statistics
+        rows = np.asarray(rows, dtype=np.float64)
+        n_b = rows.shape[0]
+        mean_b = rows.mean(axis=0)
+        m2_b = ((rows - mean_b) ** 2).sum(axis=0)
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        mean = mean_a + delta * n_b / n
+        m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+        return np.stack([n, mean, m2])
+
+    @staticmethod
+    def _remove_rows(statistics, rows):
+        """
+        Inverse of _add_rows: remove rows that have been merged into statistics before.
+        """
+        n, mean, m2 = statistics
+        rows = np.asarray(rows, dtype=np.float64)
+        n_b = rows.shape[0]
+        n_a = n - n_b
+        if np.all(n_a == 0):
+            return np.zeros_like(statistics)
+        mean_b = rows.mean(axis=0)
+        m2_b = ((rows - mean_b) ** 2).sum(axis=0)
+        mean_a = (n * mean - n_b * mean_b) / n_a
+        delta = mean_b - mean_a
+        m2_a = np.maximum(m2 - m2_b - delta ** 2 * n_a * n_b / n, 0)
+        return np.stack([n_a, mean_a, m2_a])
+
+    @staticmethod
+    def _save_array(data, file: str):
+        tmp_file = file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp_file, file)
+
+    @staticmethod
+    def _subject_ids(X, subject_ids: list = None):
+        if subject_ids is not None:
+            if len(subject_ids) != len(X):
+                msg = "FeatureStore expected one subject ID per subject."
+                logger.error(msg)
+                raise ValueError(msg)
+            return [str(subject_id) for subject_id in subject_ids]
+        if not all(isinstance(x, str) for x in X):
+            msg = "FeatureStore needs subject_ids if X is not a list of file paths."
+            logger.error(msg)
+            raise ValueError(msg)
+        return [str(x) for x in X]
+
+    @staticmethod
+    def content_hash(x):
+        """
+        Hash of the content of a file or Nifti1Image.
+        """
+        sha = hashlib.sha1()
+        if isinstance(x, str):
+            with open(x, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+        elif isinstance(x, Nifti1Image):
+            sha.update(np.ascontiguousarray(np.asanyarray(x.dataobj)).tobytes())
+            sha.update(np.asarray(x.affine).tobytes())
+        else:
+            sha.update(np.ascontiguousarray(np.asarray(x)).tobytes())
+        return sha.hexdigest()
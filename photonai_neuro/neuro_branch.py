@@ -1,13 +1,28 @@
 import os
 
+import nibabel as nib
 import numpy as np
 from nibabel.nifti1 import Nifti1Image
 
 from photonai.base import ParallelBranch, CallbackElement, PhotonRegistry
 from photonai.photonlogger.logger import logger
 
-from photonai_neuro.brain_atlas import BrainAtlas
-from photonai_neuro.nifti_transformations import NeuroTransformerMixin
+from photonai_neuro.brain_atlas import AtlasLibrary, BrainAtlas, BrainMask, MultiAtlas
+from photonai_neuro.nifti_transformations import NeuroTransformerMixin, ResampleImages, SmoothImages
+
+
+class _RegisteredNeuroElements:
+    """
+    Registry info of the neuro elements, looked up on first use instead of at class definition.
+    """
+
+    def __init__(self):
+        self.elements = None
+
+    def __get__(self, instance, owner):
+        if self.elements is None:
+            self.elements = PhotonRegistry().get_package_info(['photonai_neuro'])
+        return self.elements
 
 
 class NeuroBranch(ParallelBranch, NeuroTransformerMixin):
@@ -20,13 +35,28 @@ class NeuroBranch(ParallelBranch, NeuroTransformerMixin):
     ----------
     * `name` [str]:
         Name of the NeuroModule pipeline branch
+    * `crop_to_mask` [bool] - [default: False]:
+        If the branch ends with a BrainMask, BrainAtlas or MultiAtlas preceded only by SmoothImages and
+        ResampleImages, the images are cropped to the bounding box of the selected voxels (plus the margins
+        of the smoothing kernels and the interpolation) before the first element. The extracted features are
+        the same, only the field of view of the images in between shrinks.
+        Not applied with several processes, a cache folder or interpolation='continuous'.
+    * `crop_margin` [float] - [default: 0.]:
+        Additional margin of the bounding box in mm.
 
     """
-    NEURO_ELEMENTS = PhotonRegistry().get_package_info(['photonai_neuro'])
+    NEURO_ELEMENTS = _RegisteredNeuroElements()
+    CROP_EXTRACT_MODES = ['vec', 'mean', 'box']
+    # voxels an interpolation reaches beyond the target voxel
+    INTERPOLATION_MARGINS = {'nearest': 1, 'linear': 1}
 
-    def __init__(self, name, nr_of_processes=1, output_img: bool = False):
+    def __init__(self, name, nr_of_processes=1, output_img: bool = False, crop_to_mask: bool = False,
+                 crop_margin: float = 0.):
         ParallelBranch.__init__(self, name, nr_of_processes=nr_of_processes)
         NeuroTransformerMixin.__init__(self, output_img=output_img)
+        self.crop_to_mask = crop_to_mask
+        self.crop_margin = crop_margin
+        self._crop_plans = dict()
 
     def __iadd__(self, pipe_element):
         """
@@ -77,9 +107,169 @@ class NeuroBranch(ParallelBranch, NeuroTransformerMixin):
             new_filename = os.path.join(save_to_folder, filename + str(i) + "_transformed.nii")
             new_pic.to_filename(new_filename)
 
+    def copy_me(self):
+        new_copy = super(NeuroBranch, self).copy_me()
+        new_copy.crop_to_mask = self.crop_to_mask
+        new_copy.crop_margin = self.crop_margin
+        return new_copy
+
+    def _crop_selection(self):
+        # the voxel selecting element has to end the branch, everything before it has to be smoothing or resampling
+        elements = [getattr(p_element, 'base_element', None) for p_element in self.elements]
+        if not elements or not isinstance(elements[-1], (BrainMask, BrainAtlas, MultiAtlas)):
+            return None
+        if not all(isinstance(element, (SmoothImages, ResampleImages)) and element.target_mask is None
+                   for element in elements[:-1]):
+            return None
+        # the spline prefilter of 'continuous' reaches the whole image, a section would change the result
+        if any(isinstance(element, ResampleImages) and element.interpolation not in NeuroBranch.INTERPOLATION_MARGINS
+               for element in elements[:-1]):
+            return None
+        selection = elements[-1]
+        if isinstance(selection, BrainMask) and (selection.extract_mode not in NeuroBranch.CROP_EXTRACT_MODES
+                                                 or selection.affine is not None or selection.shape is not None):
+            return None
+        if isinstance(selection, BrainAtlas) and selection.extract_mode not in NeuroBranch.CROP_EXTRACT_MODES:
+            return None
+        return elements
+
+    @staticmethod
+    def _selected_voxels(selection, affine, shape):
+        """
+        Voxel indices selected by a BrainMask, BrainAtlas or MultiAtlas on a grid.
+        :return: np.ndarray of flat indices
+        """
+        if isinstance(selection, BrainMask):
+            mask_name = selection.mask_image if isinstance(selection.mask_image, str) else selection.mask_image.name
+            mask_object = AtlasLibrary().get_mask(mask_name, affine, shape, selection.mask_threshold)
+            return np.flatnonzero(np.asarray(mask_object.mask.dataobj))
+
+        if isinstance(selection, BrainAtlas):
+            specs = [{'atlas_name': selection.atlas_name, 'rois': selection.rois,
+                      'mask_threshold': selection.mask_threshold}]
+        else:
+            specs = selection._atlas_specs()
+        voxels = list()
+        for spec in specs:
+            atlas_obj = AtlasLibrary().get_atlas(spec['atlas_name'], affine, shape, spec['mask_threshold'])
+            voxels += [roi.voxel_indices for roi in BrainAtlas._get_rois(atlas_obj, which_rois=spec['rois'],
+                                                                         background_id=selection.background_id)]
+        return np.concatenate(voxels) if voxels else np.array([], dtype=int)
+
+    @staticmethod
+    def _crop_atlases(selection, grid: tuple, window: tuple):
+        """
+        Add the atlases of the selection on its window of the grid to the library. The ROIs are looked up
+        on the full grid, the selection finds them when it transforms the cropped images.
+        :param grid: (affine, shape) of the full grid of the selection
+        """
+        if isinstance(selection, BrainMask):
+            return
+        specs = [{'atlas_name': selection.atlas_name, 'mask_threshold': selection.mask_threshold}] \
+            if isinstance(selection, BrainAtlas) else selection._atlas_specs()
+        for spec in specs:
+            AtlasLibrary().crop_atlas(spec['atlas_name'], grid[0], grid[1], window, spec['mask_threshold'])
+
+    def _crop_plan(self, elements, affine, shape):
+        """
+        Bounding box of the input grid, sections of the resampling targets and the window of the selection's
+        grid for one input grid.
+        :return: (slices, {position: (target_affine, target_shape)}, (selection grid, window)) or None if nothing
+                 can be cropped
+        """
+        # grids in front of every element, the last one is the grid of the selection
+        grids = [(np.asarray(affine), tuple(shape))]
+        for element in elements[:-1]:
+            if isinstance(element, ResampleImages):
+                grids.append(element.target_grid(*grids[-1]))
+            else:
+                grids.append(grids[-1])
+
+        selected = NeuroBranch._selected_voxels(elements[-1], *grids[-1])
+        if selected.size == 0:
+            return None
+        voxels = np.unravel_index(selected, grids[-1][1])
+        margin = np.ceil(self.crop_margin / np.sqrt(np.sum(grids[-1][0][:3, :3] ** 2, axis=0))).astype(int)
+        lower = np.array([v.min() for v in voxels]) - margin
+        upper = np.array([v.max() for v in voxels]) + 1 + margin
+
+        # back through the chain: every element needs a larger box of its input
+        targets, window = dict(), None
+        for position in range(len(elements) - 2, -1, -1):
+            element = elements[position]
+            lower, upper = np.maximum(lower, 0), np.minimum(upper, grids[position + 1][1])
+            if window is None and isinstance(element, ResampleImages):
+                # the last resampling defines the part of the selection's grid the selection gets
+                window = tuple(slice(int(l), int(u)) for l, u in zip(lower, upper))
+            if isinstance(element, SmoothImages):
+                radius = element.kernel_radius(grids[position][0])
+                lower, upper = lower - radius, upper + radius
+            else:
+                target_affine = grids[position + 1][0].copy()
+                target_affine[:3, 3] = target_affine[:3, :3] @ lower + target_affine[:3, 3]
+                targets[position] = (target_affine, tuple(int(u - l) for l, u in zip(lower, upper)))
+                # corners of the box in the voxels of the input grid
+                corners = np.array([[l, u] for l, u in zip(lower - 0.5, upper - 0.5)])
+                corners = np.array(np.meshgrid(*corners, indexing='ij')).reshape(3, -1)
+                world = grids[position + 1][0][:3, :3] @ corners + grids[position + 1][0][:3, 3:]
+                inverse = np.linalg.inv(grids[position][0])
+                corners = inverse[:3, :3] @ world + inverse[:3, 3:]
+                interpolation_margin = NeuroBranch.INTERPOLATION_MARGINS[element.interpolation]
+                lower = np.floor(corners.min(axis=1)).astype(int) - interpolation_margin
+                upper = np.ceil(corners.max(axis=1)).astype(int) + 1 + interpolation_margin
+
+        lower, upper = np.maximum(lower, 0), np.minimum(upper, grids[0][1])
+        slices = tuple(slice(int(l), int(u)) for l, u in zip(lower, upper))
+        return slices, targets, (grids[-1], slices if window is None else window)
+
+    def _crop(self, X):
+        """
+        Crop the input images to the bounding box of the voxels the branch selects.
+        The resampling elements get the sections of their target grids, transform has to reset them.
+        :return: (cropped X, resampling elements with a crop grid), X itself if the branch cannot be cropped
+        """
+        if self.nr_of_processes > 1 or getattr(self.base_element, 'cache_folder', None) is not None:
+            logger.debug("NeuroBranch {}: no cropping with several processes or a cache folder.".format(self.name))
+            return X, []
+        elements = self._crop_selection()
+        if elements is None:
+            logger.debug("NeuroBranch {}: the elements do not allow cropping to the mask.".format(self.name))
+            return X, []
+
+        affine, shape = BrainMask.get_format_info_from_first_image(X)
+        grid_key = AtlasLibrary.grid_key(affine, shape)
+        if grid_key not in self._crop_plans:
+            self._crop_plans[grid_key] = self._crop_plan(elements, affine, shape)
+        plan = self._crop_plans[grid_key]
+        if plan is None:
+            return X, []
+
+        slices, targets, (selection_grid, window) = plan
+        NeuroBranch._crop_atlases(elements[-1], selection_grid, window)
+        cropped_elements = list()
+        for position, crop_grid in targets.items():
+            elements[position]._crop_grid = crop_grid
+            cropped_elements.append(elements[position])
+
+        def crop_img(img):
+            img = nib.load(img) if isinstance(img, str) else img
+            return img.slicer[slices]
+
+        if isinstance(X, (str, Nifti1Image)):
+            return crop_img(X), cropped_elements
+        return [crop_img(img) for img in X], cropped_elements
+
     def transform(self, X, y=None, **kwargs):
 
-        X_new, y, kwargs = super(NeuroBranch, self).transform(X, y, **kwargs)
+        cropped_elements = list()
+        if self.crop_to_mask:
+            X, cropped_elements = self._crop(X)
+        try:
+            X_new, y, kwargs = super(NeuroBranch, self).transform(X, y, **kwargs)
+        finally:
+            # the crop grids hold for this transform only, the elements keep their full grids
+            for element in cropped_elements:
+                element._crop_grid = None
 
         # check if we have a list of niftis, should avoid this, except when output_image = True
         if not self.output_img:
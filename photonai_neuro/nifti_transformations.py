@@ -2,6 +2,8 @@ import numpy as np
 from typing import Union, List
 import warnings
 
+import nibabel as nib
+from scipy import ndimage
 from sklearn.base import BaseEstimator
 from nilearn.image import resample_img, smooth_img, index_img, load_img
 from nibabel.nifti1 import Nifti1Image
@@ -9,10 +11,54 @@ from skimage.util.shape import view_as_windows
 
 from photonai.photonlogger.logger import logger
 
-from photonai_neuro.objects import NeuroTransformerMixin
+from photonai_neuro.brain_atlas import AtlasLibrary
+from photonai_neuro.objects import NeuroTransformerMixin, MaskObject
+from photonai_neuro.precision import Precision
 
 
-class SmoothImages(BaseEstimator, NeuroTransformerMixin):
+def _subject_images(X):
+    # one 3D image per subject, 4D images are split along the last axis
+    if isinstance(X, (str, Nifti1Image)):
+        X = [X]
+    images = list()
+    for img in X:
+        img = nib.load(img) if isinstance(img, str) else img
+        if len(img.shape) > 3:
+            images += [img.slicer[..., i] for i in range(img.shape[3])]
+        else:
+            images.append(img)
+    return images
+
+
+class _TargetMaskMixin:
+    """
+    In-mask voxels of the target_mask on a grid, cached per grid.
+    """
+
+    def _mask_voxels(self, affine, shape):
+        grid_key = AtlasLibrary.grid_key(affine, shape)
+        if getattr(self, '_mask_voxel_cache', None) is None:
+            self._mask_voxel_cache = dict()
+        if grid_key not in self._mask_voxel_cache:
+            mask_name = self.target_mask.name if isinstance(self.target_mask, MaskObject) else self.target_mask
+            mask_object = AtlasLibrary().get_mask(mask_name, affine, shape, self.mask_threshold)
+            if mask_object.is_empty:
+                msg = "The target_mask {} is empty.".format(mask_name)
+                logger.error(msg)
+                raise ValueError(msg)
+            self._mask_voxel_cache[grid_key] = np.nonzero(np.asarray(mask_object.mask.dataobj))
+        return self._mask_voxel_cache[grid_key]
+
+    @staticmethod
+    def _stack(features):
+        if len(set(f.size for f in features)) > 1:
+            msg = "The target_mask has a different number of voxels on the grids of the images."
+            logger.error(msg)
+            raise ValueError(msg)
+        return np.stack(features)
+
+
+class SmoothImages(BaseEstimator, NeuroTransformerMixin, _TargetMaskMixin):
     """
     PipelineElemente to perform nilearns smooth_img function.
 
@@ -30,14 +76,30 @@ class SmoothImages(BaseEstimator, NeuroTransformerMixin):
     * `output_img`: bool - [default: False]
         Indicates the output format. False -> array,  True -> object (Nifti1Image).
 
+    * `dtype`: str - [default: None]
+        Precision of the smoothing ('float32' or 'float64'). None falls back to photonai_neuro.set_precision.
+
+    * `target_mask`: Union[str, MaskObject] - [default: None]
+        Mask name (see AtlasLibrary) or mask file. If given, only the bounding box of the mask plus the kernel
+        radius is smoothed and the output is a 2D array (subjects x in-mask voxels), the same as
+        BrainMask(extract_mode='vec') applied to the smoothed images.
+
+    * `mask_threshold`: float - [default: 0.5]
+        Threshold of the target_mask.
+
     """
 
-    def __init__(self, fwhm: Union[int, List, str] = 2, output_img: bool = False):
+    def __init__(self, fwhm: Union[int, List, str] = 2, output_img: bool = False, dtype: str = None,
+                 target_mask: Union[str, MaskObject] = None, mask_threshold: float = 0.5):
 
         super(SmoothImages, self).__init__(output_img=output_img)
 
         self._fwhm = None
         self.fwhm = fwhm
+        self.dtype = dtype
+        self.target_mask = target_mask
+        self.mask_threshold = mask_threshold
+        self._mask_voxel_cache = None
 
     def fit(self, X, y=None, **kwargs):
         return self
@@ -65,7 +127,39 @@ class SmoothImages(BaseEstimator, NeuroTransformerMixin):
             logger.error(msg)
             raise ValueError(msg)
 
+    def kernel_radius(self, affine):
+        """
+        Number of voxels the smoothing reaches along every axis.
+        :param affine: affine of the images
+        :return: np.ndarray of three ints
+        """
+        if self.fwhm is None:
+            return np.zeros(3, dtype=int)
+        if self.fwhm == 'fast':
+            return np.ones(3, dtype=int)
+        voxel_size = np.sqrt(np.sum(np.asarray(affine)[:3, :3] ** 2, axis=0))
+        sigma = np.asarray(self.fwhm, dtype=float) / np.sqrt(8 * np.log(2)) / voxel_size
+        # gaussian_filter1d truncates the kernel at 4 sigma
+        return (4 * sigma + 0.5).astype(int) + 1
+
+    def _masked_transform(self, X):
+        dtype = Precision.compute_dtype(self.dtype, default='float32')
+        features = list()
+        for img in _subject_images(X):
+            voxels = self._mask_voxels(img.affine, img.shape[:3])
+            radius = self.kernel_radius(img.affine)
+            lower = np.maximum([v.min() for v in voxels] - radius, 0)
+            upper = np.minimum([v.max() + 1 for v in voxels] + radius, img.shape[:3])
+            # the box edges are either image edges or further away from the mask than the kernel reaches
+            box = Precision.cast_img(img.slicer[tuple(slice(l, u) for l, u in zip(lower, upper))], dtype)
+            smoothed = np.asarray(smooth_img(box, fwhm=self.fwhm).dataobj)
+            features.append(smoothed[tuple(v - l for v, l in zip(voxels, lower))].astype(dtype, copy=False))
+        return self._stack(features)
+
     def transform(self, X, y=None, **kwargs):
+        if self.target_mask is not None:
+            return self._masked_transform(X)
+        X = Precision.load_img(X, Precision.compute_dtype(self.dtype))
 
         if isinstance(X, list) and len(X) == 1:
             smoothed_img = smooth_img(X[0], fwhm=self.fwhm)
@@ -82,7 +176,7 @@ class SmoothImages(BaseEstimator, NeuroTransformerMixin):
         return smoothed_img
 
 
-class ResampleImages(BaseEstimator, NeuroTransformerMixin):
+class ResampleImages(BaseEstimator, NeuroTransformerMixin, _TargetMaskMixin):
     """
      Resampling voxel size based on nilearns resample_img function.
      This object creates the target_affine = np.diag(voxel_size) as 3x3 matrix.
@@ -95,12 +189,29 @@ class ResampleImages(BaseEstimator, NeuroTransformerMixin):
         Set the resample method.
     * `output_img`: bool - [default: False]
         Indicates the output format. False -> array,  True -> object (Nifti1Image).
+    * `dtype`: str - [default: None]
+        Precision of the resampling ('float32' or 'float64'). None falls back to photonai_neuro.set_precision.
+    * `target_mask`: Union[str, MaskObject] - [default: None]
+        Mask name (see AtlasLibrary) or mask file on the target grid. If given, the images are interpolated at
+        the in-mask voxels only and the output is a 2D array (subjects x in-mask voxels), the same as
+        BrainMask(extract_mode='vec') applied to the resampled images.
+    * `mask_threshold`: float - [default: 0.5]
+        Threshold of the target_mask.
 
     """
-    def __init__(self, voxel_size: Union[int, List] = 3, interpolation: str = 'nearest', output_img: bool = False):
+    INTERPOLATION_ORDERS = {'nearest': 0, 'linear': 1, 'continuous': 3}
+
+    def __init__(self, voxel_size: Union[int, List] = 3, interpolation: str = 'nearest', output_img: bool = False,
+                 dtype: str = None, target_mask: Union[str, MaskObject] = None, mask_threshold: float = 0.5):
         super(ResampleImages, self).__init__(output_img=output_img)
         self._voxel_size = None
         self.voxel_size = voxel_size
+        self.dtype = dtype
+        self.target_mask = target_mask
+        self.mask_threshold = mask_threshold
+        self._mask_voxel_cache = None
+        # (affine, shape) of a section of the target grid, set by NeuroBranch(crop_to_mask=True) for one transform
+        self._crop_grid = None
 
         if interpolation in ['continuous', 'linear', 'nearest']:
             self.interpolation = interpolation
@@ -127,15 +238,65 @@ class ResampleImages(BaseEstimator, NeuroTransformerMixin):
             logger.error(msg)
             raise ValueError(msg)
 
+    def target_grid(self, affine, shape):
+        """
+        Grid the images of a grid are resampled to.
+        :param affine: affine of the input images
+        :param shape: shape of the input images
+        :return: (target_affine, target_shape), 4x4 affine and 3D shape
+        """
+        if self._crop_grid is not None:
+            return self._crop_grid
+        # the bounding box of the input decides the grid, resampling an int8 dummy gives it exactly
+        target = resample_img(nib.Nifti1Image(np.zeros(tuple(shape)[:3], dtype=np.int8), affine),
+                              target_affine=np.diag(self.voxel_size), interpolation='nearest')
+        return target.affine, target.shape[:3]
+
+    def _masked_transform(self, X):
+        dtype = Precision.compute_dtype(self.dtype, default='float32')
+        order = ResampleImages.INTERPOLATION_ORDERS[self.interpolation]
+        features = list()
+        for img in _subject_images(X):
+            target_affine, target_shape = self.target_grid(img.affine, img.shape[:3])
+            voxels = self._mask_voxels(target_affine, target_shape)
+            # the in-mask voxels in input voxel coordinates, the same transformation resample_img applies
+            transformation = np.linalg.inv(img.affine) @ target_affine
+            coordinates = transformation[:3, :3] @ np.asarray(voxels, dtype=np.float64) + transformation[:3, 3:]
+            if order < 3:
+                # nearest and linear only read the neighbours, splines are prefiltered on the whole image
+                lower = np.maximum(np.floor(coordinates.min(axis=1)).astype(int) - 1, 0)
+                upper = np.minimum(np.ceil(coordinates.max(axis=1)).astype(int) + 2, img.shape[:3])
+                upper = np.maximum(upper, lower)
+            else:
+                lower, upper = np.zeros(3, dtype=int), np.asarray(img.shape[:3])
+            data = np.asarray(img.dataobj[tuple(slice(l, u) for l, u in zip(lower, upper))], dtype=dtype)
+            if data.size == 0:
+                # the mask lies outside of the image
+                values = np.zeros(coordinates.shape[1], dtype=dtype)
+            else:
+                values = ndimage.map_coordinates(data, coordinates - lower[:, np.newaxis], order=order,
+                                                 mode='constant', cval=0.)
+            if order == 3 and data.size:
+                values = np.clip(values, data.min(), data.max())
+            features.append(values.astype(dtype, copy=False))
+        return self._stack(features)
+
     def transform(self, X, y=None, **kwargs):
-        target_affine = np.diag(self.voxel_size)
+        if self.target_mask is not None:
+            return self._masked_transform(X)
+        target_affine, target_shape = self._crop_grid if self._crop_grid is not None \
+            else (np.diag(self.voxel_size), None)
+        X = Precision.load_img(X, Precision.compute_dtype(self.dtype))
 
         if isinstance(X, list) and len(X) == 1:
-            resampled_img = resample_img(X[0], target_affine=target_affine, interpolation=self.interpolation)
+            resampled_img = resample_img(X[0], target_affine=target_affine, target_shape=target_shape,
+                                         interpolation=self.interpolation)
         elif isinstance(X, str):
-            resampled_img = resample_img(X, target_affine=target_affine, interpolation=self.interpolation)
+            resampled_img = resample_img(X, target_affine=target_affine, target_shape=target_shape,
+                                         interpolation=self.interpolation)
         else:
-            resampled_img = resample_img(X, target_affine=target_affine, interpolation=self.interpolation)
+            resampled_img = resample_img(X, target_affine=target_affine, target_shape=target_shape,
+                                         interpolation=self.interpolation)
 
         if self.output_img:
             if len(resampled_img.shape) == 3:
@@ -2,6 +2,7 @@ import numpy as np
 
 from nilearn import image
 from nibabel.nifti1 import Nifti1Image
+from scipy.spatial import cKDTree
 
 from photonai.photonlogger.logger import logger
 
@@ -44,13 +45,29 @@ class NiftiConverter:
 
 class RoiObject:
 
-    def __init__(self, index=0, label='', size=None, mask=None):
+    def __init__(self, index=0, label='', size=None, mask=None, voxel_indices=None, atlas=None):
         self.index = index
         self.label = label
         self.size = size
-        self.mask = mask
+        self._mask = mask
+        # flat (C-order) indices of the ROI voxels in the atlas map, sorted ascending
+        self.voxel_indices = voxel_indices
+        # AtlasObject of the ROI, the mask image is built from its voxel indices on first use
+        self.atlas = atlas
         self.is_empty = False
 
+    @property
+    def mask(self):
+        if self._mask is None and self.atlas is not None and self.voxel_indices is not None:
+            mask = np.zeros(int(np.prod(self.atlas.map.shape)), dtype=np.int8)
+            mask[self.voxel_indices] = 1
+            self._mask = image.new_img_like(self.atlas.atlas, mask.reshape(self.atlas.map.shape))
+        return self._mask
+
+    @mask.setter
+    def mask(self, mask):
+        self._mask = mask
+
 
 class NeuroTransformerMixin:
 
@@ -80,8 +97,151 @@ class AtlasObject:
         self.rois_active = []
         self.rois_allocation = None
         self.map = None
+        # sparse (n_voxels, n_rois) probabilities of a probabilistic (4D) atlas
+        self.weights = None
         self.atlas = None
         self.affine = affine
         self.shape = shape
 
         self.rois_available = []
+        # lookup tables and spatial indexes, built on first use
+        self._index_size = None
+        self._positions_by_label = None
+        self._positions_by_index = None
+        self._centroids = None
+        self._centroid_tree = None
+        self._voxel_tree = None
+        self._tree_voxels = None
+
+    def _build_index(self):
+        # roi_list is filled after construction: rebuild when it changed
+        if self._index_size == len(self.roi_list):
+            return
+        self._positions_by_label, self._positions_by_index = dict(), dict()
+        for position, roi in enumerate(self.roi_list):
+            self._positions_by_label.setdefault(roi.label, []).append(position)
+            self._positions_by_index.setdefault(roi.index, []).append(position)
+        self._centroids, self._centroid_tree, self._voxel_tree, self._tree_voxels = None, None, None, None
+        self._index_size = len(self.roi_list)
+
+    def rois_by_label(self, labels: list):
+        """
+        :param labels: list of ROI labels
+        :return: list of RoiObject, in the order of roi_list
+        """
+        self._build_index()
+        positions = [p for label in set(labels) for p in self._positions_by_label.get(label, [])]
+        return [self.roi_list[p] for p in sorted(positions)]
+
+    def rois_by_index(self, indices: list):
+        """
+        :param indices: list of ROI indices
+        :return: list of RoiObject, in the order of roi_list
+        """
+        self._build_index()
+        positions = [p for index in set(indices) for p in self._positions_by_index.get(index, [])]
+        return [self.roi_list[p] for p in sorted(positions)]
+
+    def get_roi(self, label_or_index):
+        """
+        :param label_or_index: str label or int index of a ROI
+        :return: RoiObject or None
+        """
+        rois = self.rois_by_label([label_or_index]) if isinstance(label_or_index, str) \
+            else self.rois_by_index([label_or_index])
+        return rois[0] if rois else None
+
+    @property
+    def grid_affine(self):
+        return self.atlas.affine if self.atlas is not None else np.asarray(self.affine)
+
+    def world_to_voxel(self, coordinates):
+        """
+        :param coordinates: array-like, (n, 3) world (e.g. MNI) coordinates in mm
+        :return: np.ndarray, (n, 3) continuous voxel coordinates
+        """
+        coordinates = np.atleast_2d(np.asarray(coordinates, dtype=np.float64))
+        inverse_affine = np.linalg.inv(self.grid_affine)
+        return coordinates @ inverse_affine[:3, :3].T + inverse_affine[:3, 3]
+
+    def voxel_to_world(self, voxels):
+        """
+        :param voxels: array-like, (n, 3) voxel coordinates
+        :return: np.ndarray, (n, 3) world coordinates in mm
+        """
+        voxels = np.atleast_2d(np.asarray(voxels, dtype=np.float64))
+        affine = self.grid_affine
+        return voxels @ affine[:3, :3].T + affine[:3, 3]
+
+    def indices_at(self, coordinates):
+        """
+        ROI indices at world coordinates, vectorised over all coordinates.
+        :param coordinates: array-like, (n, 3) world coordinates in mm
+        :return: np.ndarray, (n,) ROI index of every coordinate, 0 outside of the atlas grid
+        """
+        voxels = np.rint(self.world_to_voxel(coordinates)).astype(int)
+        inside = np.all((voxels >= 0) & (voxels < np.asarray(self.map.shape[:3])), axis=1)
+        indices = np.zeros(voxels.shape[0], dtype=np.asarray(self.map).dtype)
+        indices[inside] = self.map[tuple(voxels[inside].T)]
+        return indices
+
+    def labels_at(self, coordinates, background_id=0):
+        """
+        ROI labels at world coordinates.
+        :param coordinates: array-like, (n, 3) world coordinates in mm
+        :param background_id: index of the background
+        :return: list, ROI label of every coordinate, None for background and outside of the atlas grid
+        """
+        self._build_index()
+        return [None if index == background_id or index not in self._positions_by_index
+                else self.roi_list[self._positions_by_index[index][0]].label
+                for index in self.indices_at(coordinates).tolist()]
+
+    @property
+    def centroids(self):
+        """
+        :return: np.ndarray, (n_rois, 3) world coordinates of the ROI centroids in the order of roi_list
+        """
+        self._build_index()
+        if self._centroids is None:
+            sizes = np.array([roi.voxel_indices.size for roi in self.roi_list])
+            voxel_indices = np.concatenate([roi.voxel_indices for roi in self.roi_list])
+            voxels = np.column_stack(np.unravel_index(voxel_indices, self.map.shape[:3])).astype(np.float64)
+            starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(int)
+            sums = np.add.reduceat(voxels, starts, axis=0) if voxels.size else np.zeros((len(sizes), 3))
+            centroids = sums / np.maximum(sizes, 1)[:, np.newaxis]
+            centroids[sizes == 0] = np.nan
+            self._centroids = self.voxel_to_world(centroids)
+        return self._centroids
+
+    def nearest_rois(self, coordinates, k: int = 1, by: str = 'voxel', background_id=0):
+        """
+        Nearest ROIs of world coordinates, vectorised over all coordinates.
+        :param coordinates: array-like, (n, 3) world coordinates in mm
+        :param k: int, number of ROIs per coordinate (by='centroid' only)
+        :param by: str, 'voxel': ROI of the nearest ROI voxel, 'centroid': ROIs of the nearest centroids
+        :param background_id: index of the background, excluded from the search
+        :return: (distances, positions) in mm and positions in roi_list, (n,) for 'voxel', (n, k) for 'centroid'
+        """
+        self._build_index()
+        coordinates = np.atleast_2d(np.asarray(coordinates, dtype=np.float64))
+        if by == 'centroid':
+            if self._centroid_tree is None:
+                valid = np.flatnonzero(np.all(np.isfinite(self.centroids), axis=1) &
+                                       np.array([roi.index != background_id for roi in self.roi_list]))
+                self._centroid_tree = (cKDTree(self.centroids[valid]), valid)
+            tree, valid = self._centroid_tree
+            distances, nearest = tree.query(coordinates, k=k)
+            return distances, valid[nearest]
+        if by != 'voxel':
+            msg = "nearest_rois by {} is not supported. Use 'voxel' or 'centroid'.".format(by)
+            logger.error(msg)
+            raise ValueError(msg)
+        if self._voxel_tree is None:
+            rois = [(position, roi) for position, roi in enumerate(self.roi_list) if roi.index != background_id]
+            voxel_indices = np.concatenate([roi.voxel_indices for _, roi in rois])
+            self._tree_voxels = np.repeat([position for position, _ in rois], [roi.voxel_indices.size for _, roi in rois])
+            voxels = np.column_stack(np.unravel_index(voxel_indices, self.map.shape[:3]))
+            self._voxel_tree = cKDTree(self.voxel_to_world(voxels))
+        distances, nearest = self._voxel_tree.query(coordinates, k=1)
+        return distances, self._tree_voxels[nearest]
@@ -0,0 +1,182 @@
+import warnings
+
+import nibabel as nib
+import numpy as np
+from nibabel.nifti1 import Nifti1Image
+
+from photonai.photonlogger.logger import logger
+
+
+class Precision:
+    """
+    Module-wide precision policy for the neuro transformations.
+
+    Every neuro element accepts its own `dtype` and (where applicable) `storage_dtype`.
+    If they are None the module-wide defaults defined here are used.
+
+    Parameter
+    ---------
+    * `dtype`: [str] - [default: None]
+        Floating point precision the images are computed in. Possible values: ['float32', 'float64'].
+        None keeps the behaviour of nibabel/nilearn (which mostly upcasts to float64).
+    * `storage_dtype`: [str] - [default: None]
+        Precision of the extracted voxel features. Possible values: ['float64', 'float32', 'float16', 'int16'].
+        int16 stores linearly scaled values, the scale is determined on the first transform.
+        Values of later transforms beyond that scale are clipped with a warning.
+        None keeps the precision the features have been computed in.
+
+    """
+    COMPUTE_DTYPES = ['float32', 'float64']
+    STORAGE_DTYPES = ['float64', 'float32', 'float16', 'int16']
+
+    dtype = None
+    storage_dtype = None
+
+    @classmethod
+    def set(cls, dtype: str = None, storage_dtype: str = None):
+        cls.dtype = cls._check(dtype, cls.COMPUTE_DTYPES)
+        cls.storage_dtype = cls._check(storage_dtype, cls.STORAGE_DTYPES)
+
+    @classmethod
+    def reset(cls):
+        cls.dtype = None
+        cls.storage_dtype = None
+
+    @classmethod
+    def compute_dtype(cls, dtype: str = None, default: str = None):
+        """
+        Resolve the compute precision of an element.
+        :param dtype: str, precision of the element, None falls back to the module-wide setting
+        :param default: str, used if neither the element nor the module define a precision
+        :return: str or None
+        """
+        if dtype is not None:
+            return cls._check(dtype, cls.COMPUTE_DTYPES)
+        if cls.dtype is not None:
+            return cls.dtype
+        return default
+
+    @classmethod
+    def resolve_storage_dtype(cls, storage_dtype: str = None):
+        if storage_dtype is not None:
+            return cls._check(storage_dtype, cls.STORAGE_DTYPES)
+        return cls.storage_dtype
+
+    @staticmethod
+    def _check(dtype, allowed):
+        if dtype is None:
+            return None
+        dtype = np.dtype(dtype).name
+        if dtype not in allowed:
+            msg = "Precision {} is not supported. Use one of {}.".format(dtype, str(allowed))
+            logger.error(msg)
+            raise ValueError(msg)
+        return dtype
+
+    @staticmethod
+    def cast_img(img, dtype: str = None):
+        """
+        Load the image data in the given precision, without detour over float64.
+        :param img: Nifti1Image or list of Nifti1Images
+        :param dtype: str, target precision; None returns img untouched
+        :return: Nifti1Image or list of Nifti1Images
+        """
+        if dtype is None:
+            return img
+        if isinstance(img, (list, tuple)):
+            return [Precision.cast_img(i, dtype) for i in img]
+        if img.get_data_dtype() == np.dtype(dtype) and not Precision._is_scaled(img):
+            return img
+        data = img.get_fdata(dtype=np.dtype(dtype))
+        new_img = Nifti1Image(data, img.affine, img.header)
+        new_img.set_data_dtype(np.dtype(dtype))
+        return new_img
+
+    @staticmethod
+    def load_img(X, dtype: str = None):
+        """
+        Load file paths and images of X in the given precision.
+        :param X: str, Nifti1Image or list/array of them
+        :param dtype: str, target precision; None returns X untouched
+        :return: Nifti1Image or list of Nifti1Images
+        """
+        if dtype is None:
+            return X
+        if isinstance(X, str):
+            return Precision.cast_img(nib.load(X), dtype)
+        if isinstance(X, Nifti1Image):
+            return Precision.cast_img(X, dtype)
+        if isinstance(X, (list, tuple)) or (isinstance(X, np.ndarray) and X.dtype.kind in 'UO'):
+            return [Precision.load_img(x, dtype) for x in X]
+        return X
+
+    @staticmethod
+    def _is_scaled(img):
+        slope, inter = img.header.get_slope_inter()
+        return slope not in (None, 1) or inter not in (None, 0)
+
+    @staticmethod
+    def to_storage(data, storage_dtype: str = None, scale: float = None):
+        """
+        Convert extracted features to storage precision.
+        :param data: np.ndarray, extracted features
+        :param storage_dtype: str, target precision; None returns data untouched
+        :param scale: float, int16 only: value of one integer step. Derived from data if None.
+        :return: (data, scale)
+        """
+        if storage_dtype is None or not isinstance(data, np.ndarray) or data.dtype == object:
+            return data, scale
+        if storage_dtype == 'int16':
+            if scale is None:
+                scale = Precision.int16_scale(data)
+            info = np.iinfo(np.int16)
+            data = np.rint(data / scale)
+            n_clipped = np.count_nonzero((data < info.min) | (data > info.max))
+            if n_clipped > 0:
+                msg = "{} of {} values exceed the int16 storage scale {} of the first transform and are " \
+                      "clipped. Use storage_dtype='float16' or 'float32' for data of varying range.".format(
+                          n_clipped, data.size, scale)
+                logger.warning(msg)
+                warnings.warn(msg)
+            data = np.clip(data, info.min, info.max).astype(np.int16)
+            return data, scale
+        return data.astype(storage_dtype, copy=False), scale
+
+    @staticmethod
+    def int16_scale(data):
+        """
+        Scale mapping the largest absolute value in data onto the int16 range.
+        :param data: np.ndarray
+        :return: float
+        """
+        max_abs = float(np.max(np.abs(data))) if data.size > 0 else 0.
+        return max_abs / np.iinfo(np.int16).max if max_abs > 0 else 1.
+
+    @staticmethod
+    def from_storage(data, scale: float = None, dtype: str = 'float32'):
+        """
+        Undo to_storage for inverse transformations.
+        :param data: np.ndarray, stored features
+        :param scale: float, int16 scale returned by to_storage
+        :param dtype: str, compute precision
+        :return: np.ndarray
+        """
+        data = np.asarray(data)
+        if data.dtype == np.int16 and scale is not None:
+            return data.astype(dtype) * np.asarray(scale, dtype=dtype)
+        if data.dtype == np.float16:
+            return data.astype(dtype)
+        return data
+
+
+def set_precision(dtype: str = None, storage_dtype: str = None):
+    """
+    Set the module-wide precision of all neuro elements that do not define their own.
+    :param dtype: str, compute precision ['float32', 'float64'] or None for the nilearn default
+    :param storage_dtype: str, feature precision ['float64', 'float32', 'float16', 'int16'] or None
+    """
+    Precision.set(dtype=dtype, storage_dtype=storage_dtype)
+
+
+def get_precision():
+    return Precision.dtype, Precision.storage_dtype
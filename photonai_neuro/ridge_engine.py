@@ -0,0 +1,353 @@
+import numpy as np
+from sklearn.model_selection import check_cv
+from sklearn.preprocessing import LabelBinarizer
+from sklearn.utils.multiclass import type_of_target
+
+from photonai.photonlogger.logger import logger
+from photonai.processing.metrics import Scorer
+
+
+class RidgeEngine:
+    """
+    Closed-form ridge regression/classification for many ROIs at once.
+
+    ROIs with fewer voxels than subjects are solved in the primal form on their voxels, zero padded to the
+    largest ROI of the batch (zero columns get zero coefficients). Larger ROIs are solved in their dual (kernel)
+    form on the (n_subjects x n_subjects) Gram matrix of their voxels. Either way the ROIs of a batch become a
+    stack of equally shaped matrices: all ROIs of a batch and all targets (e.g. permuted labels) are solved
+    with one batched np.linalg.solve per fold.
+    Classification follows sklearn's RidgeClassifier (ridge on {-1, 1} coded classes).
+
+    Parameter
+    ---------
+    * `alpha` [float] - [default: 1.0]:
+        Regularization strength. 0 gives the minimum norm least squares solution.
+
+    * `cv` [int or sklearn cross-validator] - [default: None]:
+        Cross-validation of the performance estimates. None uses the outer_cv of the AtlasMapper hyperpipe,
+        or 5 shuffled folds if there is none.
+
+    * `metrics` [list] - [default: None]:
+        photonai metrics to calculate. None uses the metrics of the AtlasMapper hyperpipe.
+
+    * `best_config_metric` [str] - [default: None]:
+        Metric written to the performance NIfTI. None uses the best_config_metric of the AtlasMapper hyperpipe.
+
+    * `roi_batch_size` [int] - [default: None]:
+        Number of ROIs whose matrices are held in memory at once. None derives it from memory_budget.
+
+    * `memory_budget` [float] - [default: 1024 ** 3]:
+        Bytes of the matrices of one ROI batch and their copies in the fit, if roi_batch_size is None.
+
+    * `random_state` [int] - [default: 42]:
+        Seed of the fold shuffling if cv is an int.
+
+    * `task` [str] - [default: None]:
+        'classification' or 'regression'. None uses the estimator of the AtlasMapper hyperpipe, or otherwise
+        treats float targets as regression and all other discrete targets as classification.
+
+    """
+    TASKS = ['classification', 'regression']
+
+    def __init__(self,
+                 alpha: float = 1.0,
+                 cv=None,
+                 metrics: list = None,
+                 best_config_metric: str = None,
+                 roi_batch_size: int = None,
+                 random_state: int = 42,
+                 task: str = None,
+                 memory_budget: float = 1024 ** 3):
+        if alpha < 0:
+            msg = "RidgeEngine expected alpha >= 0."
+            logger.error(msg)
+            raise ValueError(msg)
+        if task is not None and task not in RidgeEngine.TASKS:
+            msg = "RidgeEngine supports the tasks {}.".format(str(RidgeEngine.TASKS))
+            logger.error(msg)
+            raise ValueError(msg)
+        self.alpha = alpha
+        self.cv = cv
+        self.metrics = metrics
+        self.best_config_metric = best_config_metric
+        self.roi_batch_size = roi_batch_size
+        self.memory_budget = memory_budget
+        self.random_state = random_state
+        self.task = task
+
+    def fit(self, X, roi_columns: list, y):
+        """
+        Cross-validate the ridge model of every ROI.
+        :param X: np.ndarray, (n_subjects, n_voxels) ROI data
+        :param roi_columns: list, (start, stop) columns of every ROI in X
+        :param y: targets
+        :return: list of dicts {metric: mean test performance over folds}, in the order of roi_columns
+        """
+        y = np.asarray(y)
+        folds = self.get_folds(y)
+        Y, decode = self.encode_targets(y)
+
+        results = [None] * len(roi_columns)
+        for positions, primal in self.roi_batches(X.shape[0], roi_columns):
+            matrices = self.roi_matrices(X, [roi_columns[i] for i in positions], primal)
+            for position, result in zip(positions, self.score_kernels(matrices, Y, decode, y, folds, primal)):
+                results[position] = result
+        return results
+
+    def roi_batches(self, n_subjects: int, roi_columns: list):
+        """
+        Split the ROIs into batches of the primal or the dual form, each within roi_batch_size or memory_budget.
+        :param n_subjects: int
+        :param roi_columns: list, (start, stop) columns of every ROI
+        :return: list of (positions in roi_columns, primal)
+        """
+        sizes = np.array([stop - start for start, stop in roi_columns], dtype=int).reshape(-1)
+        # primal ROIs by size, then the padding of a batch is set by its last ROI
+        primal_positions = [int(i) for i in np.argsort(sizes, kind='stable') if sizes[i] < n_subjects]
+        dual_positions = [i for i in range(len(roi_columns)) if sizes[i] >= n_subjects]
+
+        batches = list()
+        for positions, primal in [(primal_positions, True), (dual_positions, False)]:
+            batch = list()
+            for position in positions:
+                # float64 matrices of one ROI, their train/test copies and the matrices of the solve
+                n_columns = sizes[position] if primal else n_subjects
+                roi_bytes = 8 * (3 * n_subjects * n_columns + 2 * n_columns ** 2)
+                full = len(batch) >= self.roi_batch_size if self.roi_batch_size is not None \
+                    else (len(batch) + 1) * roi_bytes > self.memory_budget
+                if batch and full:
+                    batches.append((batch, primal))
+                    batch = list()
+                batch.append(position)
+            if batch:
+                batches.append((batch, primal))
+        return batches
+
+    def roi_matrices(self, X, roi_columns: list, primal: bool):
+        """
+        :return: np.ndarray, padded voxels (primal) or Gram matrices (dual) of the ROIs, see fit_predict
+        """
+        return self.padded_voxels(X, roi_columns) if primal else self.gram_matrices(X, roi_columns)
+
+    def score_kernels(self, K, Y, decode, y, folds: list, primal: bool = False):
+        """
+        Cross-validate the ridge models of a stack of precomputed Gram matrices.
+        :param K: np.ndarray, (n_models, n_subjects, n_subjects) Gram matrices,
+                  or (n_models, n_subjects, n_columns) voxels if primal
+        :param Y: np.ndarray, (n_subjects, n_targets) targets coded by encode_targets
+        :param decode: function returned by encode_targets
+        :param y: targets
+        :param folds: list of (train, test) indices
+        :param primal: bool, K holds the voxels of the models
+        :return: list of dicts {metric: mean test performance over folds}, one per Gram matrix
+        """
+        fold_metrics = [list() for _ in range(K.shape[0])]
+        for train, test in folds:
+            predictions = decode(self.fit_predict(K, Y, train, test, primal))
+            for i in range(K.shape[0]):
+                fold_metrics[i].append(Scorer.calculate_metrics(y[test], predictions[i], self.metrics))
+        return [{metric: float(np.mean([m[metric] for m in model_metrics])) for metric in self.metrics}
+                for model_metrics in fold_metrics]
+
+    def permutation_scores(self, X, roi_columns: list, y, metric: str, n_permutations: int = 1000,
+                           permutation_batch_size: int = 100, random_state: int = None):
+        """
+        Scores of every ROI on the original and on permuted targets. All permutations use the folds of the
+        original targets. The permuted targets of a batch are solved as one target matrix.
+        :param X: np.ndarray, (n_subjects, n_voxels) ROI data
+        :param roi_columns: list, (start, stop) columns of every ROI in X
+        :param y: targets
+        :param metric: str, one of VECTORIZED_METRICS
+        :param n_permutations: int, number of label permutations
+        :param permutation_batch_size: int, number of permutations solved at once
+        :param random_state: int, seed of the permutations
+        :return: (scores, null_scores): (n_rois,) scores and (n_permutations, n_rois) scores on permuted targets
+        """
+        if metric not in VECTORIZED_METRICS:
+            msg = "Permutation testing supports the metrics {}.".format(str(list(VECTORIZED_METRICS.keys())))
+            logger.error(msg)
+            raise ValueError(msg)
+        y = np.asarray(y)
+        if metric == 'balanced_accuracy' and len(np.unique(y)) != 2:
+            # photonai defines the balanced accuracy for binary targets only
+            msg = "Permutation testing with balanced_accuracy needs binary targets, got {} classes.".format(
+                len(np.unique(y)))
+            logger.error(msg)
+            raise ValueError(msg)
+        folds = self.get_folds(y)
+        Y, decode = self.encode_targets(y)
+        rnd = np.random.RandomState(random_state)
+        permutations = np.array([rnd.permutation(len(y)) for _ in range(n_permutations)]).reshape(-1, len(y))
+
+        scores = np.empty(len(roi_columns))
+        null_scores = np.empty((n_permutations, len(roi_columns)))
+        for batch, primal in self.roi_batches(X.shape[0], roi_columns):
+            K = self.roi_matrices(X, [roi_columns[i] for i in batch], primal)
+            scores[batch] = self._score_permutations(K, Y, decode, y, folds, metric, np.arange(len(y))[None],
+                                                     primal)[0]
+            for permutation_start in range(0, n_permutations, permutation_batch_size):
+                permutation_batch = slice(permutation_start, permutation_start + permutation_batch_size)
+                null_scores[permutation_batch, batch] = self._score_permutations(
+                    K, Y, decode, y, folds, metric, permutations[permutation_batch], primal)
+        return scores, null_scores
+
+    def _score_permutations(self, K, Y, decode, y, folds: list, metric: str, permutations, primal: bool = False):
+        """
+        :param permutations: np.ndarray, (n_permutations, n_subjects) subject orders of the targets
+        :return: np.ndarray, (n_permutations, n_rois) mean test scores over folds
+        """
+        n_permutations, n_targets = permutations.shape[0], Y.shape[1]
+        y_permuted = y[permutations]
+        # (n_subjects, n_permutations * n_targets)
+        Y_permuted = Y[permutations].transpose(1, 0, 2).reshape(len(y), n_permutations * n_targets)
+
+        fold_scores = list()
+        for train, test in folds:
+            predictions = self.fit_predict(K, Y_permuted, train, test, primal)
+            predictions = decode(predictions.reshape(K.shape[0], len(test), n_permutations, n_targets))
+            # (n_rois, n_permutations, n_test) against (n_permutations, n_test)
+            fold_scores.append(VECTORIZED_METRICS[metric](y_permuted[:, test], predictions.transpose(0, 2, 1)))
+        return np.mean(fold_scores, axis=0).T
+
+    def get_folds(self, y):
+        cv = check_cv(self.cv if self.cv is not None else 5, y, classifier=self.is_classification(y))
+        if isinstance(self.cv, (int, type(None))) and hasattr(cv, 'shuffle'):
+            cv.shuffle = True
+            cv.random_state = self.random_state
+        return list(cv.split(np.zeros((len(y), 1)), y))
+
+    def is_classification(self, y):
+        if self.task is not None:
+            return self.task == 'classification'
+        # whole-numbered floats, e.g. ages in years, are regression targets too
+        if np.asarray(y).dtype.kind in 'fc':
+            return False
+        return type_of_target(y) in ['binary', 'multiclass']
+
+    def encode_targets(self, y):
+        """
+        Code targets as a real valued (n_subjects, n_targets) matrix.
+        :param y: targets
+        :return: (Y, decode): target matrix and function mapping (..., n_targets) predictions back to targets
+        """
+        if self.is_classification(y):
+            binarizer = LabelBinarizer(neg_label=-1, pos_label=1).fit(y)
+            classes = binarizer.classes_
+
+            def decode(predictions):
+                if predictions.shape[-1] == 1:
+                    return classes[(predictions[..., 0] > 0).astype(int)]
+                return classes[np.argmax(predictions, axis=-1)]
+            return binarizer.transform(y).astype(np.float64), decode
+
+        return np.asarray(y, dtype=np.float64).reshape(len(y), -1), lambda predictions: predictions[..., 0]
+
+    @staticmethod
+    def gram_matrices(X, roi_columns: list, dtype='float64'):
+        """
+        Linear kernel of every ROI.
+        :param X: np.ndarray, (n_subjects, n_voxels) ROI data
+        :param roi_columns: list, (start, stop) columns of every ROI in X
+        :return: np.ndarray, (n_rois, n_subjects, n_subjects)
+        """
+        n_subjects = X.shape[0]
+        K = np.empty((len(roi_columns), n_subjects, n_subjects), dtype=dtype)
+        for i, (start, stop) in enumerate(roi_columns):
+            X_roi = np.asarray(X[:, start:stop], dtype=dtype)
+            np.dot(X_roi, X_roi.T, out=K[i])
+        return K
+
+    @staticmethod
+    def padded_voxels(X, roi_columns: list, dtype='float64'):
+        """
+        Voxels of every ROI, zero padded to the largest ROI.
+        :param X: np.ndarray, (n_subjects, n_voxels) ROI data
+        :param roi_columns: list, (start, stop) columns of every ROI in X
+        :return: np.ndarray, (n_rois, n_subjects, n_columns of the largest ROI)
+        """
+        n_columns = max(1, max(stop - start for start, stop in roi_columns))
+        voxels = np.zeros((len(roi_columns), X.shape[0], n_columns), dtype=dtype)
+        for i, (start, stop) in enumerate(roi_columns):
+            voxels[i, :, :stop - start] = X[:, start:stop]
+        return voxels
+
+    def fit_predict(self, K, Y, train, test, primal: bool = False):
+        """
+        Fit ridge models with intercept on the train subjects and predict the test subjects, for all ROIs and
+        all target columns at once.
+        :param K: np.ndarray, (n_rois, n_subjects, n_subjects) Gram matrices,
+                  or (n_rois, n_subjects, n_columns) voxels if primal
+        :param Y: np.ndarray, (n_subjects, n_targets) targets
+        :param train: indices of the train subjects
+        :param test: indices of the test subjects
+        :param primal: bool, solve on the voxels in K instead of the Gram matrices
+        :return: np.ndarray, (n_rois, n_test, n_targets) predictions
+        """
+        y_mean = Y[train].mean(axis=0)
+        Y_train = Y[train] - y_mean
+        if primal:
+            return self._fit_predict_primal(K, Y_train, train, test) + y_mean
+
+        K_train = K[:, train][:, :, train]
+        K_test = K[:, test][:, :, train]
+
+        # center the kernels on the train subjects, which fits the intercept
+        train_mean = K_train.mean(axis=1)
+        total_mean = train_mean.mean(axis=1)
+        K_train = K_train - train_mean[:, None, :] - train_mean[:, :, None] + total_mean[:, None, None]
+        K_test = K_test - K_test.mean(axis=2, keepdims=True) - train_mean[:, None, :] + total_mean[:, None, None]
+
+        if self.alpha > 0:
+            diagonal = np.arange(len(train))
+            K_train[:, diagonal, diagonal] += self.alpha
+            dual_coef = np.linalg.solve(K_train, np.broadcast_to(Y_train, (K_train.shape[0],) + Y_train.shape))
+        else:
+            dual_coef = np.matmul(np.linalg.pinv(K_train, hermitian=True), Y_train)
+        return np.matmul(K_test, dual_coef) + y_mean
+
+    def _fit_predict_primal(self, voxels, Y_train, train, test):
+        """
+        Ridge on the voxels centered on the train subjects, predictions without the target mean.
+        """
+        X_train = voxels[:, train]
+        voxel_mean = X_train.mean(axis=1, keepdims=True)
+        X_train = X_train - voxel_mean
+        X_test = voxels[:, test] - voxel_mean
+
+        if self.alpha > 0:
+            X_train_t = X_train.transpose(0, 2, 1)
+            gram = np.matmul(X_train_t, X_train)
+            diagonal = np.arange(gram.shape[1])
+            gram[:, diagonal, diagonal] += self.alpha
+            coef = np.linalg.solve(gram, np.matmul(X_train_t, Y_train))
+        else:
+            # minimum norm least squares, as the dual form
+            coef = np.matmul(np.linalg.pinv(X_train), Y_train)
+        return np.matmul(X_test, coef)
+
+
+def _balanced_accuracy(y_true, y_pred):
+    # mean of sensitivity and specificity for binary targets, as photonai's balanced_accuracy
+    recall_sum, n_classes = 0., 0
+    for c in np.unique(y_true):
+        positives = y_true == c
+        n_positives = np.sum(positives, axis=-1)
+        recall_sum = recall_sum + np.sum((y_pred == c) & positives, axis=-1) / np.maximum(n_positives, 1)
+        n_classes = n_classes + (n_positives > 0)
+    return recall_sum / n_classes
+
+
+def _r2(y_true, y_pred):
+    y_true = y_true.astype(np.float64)
+    total = np.sum((y_true - y_true.mean(axis=-1, keepdims=True)) ** 2, axis=-1)
+    return 1 - np.sum((y_true - y_pred) ** 2, axis=-1) / total
+
+
+# metrics on the last axis, broadcasting over all leading axes
+VECTORIZED_METRICS = {
+    'accuracy': lambda y_true, y_pred: np.mean(y_true == y_pred, axis=-1),
+    'balanced_accuracy': _balanced_accuracy,
+    'mean_squared_error': lambda y_true, y_pred: np.mean((y_true - y_pred) ** 2, axis=-1),
+    'mean_absolute_error': lambda y_true, y_pred: np.mean(np.abs(y_true - y_pred), axis=-1),
+    'r2': _r2
+}
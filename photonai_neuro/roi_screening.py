@@ -0,0 +1,103 @@
+import math
+from typing import List
+
+import numpy as np
+from sklearn.base import clone, is_classifier
+from sklearn.linear_model import Ridge, RidgeClassifier
+from sklearn.model_selection import check_cv
+from sklearn.utils.multiclass import type_of_target
+
+from photonai.photonlogger.logger import logger
+from photonai.processing.metrics import Scorer
+
+
+class RoiScreening:
+    """
+    Successive-halving screening of atlas ROIs for the AtlasMapper.
+    All ROIs are evaluated with a cheap proxy estimator and few folds, only the best keep_fraction advances
+    to the next round with more folds. The ROIs surviving the last round are fitted with the full hyperpipe.
+
+    Parameter
+    ---------
+    * `proxy_estimator` [sklearn estimator] - [default: None]:
+        Cheap model evaluated on every ROI. None uses RidgeClassifier for classification and Ridge otherwise.
+
+    * `n_splits` [List[int]] - [default: [2, 3, 5]]:
+        Number of cross-validation folds of every screening round.
+
+    * `keep_fraction` [float] - [default: 0.25]:
+        Fraction of the ROIs advancing to the next round after every round.
+
+    * `min_rois` [int] - [default: 1]:
+        Minimal number of ROIs advancing to the next round.
+
+    * `random_state` [int] - [default: 42]:
+        Seed of the fold shuffling.
+
+    """
+
+    def __init__(self,
+                 proxy_estimator=None,
+                 n_splits: List[int] = None,
+                 keep_fraction: float = 0.25,
+                 min_rois: int = 1,
+                 random_state: int = 42):
+        if not 0 < keep_fraction <= 1:
+            msg = "RoiScreening expected keep_fraction in (0, 1]."
+            logger.error(msg)
+            raise ValueError(msg)
+        self.proxy_estimator = proxy_estimator
+        self.n_splits = n_splits if n_splits is not None else [2, 3, 5]
+        self.keep_fraction = keep_fraction
+        self.min_rois = min_rois
+        self.random_state = random_state
+
+    def screen(self, X, roi_columns: dict, y, metric: str):
+        """
+        Run all screening rounds.
+        :param X: np.ndarray, (n_subjects, n_voxels) ROI data
+        :param roi_columns: dict, (start, stop) columns of every ROI in X by ROI label
+        :param y: targets
+        :param metric: str, photonai metric to rank the ROIs by
+        :return: (survivors, proxy_results): list of ROI labels advancing to the hyperpipe and
+                 dict of {metric: proxy score, 'screening_round': last round} by ROI label
+        """
+        y = np.asarray(y)
+        greater_is_better = Scorer.greater_is_better_distinction(metric)
+        estimator = self._get_proxy_estimator(y)
+
+        candidates = list(roi_columns.keys())
+        proxy_results = dict()
+        for screening_round, n_splits in enumerate(self.n_splits):
+            cv = check_cv(n_splits, y, classifier=is_classifier(estimator))
+            if hasattr(cv, 'shuffle'):
+                cv.shuffle = True
+                cv.random_state = self.random_state
+            folds = list(cv.split(np.zeros((len(y), 1)), y))
+
+            scores = dict()
+            for roi_name in candidates:
+                start, stop = roi_columns[roi_name]
+                scores[roi_name] = self._score(estimator, X[:, start:stop], y, folds, metric)
+                proxy_results[roi_name] = {metric: scores[roi_name], 'screening_round': screening_round}
+
+            n_keep = min(len(candidates), max(self.min_rois, int(math.ceil(self.keep_fraction * len(candidates)))))
+            candidates = sorted(candidates, key=lambda r: scores[r], reverse=greater_is_better)[:n_keep]
+            logger.info("RoiScreening round {}: {} folds, {} ROIs advance".format(screening_round, n_splits,
+                                                                                 len(candidates)))
+        return candidates, proxy_results
+
+    def _get_proxy_estimator(self, y):
+        if self.proxy_estimator is not None:
+            return self.proxy_estimator
+        if type_of_target(y) in ['binary', 'multiclass']:
+            return RidgeClassifier()
+        return Ridge()
+
+    @staticmethod
+    def _score(estimator, X, y, folds: list, metric: str):
+        fold_scores = list()
+        for train, test in folds:
+            model = clone(estimator).fit(X[train], y[train])
+            fold_scores.append(Scorer.calculate_metrics(y[test], model.predict(X[test]), [metric])[metric])
+        return float(np.mean(fold_scores))
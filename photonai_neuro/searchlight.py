@@ -0,0 +1,236 @@
+import copy
+import os
+from itertools import chain
+from typing import Union
+
+import joblib
+import numpy as np
+import pandas as pd
+from nibabel.affines import apply_affine
+from scipy.spatial import cKDTree
+
+from photonai.base import PipelineElement
+from photonai.photonlogger.logger import logger
+
+from photonai_neuro.brain_atlas import BrainMask
+from photonai_neuro.neuro_branch import NeuroBranch
+from photonai_neuro.ridge_engine import RidgeEngine
+
+
+class SearchlightMapper:
+    """
+    Searchlight mapping of model performance for every voxel of a BrainMask.
+
+    The sphere of every voxel is computed once as a sparse neighbour structure (CSR: indptr, indices into the
+    masked voxels). Spheres are evaluated in batches: the Gram matrices of all spheres of a batch are computed
+    with one batched matrix product and cross-validated with the closed-form RidgeEngine.
+    The performance of every sphere is written to its center voxel.
+
+    Parameter
+    ---------
+    * `neuro_element` [Union[NeuroBranch, PipelineElement]]:
+        Neuro processing ending in a BrainMask with extract_mode='vec'. The BrainMask defines the voxel domain.
+
+    * `engine` [RidgeEngine]:
+        Model evaluated on every sphere. metrics and best_config_metric have to be defined.
+
+    * `radius` [float] - [default: 6.]:
+        Sphere radius in mm.
+
+    * `folder` [str] - [default: "./tmp/"]:
+        Output path for the performance maps.
+
+    * `sphere_batch_size` [int] - [default: 256]:
+        Number of spheres evaluated at once.
+
+    * `n_jobs` [int] - [default: 1]:
+        Number of processes evaluating sphere batches concurrently. -1 uses all cores.
+
+    """
+
+    def __init__(self,
+                 neuro_element: Union[NeuroBranch, PipelineElement],
+                 engine: RidgeEngine,
+                 radius: float = 6.,
+                 folder: str = "./tmp/",
+                 sphere_batch_size: int = 256,
+                 n_jobs: int = 1):
+
+        if not engine.metrics or engine.best_config_metric is None:
+            msg = "SearchlightMapper needs a RidgeEngine with metrics and best_config_metric."
+            logger.error(msg)
+            raise ValueError(msg)
+
+        self.folder = folder
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+        self.neuro_element = neuro_element
+        self.brain_mask = self._find_brain_mask(self.neuro_element)
+        self.engine = copy.copy(engine)
+        if self.engine.best_config_metric not in self.engine.metrics:
+            self.engine.metrics = list(self.engine.metrics) + [self.engine.best_config_metric]
+        self.radius = radius
+        self.sphere_batch_size = sphere_batch_size
+        self.n_jobs = n_jobs
+
+        self.neighbours = None
+        self.results = None
+
+    def fit(self, X, y):
+        """
+        Transform data on NeuroElement and evaluate the model of every sphere.
+        Writes searchlight_results.csv and searchlight_performances.nii.gz (best_config_metric) to the folder.
+        :param X: input data
+        :param y: targets
+        :return: self
+        """
+        self.neuro_element.fit(X)
+        X_masked = self._extract(X)
+
+        mask_img = self.brain_mask.masker.mask_img_
+        self.neighbours = self.sphere_neighbours(mask_img, self.radius)
+        n_voxels = len(self.neighbours[0]) - 1
+        if X_masked.shape[1] != n_voxels:
+            msg = "SearchlightMapper: {} masked voxels in the data but {} in the mask.".format(X_masked.shape[1],
+                                                                                            n_voxels)
+            logger.error(msg)
+            raise ValueError(msg)
+        logger.info("SearchlightMapper: {} spheres, {:.1f} voxels per sphere on average".format(
+            n_voxels, len(self.neighbours[1]) / max(n_voxels, 1)))
+
+        y = np.asarray(y)
+        folds = self.engine.get_folds(y)
+        batches = [(start, min(start + self.sphere_batch_size, n_voxels))
+                   for start in range(0, n_voxels, self.sphere_batch_size)]
+
+        if self.n_jobs == 1:
+            results = [_score_spheres(self.engine, X_masked, self.neighbours, batch, y, folds) for batch in batches]
+        else:
+            # the workers memory map data and neighbours instead of receiving pickled copies
+            files = [os.path.join(self.folder, f) for f in ['searchlight_data.npy', 'searchlight_indptr.npy',
+                                                            'searchlight_indices.npy']]
+            for file, data in zip(files, [X_masked, self.neighbours[0], self.neighbours[1]]):
+                np.save(file, data)
+            n_jobs = joblib.cpu_count() if self.n_jobs == -1 else self.n_jobs
+            with joblib.parallel_backend('loky', inner_max_num_threads=1):
+                results = joblib.Parallel(n_jobs=n_jobs)(
+                    joblib.delayed(_score_spheres)(self.engine, files[0], (files[1], files[2]), batch, y, folds)
+                    for batch in batches)
+            for file in files:
+                os.remove(file)
+
+        self.results = pd.DataFrame(list(chain.from_iterable(results)), columns=self.engine.metrics)
+        self._write_results(mask_img)
+        return self
+
+    def _write_results(self, mask_img):
+        """
+        Write the results of all spheres by center voxel and the performance NIfTI.
+        """
+        df = self.results.copy()
+        voxels = np.argwhere(np.asanyarray(mask_img.dataobj).astype(bool))
+        df.insert(0, 'i', voxels[:, 0])
+        df.insert(1, 'j', voxels[:, 1])
+        df.insert(2, 'k', voxels[:, 2])
+        df.to_csv(os.path.join(self.folder, 'searchlight_results.csv'), index=False)
+
+        performances = self.results[self.engine.best_config_metric].values.astype(np.float32)
+        backmapped_img, _, _ = self.neuro_element.inverse_transform(performances)
+        backmapped_img.to_filename(os.path.join(self.folder, 'searchlight_performances.nii.gz'))
+
+    def _extract(self, X):
+        """
+        Transform X with the neuro element.
+        :param X: input data
+        :return: np.ndarray, (n_subjects, n_voxels) masked data
+        """
+        self.brain_mask.masker = None
+        X_masked, _, _ = self.neuro_element.transform(X)
+
+        if self.brain_mask.masker is None:
+            # the BrainMask ran in other processes (nr_of_processes > 1): get the masker from a single subject
+            single_element = self.neuro_element.copy_me()
+            if isinstance(single_element, NeuroBranch):
+                single_element.nr_of_processes = 1
+            single_mask = SearchlightMapper._find_brain_mask(single_element)
+            single_element.transform(X[:1] if isinstance(X, (list, np.ndarray)) else X)
+            self.brain_mask.masker = single_mask.masker
+            self.brain_mask.mask_image = single_mask.mask_image
+            self.brain_mask.affine, self.brain_mask.shape = single_mask.affine, single_mask.shape
+        return np.atleast_2d(X_masked)
+
+    @staticmethod
+    def sphere_neighbours(mask_img, radius: float):
+        """
+        Voxels within radius (mm) of every voxel of the mask, in the voxel order of the NiftiMasker.
+        :param mask_img: Nifti1Image, binary mask
+        :param radius: float, sphere radius in mm
+        :return: (indptr, indices): the sphere of voxel v are the voxels indices[indptr[v]:indptr[v + 1]]
+        """
+        voxels = np.argwhere(np.asanyarray(mask_img.dataobj).astype(bool))
+        coordinates = apply_affine(mask_img.affine, voxels)
+        neighbours = cKDTree(coordinates).query_ball_point(coordinates, r=radius)
+        sizes = np.fromiter((len(n) for n in neighbours), dtype=np.int64, count=len(neighbours))
+        indptr = np.concatenate([[0], np.cumsum(sizes)])
+        indices = np.fromiter(chain.from_iterable(neighbours), dtype=np.int64, count=indptr[-1])
+        return indptr, indices
+
+    @staticmethod
+    def sphere_gram_matrices(X, neighbours: tuple, centers: tuple, dtype='float64'):
+        """
+        Linear kernel of a batch of spheres. The spheres are padded to the largest sphere of the batch,
+        padded voxels are zero and do not contribute.
+        :param X: np.ndarray, (n_subjects, n_voxels) masked data
+        :param neighbours: (indptr, indices) as returned by sphere_neighbours
+        :param centers: (start, stop), range of center voxels
+        :return: np.ndarray, (n_spheres, n_subjects, n_subjects)
+        """
+        indptr, indices = neighbours
+        starts = np.asarray(indptr[centers[0]:centers[1]])
+        sizes = np.asarray(indptr[centers[0] + 1:centers[1] + 1]) - starts
+        offsets = np.arange(sizes.max())
+        valid = offsets[None, :] < sizes[:, None]
+        voxels = np.asarray(indices)[np.where(valid, starts[:, None] + offsets[None, :], 0)]
+
+        # (n_spheres, n_subjects, max sphere size)
+        X_spheres = np.asarray(X[:, voxels.ravel()], dtype=dtype).reshape(X.shape[0], *voxels.shape)
+        X_spheres = X_spheres.transpose(1, 0, 2) * valid[:, None, :]
+        return np.matmul(X_spheres, X_spheres.transpose(0, 2, 1))
+
+    @staticmethod
+    def _find_brain_mask(neuro_element: Union[NeuroBranch, PipelineElement]):
+        """
+        Find the BrainMask defining the voxel domain.
+        :param neuro_element: NeuroElement
+        :return: BrainMask
+        """
+        brain_mask = None
+        if isinstance(neuro_element, NeuroBranch):
+            for element in neuro_element.elements:
+                if isinstance(element.base_element, BrainMask):
+                    brain_mask = element.base_element
+        elif isinstance(neuro_element.base_element, BrainMask):
+            brain_mask = neuro_element.base_element
+
+        if brain_mask is None or brain_mask.extract_mode != 'vec':
+            msg = "SearchlightMapper needs a BrainMask with extract_mode='vec'."
+            logger.error(msg)
+            raise ValueError(msg)
+        return brain_mask
+
+
+def _score_spheres(engine: RidgeEngine, X, neighbours: tuple, centers: tuple, y, folds: list):
+    """
+    Cross-validate the spheres of a batch of center voxels.
+    :param engine: RidgeEngine
+    :param X: masked data or path to the masked data saved with np.save
+    :param neighbours: (indptr, indices) or paths to them
+    :param centers: (start, stop), range of center voxels
+    :return: list of dicts {metric: mean test performance over folds}
+    """
+    if isinstance(X, str):
+        X = np.load(X, mmap_mode='r')
+        neighbours = tuple(np.load(n, mmap_mode='r') for n in neighbours)
+    Y, decode = engine.encode_targets(y)
+    return engine.score_kernels(SearchlightMapper.sphere_gram_matrices(X, neighbours, centers), Y, decode, y, folds)
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import shutil
+
+import nibabel as nib
+import numpy as np
+from scipy import sparse
+
+from photonai.photonlogger.logger import logger
+
+from photonai_neuro.objects import AtlasObject, MaskObject, RoiObject
+from photonai_neuro.util import dump_json
+
+
+class SharedAtlasStore:
+    """
+    Folder of memory mapped atlas and mask bundles. The parent process publishes the prepared label maps,
+    ROI voxel indices and masks once, worker processes attach to them read-only: the operating system shares
+    the mapped pages between all processes, nothing is copied or rebuilt.
+
+    The store is found by the workers through the environment variable PHOTONAI_NEURO_SHARED_ATLASES,
+    so it has to be activated before the worker processes are started.
+    The same bundles hold the atlases precomputed for standard grids (see AtlasLibrary.precompute).
+
+    Parameter
+    ---------
+    * `folder` [str]:
+        Folder of the bundles, on a local or shared filesystem.
+
+    """
+    ENVIRONMENT_VARIABLE = 'PHOTONAI_NEURO_SHARED_ATLASES'
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        os.makedirs(self.folder, exist_ok=True)
+
+    @staticmethod
+    def active():
+        """
+        :return: SharedAtlasStore activated in this or the parent process, None if there is none
+        """
+        folder = os.environ.get(SharedAtlasStore.ENVIRONMENT_VARIABLE)
+        if not folder or not os.path.isdir(folder):
+            return None
+        return SharedAtlasStore(folder)
+
+    def activate(self):
+        os.environ[SharedAtlasStore.ENVIRONMENT_VARIABLE] = os.path.abspath(self.folder)
+
+    @staticmethod
+    def deactivate():
+        os.environ.pop(SharedAtlasStore.ENVIRONMENT_VARIABLE, None)
+
+    @staticmethod
+    def bundle_name(key: tuple):
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:20]
+
+    def has(self, key: tuple):
+        return os.path.isfile(os.path.join(self.folder, SharedAtlasStore.bundle_name(key), 'bundle.json'))
+
+    def publish(self, key: tuple, obj, source_hash: str = None):
+        """
+        Write an AtlasObject or MaskObject as bundle. An existing bundle of the key is replaced.
+        :param key: tuple, library key of the object
+        :param obj: AtlasObject or MaskObject
+        :param source_hash: str, content hash of the atlas or mask file the object was built from
+        """
+        bundle = os.path.join(self.folder, SharedAtlasStore.bundle_name(key))
+        tmp_bundle = bundle + '.tmp{}'.format(os.getpid())
+        os.makedirs(tmp_bundle, exist_ok=True)
+
+        if isinstance(obj, AtlasObject):
+            roi_voxels = [roi.voxel_indices for roi in obj.roi_list]
+            np.save(os.path.join(tmp_bundle, 'map.npy'), np.asarray(obj.map))
+            np.save(os.path.join(tmp_bundle, 'roi_voxels.npy'),
+                    np.concatenate(roi_voxels).astype(np.int64) if roi_voxels else np.array([], dtype=np.int64))
+            meta = {'kind': 'atlas', 'key': repr(key), 'name': obj.name, 'path': obj.path,
+                    'labels_file': obj.labels_file, 'mask_threshold': obj.mask_threshold,
+                    'affine': np.asarray(obj.atlas.affine).tolist(),
+                    'indices': [float(i) for i in obj.indices],
+                    'rois': [[float(roi.index), roi.label, int(roi.voxel_indices.size), bool(roi.is_empty)]
+                             for roi in obj.roi_list],
+                    'weights_shape': None}
+            if obj.weights is not None:
+                # probabilistic atlas: the sparse weights as their three arrays
+                for part in ['data', 'indices', 'indptr']:
+                    np.save(os.path.join(tmp_bundle, 'weights_{}.npy'.format(part)), getattr(obj.weights, part))
+                meta['weights_shape'] = list(obj.weights.shape)
+        elif isinstance(obj, MaskObject):
+            np.save(os.path.join(tmp_bundle, 'mask.npy'), np.asarray(obj.mask.dataobj))
+            meta = {'kind': 'mask', 'key': repr(key), 'name': obj.name, 'mask_file': obj.mask_file,
+                    'affine': np.asarray(obj.mask.affine).tolist(), 'is_empty': bool(obj.is_empty)}
+        else:
+            msg = "Cannot share objects of type {}.".format(type(obj).__name__)
+            logger.error(msg)
+            raise ValueError(msg)
+
+        meta['source_hash'] = source_hash
+        dump_json(meta, os.path.join(tmp_bundle, 'bundle.json'))
+        if os.path.isdir(bundle):
+            shutil.rmtree(bundle)
+        os.replace(tmp_bundle, bundle)
+        logger.debug("SharedAtlasStore: published {} to {}".format(obj.name, bundle))
+
+    def attach(self, key: tuple, source_hash: str = None):
+        """
+        Attach read-only to the bundle of a key.
+        :param key: tuple, library key
+        :param source_hash: str, content hash of the atlas or mask file, bundles of other content are ignored
+        :return: AtlasObject or MaskObject backed by memory maps, None if the key has not been published
+        """
+        bundle = os.path.join(self.folder, SharedAtlasStore.bundle_name(key))
+        meta_file = os.path.join(bundle, 'bundle.json')
+        if not os.path.isfile(meta_file):
+            return None
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+        if meta['key'] != repr(key):
+            return None
+        if source_hash is not None and meta.get('source_hash') != source_hash:
+            logger.debug("SharedAtlasStore: bundle {} is outdated.".format(bundle))
+            return None
+        affine = np.asarray(meta['affine'])
+
+        if meta['kind'] == 'mask':
+            mask = np.load(os.path.join(bundle, 'mask.npy'), mmap_mode='r')
+            mask_object = MaskObject(name=meta['name'], mask_file=meta['mask_file'],
+                                     mask=nib.Nifti1Image(mask, affine))
+            mask_object.is_empty = meta['is_empty']
+            return mask_object
+
+        atlas_map = np.load(os.path.join(bundle, 'map.npy'), mmap_mode='r')
+        roi_voxels = np.load(os.path.join(bundle, 'roi_voxels.npy'), mmap_mode='r')
+        atlas_object = AtlasObject(name=meta['name'], path=meta['path'], labels_file=meta['labels_file'],
+                                   mask_threshold=meta['mask_threshold'], affine=affine,
+                                   shape=atlas_map.shape, indices=meta['indices'])
+        atlas_object.map = atlas_map
+        atlas_object.atlas = nib.Nifti1Image(atlas_map, affine)
+        if meta.get('weights_shape') is not None:
+            atlas_object.weights = sparse.csc_matrix(tuple(np.load(os.path.join(bundle, 'weights_{}.npy'.format(part)),
+                                                                   mmap_mode='r')
+                                                           for part in ['data', 'indices', 'indptr']),
+                                                     shape=tuple(meta['weights_shape']))
+        offsets = np.concatenate([[0], np.cumsum([size for _, _, size, _ in meta['rois']])]).astype(int)
+        for (index, label, size, is_empty), start in zip(meta['rois'], offsets[:-1]):
+            # the voxel indices are views on the shared memory map
+            roi = RoiObject(index=index, label=label, size=size, voxel_indices=roi_voxels[start:start + size],
+                            atlas=atlas_object)
+            roi.is_empty = is_empty
+            atlas_object.roi_list.append(roi)
+        return atlas_object
+
+    def clear(self):
+        """
+        Delete all bundles of the store.
+        """
+        for name in os.listdir(self.folder):
+            if os.path.isdir(os.path.join(self.folder, name)) and \
+                    os.path.isfile(os.path.join(self.folder, name, 'bundle.json')):
+                shutil.rmtree(os.path.join(self.folder, name))
@@ -0,0 +1,151 @@
+import os
+import socket
+import sqlite3
+import time
+
+from photonai.photonlogger.logger import logger
+
+
+class RoiTaskQueue:
+    """
+    Ledger of ROI fitting tasks in an SQLite database on a shared filesystem.
+    Any number of workers on any node can claim tasks; a claim is an exclusive transaction,
+    so every task is handed out once. Tasks of crashed workers stay running until they are claimed again
+    after STALE_AFTER seconds or handed back with requeue.
+
+    Parameter
+    ---------
+    * `file` [str]:
+        Path of the SQLite database.
+
+    * `timeout` [float] - [default: 60.]:
+        Seconds to wait for the lock of the database.
+
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    # seconds after which a running task counts as abandoned by a crashed worker
+    STALE_AFTER = 24 * 3600.
+
+    def __init__(self, file: str, timeout: float = 60.):
+        self.file = file
+        self.timeout = timeout
+
+    def _connect(self):
+        # autocommit mode, transactions are opened explicitly
+        return sqlite3.connect(self.file, timeout=self.timeout, isolation_level=None)
+
+    def publish(self, tasks: list):
+        """
+        Replace all tasks of the queue.
+        :param tasks: list of (roi_name, roi_index, hyperpipe_file, start_column, stop_column)
+        """
+        con = self._connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            con.execute('CREATE TABLE IF NOT EXISTS tasks (roi_name TEXT PRIMARY KEY, roi_index INTEGER, '
+                        'hyperpipe_file TEXT, start_column INTEGER, stop_column INTEGER, status TEXT, '
+                        'worker TEXT, claimed_at REAL, finished_at REAL, attempts INTEGER, error TEXT)')
+            con.execute('DELETE FROM tasks')
+            con.executemany("INSERT INTO tasks VALUES (?, ?, ?, ?, ?, '{}', NULL, NULL, NULL, 0, NULL)"
+                            .format(self.PENDING), tasks)
+            con.execute('COMMIT')
+        finally:
+            con.close()
+
+    def claim(self, worker: str = None, stale_after: float = STALE_AFTER):
+        """
+        Claim the next pending task.
+        :param worker: str, name of the worker, None uses host and process id
+        :param stale_after: float, seconds after which running tasks count as abandoned and are handed out again,
+                            None never hands out running tasks
+        :return: dict of the task or None if there is no task left
+        """
+        worker = worker if worker is not None else RoiTaskQueue.worker_name()
+        now = time.time()
+        con = self._connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            row = con.execute('SELECT roi_name, roi_index, hyperpipe_file, start_column, stop_column FROM tasks '
+                              'WHERE status = ? OR (status = ? AND claimed_at < ?) ORDER BY roi_index LIMIT 1',
+                              (self.PENDING, self.RUNNING,
+                               now - stale_after if stale_after is not None else -1)).fetchone()
+            if row is not None:
+                con.execute('UPDATE tasks SET status = ?, worker = ?, claimed_at = ?, attempts = attempts + 1 '
+                            'WHERE roi_name = ?', (self.RUNNING, worker, now, row[0]))
+            con.execute('COMMIT')
+        finally:
+            con.close()
+        if row is None:
+            return None
+        return {'roi_name': row[0], 'roi_index': row[1], 'hyperpipe_file': row[2],
+                'roi_columns': (row[3], row[4]), 'worker': worker}
+
+    def requeue(self, stale_after: float = 0.):
+        """
+        Hand running tasks back to the queue, e.g. those of crashed workers before a merge.
+        Their old workers can not finish them anymore.
+        :param stale_after: float, only tasks claimed longer than this many seconds ago, 0 requeues all running tasks
+        :return: int, number of requeued tasks
+        """
+        con = self._connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            n_requeued = con.execute('UPDATE tasks SET status = ?, worker = NULL, claimed_at = NULL '
+                                     'WHERE status = ? AND claimed_at <= ?',
+                                     (self.PENDING, self.RUNNING, time.time() - stale_after)).rowcount
+            con.execute('COMMIT')
+        finally:
+            con.close()
+        return n_requeued
+
+    def finish(self, roi_name: str, worker: str):
+        self._set_status(roi_name, worker, self.DONE)
+
+    def fail(self, roi_name: str, worker: str, error: str):
+        logger.error("ROI {} failed on worker {}: {}".format(roi_name, worker, error))
+        self._set_status(roi_name, worker, self.FAILED, error)
+
+    def _set_status(self, roi_name: str, worker: str, status: str, error: str = None):
+        con = self._connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            # a task handed out again as stale belongs to the new worker
+            con.execute('UPDATE tasks SET status = ?, finished_at = ?, error = ? WHERE roi_name = ? AND worker = ?',
+                        (status, time.time(), error, roi_name, worker))
+            con.execute('COMMIT')
+        finally:
+            con.close()
+
+    def status(self):
+        """
+        :return: dict, number of tasks by status
+        """
+        con = self._connect()
+        try:
+            rows = con.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall()
+        finally:
+            con.close()
+        counts = {self.PENDING: 0, self.RUNNING: 0, self.DONE: 0, self.FAILED: 0}
+        counts.update(dict(rows))
+        return counts
+
+    def tasks(self, status: str = None):
+        """
+        :param status: str, only tasks of this status, None returns all tasks
+        :return: list of (roi_name, status, worker, attempts, error)
+        """
+        con = self._connect()
+        try:
+            query = 'SELECT roi_name, status, worker, attempts, error FROM tasks'
+            if status is not None:
+                return con.execute(query + ' WHERE status = ? ORDER BY roi_index', (status,)).fetchall()
+            return con.execute(query + ' ORDER BY roi_index').fetchall()
+        finally:
+            con.close()
+
+    @staticmethod
+    def worker_name():
+        return "{}:{}".format(socket.gethostname(), os.getpid())
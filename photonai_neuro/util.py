@@ -1,5 +1,8 @@
+import inspect
+import json
 import os
 from photonai.base import PhotonRegistry
+from photonai.photonlogger.logger import logger
 
 
 def delete_photonai_neuro():
@@ -9,6 +12,35 @@ def delete_photonai_neuro():
 
 
 def register_photonai_neuro():
+    """
+    Register the neuro elements in the PHOTONAI registry, if they are not registered yet or if the
+    registered elements differ from the elements of this version. Nothing is written otherwise.
+    The registry resolves element names from the module files in its folder only, a lookup of an unknown name
+    reloads all elements from these files. The file is therefore written once per install or version change.
+    The module files are compared directly: instantiating the registry imports all registered elements.
+    """
     current_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "photonai_neuro.json")
-    reg = PhotonRegistry()
-    reg.add_module(current_path)
+    registered_path = os.path.join(os.path.dirname(os.path.abspath(inspect.getfile(PhotonRegistry))), "modules",
+                                   "photonai_neuro.json")
+    with open(current_path, 'r') as f:
+        elements = json.load(f)
+    try:
+        with open(registered_path, 'r') as f:
+            registered_elements = json.load(f)
+    except (OSError, ValueError):
+        registered_elements = None
+    if registered_elements == elements:
+        return
+
+    logger.info("Registering Neuro Module" if registered_elements is None else "Updating Neuro Module Registration")
+    PhotonRegistry().add_module(current_path)
+
+
+def dump_json(obj, file: str):
+    """
+    Write json atomically: an interrupted write never leaves a truncated file behind.
+    """
+    tmp_file = file + '.tmp'
+    with open(tmp_file, 'w') as fp:
+        json.dump(obj, fp)
+    os.replace(tmp_file, file)
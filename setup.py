@@ -25,6 +25,10 @@ In addition, it supports a range of advanced feature extraction and feature engi
     download_url='https://github.com/wwu-mmll/photonai_neuro/archive/' + __version__ + '.tar.gz',
     keywords=['machine learning', 'neuroimaging', 'MRI'],
     classifiers=[],
+    entry_points={
+        'console_scripts': ['photonai-neuro-extract = photonai_neuro.cli:main',
+                            'photonai-neuro-atlases = photonai_neuro.cli:precompute_main']
+    },
     install_requires=[
         'photonai',
         'nibabel',
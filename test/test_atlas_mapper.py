@@ -1,11 +1,13 @@
+import multiprocessing
 import warnings
 import os
 import numpy as np
+import pandas as pd
 from nilearn.datasets import fetch_oasis_vbm
 from sklearn.model_selection import KFold
 
 from photonai.base import Hyperpipe, PipelineElement, OutputSettings, Preprocessing
-from photonai_neuro import AtlasMapper, NeuroBranch
+from photonai_neuro import AtlasMapper, NeuroBranch, RoiScreening, RidgeEngine, FeatureStore
 from test.test_neuro import NeuroBaseTest
 
 class AtlasMapperTests(NeuroBaseTest):
@@ -95,3 +97,270 @@ class AtlasMapperTests(NeuroBaseTest):
         with self.assertRaises(Exception):
             atlas_mapper.predict(X)
         atlas_mapper.fit(X, y)
+
+    def test_fit_parallel(self):
+        results_folder = './tmp/parallel/'
+        X, y = self.create_data()
+        brain_atlas = PipelineElement('BrainAtlas', atlas_name="AAL",
+                                      rois=['Hippocampus_L', 'Hippocampus_R', "Frontal_Sup_Orb_L"], batch_size=200)
+        my_pipe = self.create_hyperpipe()
+        my_pipe.nr_of_processes = 2
+        neuro_branch = NeuroBranch('NeuroBranch')
+        neuro_branch += brain_atlas
+        atlas_mapper = AtlasMapper(neuro_element=neuro_branch,
+                                   hyperpipe=my_pipe,
+                                   folder=results_folder,
+                                   n_jobs=2)
+        atlas_mapper.fit(X, y)
+
+        for hyperpipe_name in atlas_mapper.hyperpipe_infos.keys():
+            self.assertEqual(atlas_mapper.hyperpipe_infos[hyperpipe_name]['roi_index'],
+                             atlas_mapper.roi_indices[hyperpipe_name])
+        self.assertTrue(os.path.exists(results_folder + "atlas_mapper_example_atlas_mapper_meta.json"))
+        self.assertTrue(os.path.exists(results_folder + "atlas_mapper_example_atlas_mapper_results.csv"))
+        self.assertTrue(os.path.exists(results_folder + "atlas_mapper_performances.nii.gz"))
+
+        result_apri = atlas_mapper.predict(X)
+        atlas_mapper = AtlasMapper.load_from_folder(folder=results_folder, analysis_name='atlas_mapper_example')
+        result_apo = atlas_mapper.predict(X)
+        for key in result_apri.keys():
+            np.testing.assert_array_equal(result_apo[key], result_apri[key])
+
+    def test_resume(self):
+        results_folder = './tmp/resume/'
+        X, y = self.create_data()
+
+        def create_atlas_mapper():
+            brain_atlas = PipelineElement('BrainAtlas', atlas_name="AAL",
+                                          rois=['Hippocampus_L', 'Hippocampus_R', "Frontal_Sup_Orb_L"])
+            neuro_branch = NeuroBranch('NeuroBranch')
+            neuro_branch += brain_atlas
+            return AtlasMapper(neuro_element=neuro_branch, hyperpipe=self.create_hyperpipe(), folder=results_folder)
+
+        atlas_mapper = create_atlas_mapper()
+        atlas_mapper.fit(X, y)
+        result_apri = atlas_mapper.predict(X)
+
+        checkpoint_folder = os.path.join(results_folder, 'atlas_mapper_checkpoints')
+        records = sorted(os.listdir(checkpoint_folder))
+        self.assertEqual(len(records), 3)
+        self.assertTrue(os.path.exists(os.path.join(results_folder, 'roi_data.npy')))
+
+        # simulate a fit that died before the last ROI was finished
+        os.remove(os.path.join(checkpoint_folder, 'atlas_mapper_example_Atlas_Mapper_Frontal_Sup_Orb_L.json'))
+        finished_record = os.path.join(checkpoint_folder, 'atlas_mapper_example_Atlas_Mapper_Hippocampus_L.json')
+        finished_mtime = os.path.getmtime(finished_record)
+
+        atlas_mapper = create_atlas_mapper()
+        atlas_mapper.fit(X, y, resume=True)
+        self.assertEqual(sorted(os.listdir(checkpoint_folder)), records)
+        self.assertEqual(os.path.getmtime(finished_record), finished_mtime)
+        self.assertEqual(len(atlas_mapper.hyperpipe_infos), 3)
+
+        result_apo = atlas_mapper.predict(X)
+        for key in ['Hippocampus_L', 'Hippocampus_R']:
+            np.testing.assert_array_equal(result_apo[key], result_apri[key])
+
+        # resuming with other data refits all ROIs instead of reusing models of the old data
+        atlas_mapper = create_atlas_mapper()
+        atlas_mapper.fit(X, y[::-1], resume=True)
+        self.assertEqual(sorted(os.listdir(checkpoint_folder)), records)
+        self.assertGreater(os.path.getmtime(finished_record), finished_mtime)
+
+    def test_lazy_loading(self):
+        results_folder = './tmp/lazy/'
+        X, y = self.create_data()
+        brain_atlas = PipelineElement('BrainAtlas', atlas_name="AAL",
+                                      rois=['Hippocampus_L', 'Hippocampus_R', "Frontal_Sup_Orb_L"])
+        neuro_branch = NeuroBranch('NeuroBranch')
+        neuro_branch += brain_atlas
+        atlas_mapper = AtlasMapper(neuro_element=neuro_branch, hyperpipe=self.create_hyperpipe(),
+                                   folder=results_folder)
+        atlas_mapper.fit(X, y)
+        result_apri = atlas_mapper.predict(X)
+
+        atlas_mapper = AtlasMapper.load_from_folder(folder=results_folder, max_models_in_memory=1)
+        self.assertEqual(atlas_mapper.hyperpipes_to_fit.loaded, [])
+        self.assertEqual(len(atlas_mapper.hyperpipes_to_fit), 3)
+
+        result_apo = atlas_mapper.predict(X, rois=['Hippocampus_R'])
+        self.assertEqual(list(result_apo.keys()), ['Hippocampus_R'])
+        self.assertEqual(atlas_mapper.hyperpipes_to_fit.loaded, ['Hippocampus_R'])
+
+        result_apo = atlas_mapper.predict(X)
+        self.assertEqual(len(atlas_mapper.hyperpipes_to_fit.loaded), 1)
+        for key in result_apri.keys():
+            np.testing.assert_array_equal(result_apo[key], result_apri[key])
+
+    def test_predict_batch(self):
+        results_folder = './tmp/batch/'
+        X, y = self.create_data()
+        brain_atlas = PipelineElement('BrainAtlas', atlas_name="AAL",
+                                      rois=['Hippocampus_L', 'Hippocampus_R', "Frontal_Sup_Orb_L"])
+        neuro_branch = NeuroBranch('NeuroBranch')
+        neuro_branch += brain_atlas
+        atlas_mapper = AtlasMapper(neuro_element=neuro_branch, hyperpipe=self.create_hyperpipe(),
+                                   folder=results_folder)
+        atlas_mapper.fit(X, y)
+        result_dict = atlas_mapper.predict(X)
+
+        atlas_mapper = AtlasMapper.load_from_folder(folder=results_folder)
+        for n_jobs, backend in [(1, 'threading'), (2, 'threading'), (2, 'loky')]:
+            predictions, rois = atlas_mapper.predict_batch(X, n_jobs=n_jobs, backend=backend)
+            self.assertEqual(predictions.shape, (len(X), 3))
+            # atlas order
+            self.assertEqual(rois, ['Frontal_Sup_Orb_L', 'Hippocampus_L', 'Hippocampus_R'])
+            for i, roi in enumerate(rois):
+                np.testing.assert_array_equal(predictions[:, i], result_dict[roi])
+
+        streamed = list(atlas_mapper.predict_stream(X, batch_size=7))
+        self.assertEqual(len(streamed), 3)
+        np.testing.assert_array_equal(np.concatenate([s.predictions for s in streamed]), predictions)
+
+        with self.assertRaises(ValueError):
+            atlas_mapper.predict_batch(X, n_jobs=2, backend='dask')
+
+    def test_screening(self):
+        results_folder = './tmp/screening/'
+        X, y = self.create_data()
+        brain_atlas = PipelineElement('BrainAtlas', atlas_name="AAL",
+                                      rois=['Hippocampus_L', 'Hippocampus_R', "Frontal_Sup_Orb_L"])
+        neuro_branch = NeuroBranch('NeuroBranch')
+        neuro_branch += brain_atlas
+        atlas_mapper = AtlasMapper(neuro_element=neuro_branch, hyperpipe=self.create_hyperpipe(),
+                                   folder=results_folder)
+        atlas_mapper.fit(X, y, screening=RoiScreening(n_splits=[2, 3], keep_fraction=0.5))
+
+        # 3 ROIs -> 2 ROIs -> 1 ROI fitted with the hyperpipe
+        self.assertEqual(len(atlas_mapper.hyperpipe_infos), 1)
+        results = pd.read_csv(os.path.join(results_folder, 'atlas_mapper_example_atlas_mapper_results.csv'),
+                              index_col=0)
+        self.assertEqual(len(results.columns), 3)
+        self.assertListEqual(sorted(results.loc['screening_round'].astype(int).tolist()), [0, 1, 2])
+        # one scalar per metric for screened and fitted ROIs alike
+        accuracy = results.loc['accuracy'].astype(float)
+        self.assertFalse(accuracy.isnull().any())
+        self.assertTrue(os.path.exists(os.path.join(results_folder, 'atlas_mapper_performances.nii.gz')))
+
+        predictions = atlas_mapper.predict(X)
+        self.assertEqual(list(predictions.keys()), list(atlas_mapper.hyperpipe_infos.keys()))
+
+    def test_ridge_engine(self):
+        results_folder = './tmp/ridge_engine/'
+        X, y = self.create_data()
+        brain_atlas = PipelineElement('BrainAtlas', atlas_name="AAL",
+                                      rois=['Hippocampus_L', 'Hippocampus_R', "Frontal_Sup_Orb_L"])
+        neuro_branch = NeuroBranch('NeuroBranch')
+        neuro_branch += brain_atlas
+
+        # settings are taken from the hyperpipe
+        atlas_mapper = AtlasMapper(neuro_element=neuro_branch, hyperpipe=self.create_hyperpipe(),
+                                   folder=results_folder)
+        atlas_mapper.fit(X, y, engine=RidgeEngine(cv=KFold(n_splits=3)))
+        results = pd.read_csv(os.path.join(results_folder, 'atlas_mapper_example_atlas_mapper_results.csv'),
+                              index_col=0)
+        # atlas order
+        self.assertListEqual(list(results.columns), ['Frontal_Sup_Orb_L', 'Hippocampus_L', 'Hippocampus_R'])
+        self.assertTrue(((results.loc['accuracy'] >= 0) & (results.loc['accuracy'] <= 1)).all())
+        self.assertTrue(os.path.exists(os.path.join(results_folder, 'atlas_mapper_performances.nii.gz')))
+        self.assertFalse(os.path.exists(os.path.join(results_folder, 'atlas_mapper_example_atlas_mapper_meta.json')))
+
+        # the task follows the estimator of the hyperpipe
+        self.assertEqual(atlas_mapper._configure_engine(RidgeEngine()).task, 'classification')
+        self.assertEqual(atlas_mapper._configure_engine(RidgeEngine(task='regression')).task, 'regression')
+
+        # without hyperpipe the engine has to define the metrics
+        atlas_mapper = AtlasMapper(neuro_element=neuro_branch, folder=results_folder)
+        with self.assertRaises(ValueError):
+            atlas_mapper.fit(X, y, engine=RidgeEngine())
+        atlas_mapper.fit(X, y, engine=RidgeEngine(metrics=['accuracy'], best_config_metric='accuracy'))
+        self.assertTrue(os.path.exists(os.path.join(results_folder, 'ridge_engine_atlas_mapper_results.csv')))
+
+    def test_permutation_test(self):
+        results_folder = './tmp/permutation/'
+        X, y = self.create_data()
+        brain_atlas = PipelineElement('BrainAtlas', atlas_name="AAL",
+                                      rois=['Hippocampus_L', 'Hippocampus_R', "Frontal_Sup_Orb_L"])
+        neuro_branch = NeuroBranch('NeuroBranch')
+        neuro_branch += brain_atlas
+        atlas_mapper = AtlasMapper(neuro_element=neuro_branch, hyperpipe=self.create_hyperpipe(),
+                                   folder=results_folder)
+        atlas_mapper.fit(X, y, engine=RidgeEngine(cv=KFold(n_splits=3)))
+        results = atlas_mapper.permutation_test(X, y, n_permutations=50, engine=RidgeEngine(cv=KFold(n_splits=3)))
+
+        # atlas order
+        self.assertListEqual(list(results.columns), ['Frontal_Sup_Orb_L', 'Hippocampus_L', 'Hippocampus_R'])
+        self.assertTrue((results.loc['p_value'] >= 1 / 51).all())
+        self.assertTrue((results.loc['p_value_corrected'] >= results.loc['p_value']).all())
+        # same engine and split as the fit
+        fit_results = pd.read_csv(os.path.join(results_folder, 'atlas_mapper_example_atlas_mapper_results.csv'),
+                                  index_col=0)
+        np.testing.assert_allclose(results.loc['accuracy'].values, fit_results.loc['accuracy'].values)
+        for file in ['atlas_mapper_pvalues.nii.gz', 'atlas_mapper_pvalues_corrected.nii.gz',
+                     'atlas_mapper_significant.nii.gz', 'atlas_mapper_example_atlas_mapper_permutations.csv']:
+            self.assertTrue(os.path.exists(os.path.join(results_folder, file)))
+
+    def test_distributed(self):
+        results_folder = './tmp/distributed/'
+        X, y = self.create_data()
+        brain_atlas = PipelineElement('BrainAtlas', atlas_name="AAL",
+                                      rois=['Hippocampus_L', 'Hippocampus_R', "Frontal_Sup_Orb_L"])
+        neuro_branch = NeuroBranch('NeuroBranch')
+        neuro_branch += brain_atlas
+        atlas_mapper = AtlasMapper(neuro_element=neuro_branch, hyperpipe=self.create_hyperpipe(),
+                                   folder=results_folder)
+        queue = atlas_mapper.publish(X, y)
+        self.assertEqual(queue.status()['pending'], 3)
+
+        with self.assertRaises(ValueError):
+            AtlasMapper.merge(results_folder)
+
+        workers = [multiprocessing.Process(target=AtlasMapper.run_worker, args=(results_folder,)) for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(queue.status()['done'], 3)
+        # every task has been claimed exactly once
+        self.assertListEqual([attempts for _, _, _, attempts, _ in queue.tasks()], [1, 1, 1])
+
+        merged = AtlasMapper.merge(results_folder)
+        for file in ['atlas_mapper_example_atlas_mapper_meta.json', 'atlas_mapper_example_atlas_mapper_results.csv',
+                     'atlas_mapper_performances.nii.gz']:
+            self.assertTrue(os.path.exists(os.path.join(results_folder, file)))
+        predictions = merged.predict(X)
+        self.assertEqual(len(predictions), 3)
+
+    def test_feature_store(self):
+        X, y = self.create_data()
+        brain_atlas = PipelineElement('BrainAtlas', atlas_name="AAL",
+                                      rois=['Hippocampus_L', 'Hippocampus_R', "Frontal_Sup_Orb_L"])
+        neuro_branch = NeuroBranch('NeuroBranch')
+        neuro_branch += brain_atlas
+        feature_store = FeatureStore(os.path.join(self.tmp_folder_path, 'feature_store'))
+
+        atlas_mapper = AtlasMapper(neuro_element=neuro_branch, folder='./tmp/feature_store/first')
+        atlas_mapper.fit(X[:10], y[:10], engine=RidgeEngine(metrics=['accuracy'], best_config_metric='accuracy'),
+                         feature_store=feature_store)
+        self.assertEqual(len(feature_store), 10)
+
+        # the second fit only extracts the new subjects
+        atlas_mapper = AtlasMapper(neuro_element=neuro_branch, hyperpipe=self.create_hyperpipe(),
+                                   folder='./tmp/feature_store/second')
+        atlas_mapper.fit(X, y, feature_store=feature_store)
+        self.assertEqual(len(feature_store), 20)
+
+        X_extracted, _ = atlas_mapper._extract(X)
+        np.testing.assert_array_equal(np.load('./tmp/feature_store/second/roi_data.npy'), X_extracted)
+        self.assertTrue(os.path.exists('./tmp/feature_store/second/atlas_mapper_performances.nii.gz'))
+
+        # a store of other ROIs is not reused
+        neuro_branch = NeuroBranch('NeuroBranch')
+        neuro_branch += PipelineElement('BrainAtlas', atlas_name="AAL", rois=['Hippocampus_L'])
+        atlas_mapper = AtlasMapper(neuro_element=neuro_branch, folder='./tmp/feature_store/third')
+        atlas_mapper.fit(X, y, engine=RidgeEngine(metrics=['accuracy'], best_config_metric='accuracy'),
+                         feature_store=feature_store)
+        self.assertListEqual(feature_store.roi_labels, ['Hippocampus_L'])
+        X_extracted, _ = atlas_mapper._extract(X)
+        np.testing.assert_array_equal(feature_store.load(list(X)), X_extracted)
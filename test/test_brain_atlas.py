@@ -1,6 +1,7 @@
 import os
 import numpy as np
 from nilearn import image
+from scipy import ndimage
 import random
 import warnings
 
@@ -96,3 +97,157 @@ class BrainAtlasTests(NeuroBaseTest):
         with warnings.catch_warnings(record=True) as w:
             AtlasLibrary().list_rois("plAtlas")
             assert len(w) == 1
+
+    def test_list_layout(self):
+        atlas = BrainAtlas(atlas_name=self.atlas_name, rois=self.roi_list)
+        concat_data = atlas.transform(self.X[:3])
+        atlas.collection_mode = 'list'
+        list_data = atlas.transform(self.X[:3])
+
+        # one contiguous matrix, ROIs are column blocks
+        self.assertTrue(list_data.flags['C_CONTIGUOUS'])
+        np.testing.assert_array_equal(list_data, concat_data)
+        self.assertEqual(len(atlas.roi_offsets), len(self.roi_list) + 1)
+
+        atlas_obj = AtlasLibrary().get_atlas(self.atlas_name, atlas.affine, atlas.shape)
+        rois = BrainAtlas._get_rois(atlas_obj, which_rois=self.roi_list)
+        for i, roi in enumerate(rois):
+            roi_data = list_data[:, atlas.roi_offsets[i]:atlas.roi_offsets[i + 1]]
+            self.assertIs(roi_data.base, list_data)
+            np.testing.assert_array_equal(roi_data, atlas.apply_mask(
+                image.load_img(list(self.X[:3])).get_fdata(dtype=np.float32), roi.mask))
+
+        # inverse transform of one value per voxel
+        img = atlas.inverse_transform(np.ones(atlas.roi_offsets[-1]))
+        self.assertEqual(np.sum(img.get_fdata()), atlas.roi_offsets[-1])
+
+    def test_catalogue(self):
+        # all libraries share one catalogue, lookups do not touch the filesystem again
+        catalogue = AtlasLibrary().catalogue
+        self.assertIs(AtlasLibrary().catalogue, catalogue)
+        self.assertIs(AtlasLibrary().photon_atlases[self.atlas_name], catalogue.atlases[self.atlas_name])
+        self.assertTrue(os.path.isfile(catalogue.atlases[self.atlas_name].path))
+        self.assertEqual(catalogue.content_hash(self.atlas_name), catalogue.content_hash(self.atlas_name))
+
+        custom_atlas = os.path.join(self.atlas_folder, 'AAL_SPM12/AAL.nii.gz')
+        AtlasLibrary().register_atlas('my_aal', custom_atlas,
+                                      labels_file=os.path.join(self.atlas_folder, 'AAL_SPM12/AAL_labels.txt'))
+        self.assertListEqual(AtlasLibrary().list_rois('my_aal'), AtlasLibrary().list_rois(self.atlas_name))
+        self.assertEqual(catalogue.content_hash('my_aal'), catalogue.content_hash(self.atlas_name))
+
+        with self.assertRaises(FileNotFoundError):
+            AtlasLibrary().register_atlas('missing', 'XXXXX.nii.gz')
+
+    def test_library_keys(self):
+        affine, shape = image.load_img(self.X[0]).affine, image.load_img(self.X[0]).shape
+        noisy_affine = affine + 1e-7
+        self.assertEqual(AtlasLibrary.grid_key(affine, shape), AtlasLibrary.grid_key(noisy_affine, shape + (1,)))
+        self.assertNotEqual(AtlasLibrary.grid_key(affine, shape), AtlasLibrary.grid_key(affine * 2, shape))
+
+        AtlasLibrary.clear_cache()
+        atlas_obj = AtlasLibrary().get_atlas(self.atlas_name, affine, shape)
+        self.assertIs(AtlasLibrary().get_atlas(self.atlas_name, noisy_affine, shape), atlas_obj)
+        mask_obj = AtlasLibrary().get_mask('MNI_ICBM152_WholeBrain', affine, shape)
+        self.assertIs(AtlasLibrary().get_mask('MNI_ICBM152_WholeBrain', affine, shape), mask_obj)
+        stats = AtlasLibrary.cache_stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertGreater(stats['nbytes'], 0)
+        self.assertGreaterEqual(stats['hits'], 2)
+
+    def test_crop_atlas(self):
+        img = image.load_img(self.X[0])
+        full_obj = AtlasLibrary().get_atlas(self.atlas_name, img.affine, img.shape)
+        window = (slice(30, 60), slice(40, 70), slice(20, 50))
+        cropped_img = img.slicer[window]
+        cropped_obj = AtlasLibrary().crop_atlas(self.atlas_name, img.affine, img.shape, window)
+
+        # the cropped images find the window, whose ROIs keep the labels of the full grid
+        self.assertIs(AtlasLibrary().get_atlas(self.atlas_name, cropped_img.affine, cropped_img.shape), cropped_obj)
+        np.testing.assert_array_equal(cropped_obj.map, full_obj.map[window])
+        roi = cropped_obj.get_roi('Hippocampus_L')
+        self.assertFalse(roi.is_empty)
+        np.testing.assert_array_equal(np.flatnonzero(cropped_obj.map == roi.index), roi.voxel_indices)
+
+    def test_library_memory_budget(self):
+        AtlasLibrary.clear_cache()
+        try:
+            AtlasLibrary().get_atlas(self.atlas_name)
+            AtlasLibrary.set_memory_budget(AtlasLibrary.cache_stats()['nbytes'])
+            AtlasLibrary().get_atlas('HarvardOxford_Cortical_Threshold_25')
+            stats = AtlasLibrary.cache_stats()
+            # the least recently used atlas is dropped, the newest stays
+            self.assertEqual(stats['entries'], 1)
+            self.assertEqual(stats['evictions'], 1)
+            self.assertNotIn(AtlasLibrary.library_key('atlas', self.atlas_name), AtlasLibrary.LIBRARY)
+        finally:
+            AtlasLibrary.set_memory_budget(None)
+
+    def test_probabilistic_atlas(self):
+        # 4D atlas of three overlapping ROIs on the grid of the data
+        img = image.load_img(self.X[0])
+        label_map = AtlasLibrary().get_atlas(self.atlas_name, img.affine, img.shape).map
+        probabilities = np.zeros(img.shape + (3,), dtype=np.float32)
+        for i, index in enumerate([4101, 4102, 4201]):
+            probabilities[..., i] = (label_map == index) * 0.8
+        # ROI 3 overlaps ROI 1 with lower probabilities
+        probabilities[..., 2] += (label_map == 4101) * 0.3
+        atlas_file = os.path.join(self.tmp_folder_path, 'probabilistic_atlas.nii.gz')
+        image.new_img_like(img, probabilities).to_filename(atlas_file)
+
+        data = image.load_img(list(self.X[:3])).get_fdata(dtype=np.float32).reshape(-1, 3)
+        weights = probabilities.reshape(-1, 3)
+        expected = (data.T @ weights) / weights.sum(axis=0)
+
+        atlas = BrainAtlas(atlas_name=atlas_file, extract_mode='mean')
+        np.testing.assert_allclose(atlas.transform(self.X[:3]), expected, rtol=1e-4)
+        self.assertListEqual(list(atlas.roi_offsets), [0, 1, 2, 3])
+
+        # thresholded: the plain mean of the voxels above the threshold
+        binary = (weights >= 0.5).astype(np.float32)
+        atlas = BrainAtlas(atlas_name=atlas_file, extract_mode='mean', mask_threshold=0.5, roi_weighting='binary')
+        np.testing.assert_allclose(atlas.transform(self.X[:3]), (data.T @ binary) / binary.sum(axis=0), rtol=1e-4)
+
+        atlas_obj = AtlasLibrary().get_atlas(atlas_file, img.affine, img.shape)
+        self.assertEqual(atlas_obj.weights.shape, (label_map.size, 3))
+        self.assertEqual(atlas_obj.roi_list[-1].size, np.count_nonzero(weights[:, 2]))
+
+        # on a shifted grid the probabilities stay in [0, 1] and next to their ROI
+        shifted_affine = img.affine.copy()
+        shifted_affine[:3, 3] += 1.
+        shifted_obj = AtlasLibrary().get_atlas(atlas_file, shifted_affine, img.shape)
+        self.assertGreaterEqual(shifted_obj.weights.min(), 0)
+        self.assertLessEqual(shifted_obj.weights.max(), 1)
+        neighbourhood = ndimage.binary_dilation(label_map == 4101, structure=np.ones((3, 3, 3)))
+        neighbourhood = image.resample_img(image.new_img_like(img, neighbourhood.astype(np.float32)),
+                                           target_affine=shifted_affine, target_shape=img.shape,
+                                           interpolation='nearest').get_fdata().ravel() > 0
+        roi_voxels = shifted_obj.weights[:, 0].nonzero()[0]
+        self.assertGreater(roi_voxels.size, 0)
+        self.assertTrue(np.all(neighbourhood[roi_voxels]))
+
+    def test_spatial_index(self):
+        atlas_obj = AtlasLibrary().get_atlas(self.atlas_name)
+        hippocampus = atlas_obj.get_roi('Hippocampus_L')
+        self.assertIs(atlas_obj.get_roi(hippocampus.index), hippocampus)
+        # lookups keep the order of the atlas
+        self.assertListEqual([roi.label for roi in atlas_obj.rois_by_label(['Hippocampus_R', 'Hippocampus_L'])],
+                             ['Hippocampus_L', 'Hippocampus_R'])
+
+        # voxel <-> world round trip
+        voxels = np.column_stack(np.unravel_index(hippocampus.voxel_indices, atlas_obj.map.shape))
+        world = atlas_obj.voxel_to_world(voxels)
+        np.testing.assert_allclose(atlas_obj.world_to_voxel(world), voxels, atol=1e-6)
+
+        # every voxel of the ROI is annotated with the ROI, coordinates outside of the grid with None
+        labels = atlas_obj.labels_at(np.vstack([world, [[1000., 1000., 1000.]]]))
+        self.assertTrue(all(label == 'Hippocampus_L' for label in labels[:-1]))
+        self.assertIsNone(labels[-1])
+
+        distances, positions = atlas_obj.nearest_rois(world[:5])
+        np.testing.assert_array_equal(distances, 0)
+        self.assertTrue(all(atlas_obj.roi_list[p] is hippocampus for p in positions))
+
+        distances, positions = atlas_obj.nearest_rois(atlas_obj.centroids[[1, 2]], k=2, by='centroid')
+        self.assertEqual(positions.shape, (2, 2))
+        self.assertListEqual(list(positions[:, 0]), [1, 2])
+        np.testing.assert_allclose(distances[:, 0], 0, atol=1e-6)
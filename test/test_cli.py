@@ -0,0 +1,64 @@
+import io
+import os
+import numpy as np
+
+from photonai.base import PipelineElement
+
+from photonai_neuro import FeatureStore
+from photonai_neuro.cli import main, extract, parse_step, read_subjects, precompute_main
+from test.test_neuro import NeuroBaseTest
+
+
+class CliTests(NeuroBaseTest):
+
+    def setUp(self):
+        super(CliTests, self).setUp()
+        self.store_folder = os.path.join(self.tmp_folder_path, 'cli_store')
+        self.manifest = os.path.join(self.tmp_folder_path, 'manifest.csv')
+        with open(self.manifest, 'w') as f:
+            f.write("path,subject_id\n")
+            for i, x in enumerate(self.X):
+                f.write("{},subject_{}\n".format(x, i))
+
+    def test_parse_step(self):
+        self.assertEqual(parse_step('SmoothImages:fwhm=6'), ('SmoothImages', {'fwhm': 6}))
+        self.assertEqual(parse_step('BrainAtlas:atlas_name=AAL,rois=["Hippocampus_L","Amygdala_L"],extract_mode=mean'),
+                         ('BrainAtlas', {'atlas_name': 'AAL', 'rois': ['Hippocampus_L', 'Amygdala_L'],
+                                         'extract_mode': 'mean'}))
+
+    def test_read_subjects(self):
+        files, subject_ids = read_subjects(self.manifest)
+        self.assertListEqual(files, list(self.X))
+        self.assertListEqual(subject_ids, ['subject_{}'.format(i) for i in range(len(self.X))])
+
+        files, subject_ids = read_subjects(os.path.dirname(self.X[0]), pattern='*.nii*')
+        self.assertIn(self.X[0], files)
+
+    def test_main(self):
+        steps = ['--step', 'BrainAtlas:atlas_name=AAL,rois=["Hippocampus_L","Amygdala_L"],extract_mode=mean']
+        self.assertEqual(main([self.manifest, '-o', self.store_folder, '-j', '2', '-b', '3'] + steps), 0)
+
+        store = FeatureStore(self.store_folder)
+        self.assertEqual(len(store), len(self.X))
+        expected, _, _ = PipelineElement('BrainAtlas', atlas_name='AAL', rois=['Hippocampus_L', 'Amygdala_L'],
+                                         extract_mode='mean').transform(self.X)
+        np.testing.assert_array_almost_equal(store.load(['subject_{}'.format(i) for i in range(len(self.X))]),
+                                             expected)
+
+        # resume: nothing left to extract
+        out = io.StringIO()
+        files, subject_ids = read_subjects(self.manifest)
+        n_extracted = extract(files, subject_ids, [('BrainAtlas', {'atlas_name': 'AAL',
+                                                                   'rois': ['Hippocampus_L', 'Amygdala_L'],
+                                                                   'extract_mode': 'mean'})],
+                              self.store_folder, out=out)
+        self.assertEqual(n_extracted, 0)
+        self.assertIn('0 to extract', out.getvalue())
+
+        self.assertEqual(main([self.manifest, '-o', self.store_folder]), 2)
+
+    def test_precompute_main(self):
+        bundle_folder = os.path.join(self.tmp_folder_path, 'cli_bundles')
+        self.assertEqual(precompute_main(['-g', '3', '-g', self.X[0], '-a', 'AAL', '-k', 'Cerebellum',
+                                          '-o', bundle_folder]), 0)
+        self.assertEqual(len(os.listdir(bundle_folder)), 4)
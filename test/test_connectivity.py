@@ -0,0 +1,68 @@
+import os
+import numpy as np
+from nilearn import image
+
+from photonai.base import PipelineElement
+
+from photonai_neuro import AtlasLibrary, BrainAtlas, RoiConnectivity
+from test.test_neuro import NeuroBaseTest
+
+
+class RoiConnectivityTests(NeuroBaseTest):
+
+    def setUp(self):
+        super(RoiConnectivityTests, self).setUp()
+        # two short 4D runs on a coarse MNI grid
+        affine, shape = AtlasLibrary.mni152_grid(5)
+        rnd = np.random.RandomState(0)
+        self.runs = list()
+        for i in range(2):
+            data = rnd.randn(*(shape + (25,))).astype(np.float32) + 100
+            run_file = os.path.join(self.tmp_folder_path, 'run_{}.nii.gz'.format(i))
+            image.new_img_like(image.load_img(self.X[0]), data, affine=affine).to_filename(run_file)
+            self.runs.append(run_file)
+
+    def _time_series(self, run):
+        img = image.load_img(run)
+        atlas_obj = AtlasLibrary().get_atlas(self.atlas_name, img.affine, img.shape[:3])
+        rois = BrainAtlas._get_rois(atlas_obj, which_rois=self.roi_list)
+        data = img.get_fdata(dtype=np.float32).reshape(-1, img.shape[3])
+        return np.stack([data[roi.voxel_indices].mean(axis=0) for roi in rois], axis=1)
+
+    def test_correlation(self):
+        connectivity = RoiConnectivity(self.atlas_name, rois=self.roi_list, time_chunk_size=7)
+        features = connectivity.transform(self.runs)
+        n_rois = len(self.roi_list)
+        self.assertEqual(features.shape, (2, n_rois * (n_rois - 1) // 2))
+        self.assertEqual(features.dtype, np.float32)
+        for i, run in enumerate(self.runs):
+            expected = np.corrcoef(self._time_series(run).T)
+            np.testing.assert_allclose(connectivity.inverse_transform(features[i])[0], expected, atol=1e-4)
+
+        # chunks of time give the same time series
+        np.testing.assert_allclose(connectivity.time_series(self.runs[0]),
+                                   RoiConnectivity(self.atlas_name, rois=self.roi_list,
+                                                   time_chunk_size=1000).time_series(self.runs[0]), rtol=1e-5)
+
+    def test_kinds(self):
+        time_series = self._time_series(self.runs[0])
+        covariance = np.cov(time_series.T)
+        features = RoiConnectivity(self.atlas_name, kind='covariance', rois=self.roi_list).transform(self.runs[0])
+        np.testing.assert_allclose(RoiConnectivity.vector_to_matrix(features, len(self.roi_list), diagonal=True)[0],
+                                   covariance, rtol=1e-3, atol=1e-5)
+
+        precision = np.linalg.inv(covariance)
+        partial = -precision / np.sqrt(np.outer(np.diag(precision), np.diag(precision)))
+        np.fill_diagonal(partial, 1)
+        connectivity = RoiConnectivity(self.atlas_name, kind='partial_correlation', rois=self.roi_list)
+        np.testing.assert_allclose(connectivity.inverse_transform(connectivity.transform(self.runs[0]))[0],
+                                   partial, atol=1e-3)
+
+        with self.assertRaises(ValueError):
+            RoiConnectivity(self.atlas_name, kind='coherence').transform(self.runs)
+
+    def test_pipeline_element(self):
+        element = PipelineElement('RoiConnectivity', atlas_name=self.atlas_name, fisher_z=True)
+        features, _, _ = element.transform(self.runs)
+        self.assertEqual(features.shape[0], 2)
+        self.assertTrue(np.all(np.isfinite(features)))
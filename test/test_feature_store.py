@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nib
+
+from photonai.base import PipelineElement
+
+from photonai_neuro import FeatureStore, NeuroBranch
+from test.test_neuro import NeuroBaseTest
+
+
+class FeatureStoreTests(NeuroBaseTest):
+
+    def setUp(self):
+        super(FeatureStoreTests, self).setUp()
+        self.folder = tempfile.mkdtemp()
+        self.store_folder = os.path.join(self.folder, 'feature_store')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def create_atlas(self):
+        return PipelineElement('BrainAtlas', atlas_name=self.atlas_name, rois=self.roi_list, extract_mode='mean')
+
+    def test_incremental_update(self):
+        store = FeatureStore(self.store_folder)
+        extracted = store.update(self.X[:6], self.create_atlas())
+        self.assertEqual(len(extracted), 6)
+
+        # only new subjects are extracted
+        extracted = store.update(self.X, self.create_atlas())
+        self.assertListEqual(extracted, list(self.X[6:]))
+        self.assertListEqual(store.update(self.X, self.create_atlas()), [])
+
+        expected, _, _ = self.create_atlas().transform(self.X)
+        np.testing.assert_array_almost_equal(store.load(list(self.X)), expected)
+
+        # reopened store
+        store = FeatureStore(self.store_folder)
+        self.assertEqual(len(store), len(self.X))
+        np.testing.assert_array_almost_equal(store.load(list(self.X[::-1])), expected[::-1])
+
+    def test_changed_subject(self):
+        changed_file = os.path.join(self.folder, 'changed.nii.gz')
+        img = nib.load(self.X[0])
+        nib.Nifti1Image(img.get_fdata() * 2, img.affine).to_filename(changed_file)
+        X = [changed_file] + list(self.X[1:])
+        subject_ids = ['subject_{}'.format(i) for i in range(len(X))]
+
+        store = FeatureStore(self.store_folder)
+        store.update(list(self.X), self.create_atlas(), subject_ids=subject_ids)
+        self.assertListEqual(store.update(X, self.create_atlas(), subject_ids=subject_ids), ['subject_0'])
+
+        expected, _, _ = self.create_atlas().transform(X)
+        np.testing.assert_array_almost_equal(store.load(subject_ids), expected)
+        self._check_statistics(store, expected)
+
+        store.compact()
+        self.assertEqual(len(store.meta['blocks']), 1)
+        np.testing.assert_array_almost_equal(store.load(subject_ids), expected)
+
+    def test_changed_parameters(self):
+        store = FeatureStore(self.store_folder)
+        store.update(self.X[:4], self.create_atlas())
+        self.assertFalse(store.invalidate(self.create_atlas()))
+
+        # features of another smoothing kernel are extracted again
+        def smoothed_atlas(fwhm):
+            neuro_branch = NeuroBranch('neuro_branch')
+            neuro_branch += PipelineElement('SmoothImages', fwhm=fwhm)
+            neuro_branch += self.create_atlas()
+            return neuro_branch
+        self.assertListEqual(store.update(self.X[:4], smoothed_atlas(4)), list(self.X[:4]))
+        self.assertListEqual(store.update(self.X[:4], smoothed_atlas(4)), [])
+        self.assertListEqual(store.update(self.X[:4], smoothed_atlas(8)), list(self.X[:4]))
+        self.assertEqual(len(store.meta['blocks']), 1)
+
+        expected, _, _ = smoothed_atlas(8).transform(self.X[:4])
+        np.testing.assert_array_almost_equal(FeatureStore(self.store_folder).load(list(self.X[:4])), expected)
+
+    def _check_statistics(self, store, features):
+        statistics = store.statistics()
+        self.assertEqual(statistics['n'], features.shape[0])
+        np.testing.assert_allclose(statistics['mean'], features.mean(axis=0), rtol=1e-5)
+        np.testing.assert_allclose(statistics['var'], features.var(axis=0), rtol=1e-4)
+
+    def test_statistics(self):
+        rnd = np.random.RandomState(0)
+        features = rnd.randn(30, 8) * 3 + 5
+        store = FeatureStore(self.store_folder)
+        ids = [str(i) for i in range(30)]
+        store.add(ids[:10], ids[:10], features[:10])
+        store.add(ids[10:], ids[10:], features[10:])
+        self._check_statistics(store, features)
+
+        # replace rows
+        features[:5] = rnd.randn(5, 8)
+        store.add(ids[:5], ['new'] * 5, features[:5])
+        self._check_statistics(store, features)
+
+        with self.assertRaises(ValueError):
+            store.add(['x'], ['x'], np.zeros((1, 3)))
+        with self.assertRaises(KeyError):
+            store.load(['unknown'])
+
+    def test_read_rois(self):
+        atlas = PipelineElement('BrainAtlas', atlas_name=self.atlas_name, rois=self.roi_list, extract_mode='vec')
+        expected, _, _ = atlas.transform(self.X)
+        roi_offsets = atlas.base_element.roi_offsets
+        roi_labels = list(atlas.base_element.roi_allocation.keys())
+
+        for compress, min_chunk_columns in [(False, 1), (False, 10 ** 6), (True, 1000)]:
+            store = FeatureStore(os.path.join(self.store_folder, str(compress) + str(min_chunk_columns)),
+                                 compress=compress, min_chunk_columns=min_chunk_columns)
+            store.update(self.X[:4], atlas)
+            store.update(self.X, atlas)
+
+            # reopened store knows its layout
+            store = FeatureStore(store.folder)
+            self.assertListEqual(store.roi_labels, roi_labels)
+            self.assertListEqual(store.layout['roi_offsets'], [int(o) for o in roi_offsets])
+            self.assertEqual(store.layout['params']['BrainAtlas']['atlas_name'], self.atlas_name)
+
+            np.testing.assert_array_equal(store.load(list(self.X)), expected)
+            for rois in [[roi_labels[1]], [roi_labels[3], roi_labels[0]], [2]]:
+                indices = [roi_labels.index(r) if r in roi_labels else r for r in rois]
+                columns = np.concatenate([np.arange(roi_offsets[i], roi_offsets[i + 1]) for i in indices])
+                np.testing.assert_array_equal(store.read(rois=rois, subject_ids=list(self.X[::2])),
+                                              expected[::2][:, columns])
+
+        with self.assertRaises(KeyError):
+            store.read(rois=['unknown'])
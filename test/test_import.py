@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+import unittest
+
+
+class ImportTests(unittest.TestCase):
+
+    @staticmethod
+    def _import_time(statement: str, repeats: int = 3):
+        # fresh interpreters: every worker process pays the import once
+        code = "import time; t = time.perf_counter(); {}; print(time.perf_counter() - t)".format(statement)
+        cwd = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        return min(float(subprocess.check_output([sys.executable, '-c', code], cwd=cwd).decode().split()[-1])
+                   for _ in range(repeats))
+
+    def test_lazy_submodules(self):
+        code = "import sys, photonai_neuro; " \
+               "print([m for m in ['photonai_neuro.atlas_mapper', 'photonai_neuro.searchlight', " \
+               "'photonai_neuro.feature_store', 'photonai_neuro.brain_atlas', 'nilearn.plotting', " \
+               "'nilearn.datasets'] if m in sys.modules])"
+        cwd = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        loaded = subprocess.check_output([sys.executable, '-c', code], cwd=cwd).decode().split('\n')[-2]
+        self.assertEqual(loaded, '[]')
+
+    def test_lazy_attributes(self):
+        import photonai_neuro
+        from photonai_neuro.atlas_mapper import AtlasMapper
+        self.assertIs(photonai_neuro.AtlasMapper, AtlasMapper)
+        self.assertIn('AtlasMapper', dir(photonai_neuro))
+        with self.assertRaises(AttributeError):
+            photonai_neuro.NotAnElement
+
+    def test_import_time(self):
+        baseline = self._import_time("import photonai.base")
+        neuro = self._import_time("import photonai_neuro")
+        # the package adds little on top of photonai, relative to the speed of the machine
+        self.assertLess(neuro, 1.5 * baseline)
@@ -0,0 +1,56 @@
+import numpy as np
+
+from photonai.base import PipelineElement
+
+from photonai_neuro import BrainAtlas, MultiAtlas, NeuroBranch
+from test.test_neuro import NeuroBaseTest
+
+
+class MultiAtlasTests(NeuroBaseTest):
+
+    def setUp(self):
+        super(MultiAtlasTests, self).setUp()
+        self.atlases = [{'atlas_name': self.atlas_name, 'rois': self.roi_list},
+                        {'atlas_name': 'HarvardOxford_Subcortical_Threshold_25', 'extract_mode': 'mean'}]
+
+    def test_blocks(self):
+        multi_atlas = MultiAtlas(self.atlases)
+        features = multi_atlas.transform(self.X[:4])
+
+        aal = BrainAtlas(self.atlas_name, rois=self.roi_list).transform(self.X[:4])
+        harvard_oxford = BrainAtlas('HarvardOxford_Subcortical_Threshold_25')
+        harvard_oxford.transform(self.X[:4])
+        ho_vec = BrainAtlas('HarvardOxford_Subcortical_Threshold_25').transform(self.X[:4])
+        ho_means = np.stack([ho_vec[:, harvard_oxford.roi_offsets[i]:harvard_oxford.roi_offsets[i + 1]].mean(axis=1)
+                             for i in range(len(harvard_oxford.roi_offsets) - 1)], axis=1)
+
+        blocks = multi_atlas.blocks(features)
+        self.assertListEqual(list(blocks.keys()), [self.atlas_name, 'HarvardOxford_Subcortical_Threshold_25'])
+        np.testing.assert_array_equal(blocks[self.atlas_name], aal)
+        np.testing.assert_allclose(blocks['HarvardOxford_Subcortical_Threshold_25'], ho_means, rtol=1e-4)
+        self.assertEqual(multi_atlas.atlas_offsets[-1], features.shape[1])
+        self.assertEqual(multi_atlas.roi_offsets[-1], features.shape[1])
+        self.assertEqual(len(multi_atlas.roi_labels), len(multi_atlas.roi_offsets) - 1)
+        # atlas order
+        self.assertListEqual(multi_atlas.roi_labels[:len(self.roi_list)],
+                             ["{}/{}".format(self.atlas_name, roi) for roi in
+                              ['Hippocampus_L', 'Hippocampus_R', 'Amygdala_L', 'Amygdala_R']])
+
+        # batches of subjects give the same features
+        np.testing.assert_array_equal(MultiAtlas(self.atlases, subject_batch_size=3).transform(self.X[:4]), features)
+
+    def test_inverse_transform(self):
+        multi_atlas = MultiAtlas(self.atlases)
+        features = multi_atlas.transform(self.X[:2])
+        images = multi_atlas.inverse_transform(np.ones(features.shape[1]))
+        self.assertEqual(len(images), 2)
+        self.assertEqual(np.sum(images[0].get_fdata()), multi_atlas.atlas_offsets[1])
+
+    def test_neuro_branch(self):
+        neuro_branch = NeuroBranch('multi_atlas')
+        neuro_branch += PipelineElement('MultiAtlas', atlases=[self.atlas_name, 'Yeo_7'], extract_mode='mean')
+        features, _, _ = neuro_branch.transform(self.X[:3])
+        self.assertEqual(features.shape[0], 3)
+
+        with self.assertRaises(ValueError):
+            MultiAtlas([self.atlas_name], extract_mode='box').transform(self.X[:2])
@@ -187,3 +187,55 @@ class NeuroBranchTests(NeuroBaseTest):
         nb.transform(self.X[:1])
 
         self.assertIsInstance(self.a[0], Nifti1Image)
+
+    def test_crop_to_mask(self):
+        selections = [('BrainMask', {'mask_image': 'MNI_ICBM152_WholeBrain', 'extract_mode': 'vec'}),
+                      ('BrainAtlas', {'atlas_name': self.atlas_name, 'rois': ['Hippocampus_L', 'Hippocampus_R'],
+                                      'extract_mode': 'vec'}),
+                      ('BrainAtlas', {'atlas_name': self.atlas_name, 'rois': 'Hippocampus_L',
+                                      'extract_mode': 'mean'}),
+                      ('MultiAtlas', {'atlases': [{'atlas_name': self.atlas_name, 'rois': ['Hippocampus_L']},
+                                                  {'atlas_name': self.atlas_name, 'rois': ['Amygdala_R'],
+                                                   'extract_mode': 'mean'}]})]
+        for interpolation in ['nearest', 'linear']:
+            for selection, params in selections:
+                results = list()
+                for crop_to_mask in [False, True]:
+                    nb = NeuroBranch('neuro_branch', crop_to_mask=crop_to_mask)
+                    nb += PipelineElement('SmoothImages', fwhm=6)
+                    nb += PipelineElement('ResampleImages', voxel_size=4, interpolation=interpolation)
+                    nb += PipelineElement(selection, **params)
+                    results.append(np.asarray(nb.transform(self.X[:3])[0]))
+                self.assertGreater(results[0].shape[1], 0)
+                np.testing.assert_array_equal(results[0], results[1])
+
+    def test_crop_to_mask_plan(self):
+        nb = NeuroBranch('neuro_branch', crop_to_mask=True, crop_margin=4.)
+        nb += PipelineElement('ResampleImages', voxel_size=4)
+        nb += PipelineElement('BrainAtlas', atlas_name=self.atlas_name, rois=['Hippocampus_L'], extract_mode='vec')
+        resample = nb.elements[0].base_element
+        full_grid = resample.target_grid(image.load_img(self.X[0]).affine, image.load_img(self.X[0]).shape[:3])
+        cropped, cropped_elements = nb._crop(self.X[:2])
+        full_shape = image.load_img(self.X[0]).shape[:3]
+        self.assertTrue(all(c < f for c, f in zip(cropped[0].shape[:3], full_shape)))
+        self.assertListEqual(cropped_elements, [resample])
+        self.assertIsNotNone(resample._crop_grid)
+
+        # after the transform the elements resample onto their full grid again
+        nb.transform(self.X[:2])
+        self.assertIsNone(resample._crop_grid)
+        self.assertEqual(resample.target_grid(image.load_img(self.X[0]).affine, full_shape)[1], full_grid[1])
+        self.assertNotIn('target_affine', resample.get_params())
+
+        # the copy keeps the cropping, a branch without voxel selection is not cropped
+        self.assertTrue(nb.copy_me().crop_to_mask)
+        nb = NeuroBranch('neuro_branch', crop_to_mask=True)
+        nb += PipelineElement('SmoothImages', fwhm=6)
+        X = self.X[:2]
+        self.assertIs(nb._crop(X)[0], X)
+
+        # neither is a branch with spline interpolation
+        nb = NeuroBranch('neuro_branch', crop_to_mask=True)
+        nb += PipelineElement('ResampleImages', voxel_size=4, interpolation='continuous')
+        nb += PipelineElement('BrainAtlas', atlas_name=self.atlas_name, rois=['Hippocampus_L'], extract_mode='vec')
+        self.assertIs(nb._crop(X)[0], X)
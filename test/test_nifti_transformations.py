@@ -5,7 +5,8 @@ from nibabel.nifti1 import Nifti1Image
 from nilearn.image import resample_img, index_img, smooth_img
 
 from photonai.base import PipelineElement
-from photonai_neuro.nifti_transformations import PatchImages
+from photonai_neuro.brain_atlas import BrainMask
+from photonai_neuro.nifti_transformations import PatchImages, SmoothImages, ResampleImages
 from photonai_neuro import NeuroBranch
 from test.test_neuro import NeuroBaseTest
 
@@ -66,6 +67,14 @@ class SmoothImagesTests(NeuroBaseTest):
         with self.assertRaises(ValueError):
             PipelineElement('SmoothImages', hyperparameters={}, fwhm="quick")
 
+    def test_target_mask(self):
+        for fwhm in [6, 'fast']:
+            smoothed = SmoothImages(fwhm=fwhm, output_img=True).transform(self.X[:3])
+            expected = BrainMask(mask_image='MNI_ICBM152_WholeBrain', extract_mode='vec').transform(smoothed)
+            masked = SmoothImages(fwhm=fwhm, target_mask='MNI_ICBM152_WholeBrain').transform(self.X[:3])
+            self.assertEqual(masked.shape, np.asarray(expected).shape)
+            np.testing.assert_allclose(masked, expected, rtol=1e-5, atol=1e-5)
+
 
 class ResampleImagesTests(NeuroBaseTest):
 
@@ -130,6 +139,15 @@ class ResampleImagesTests(NeuroBaseTest):
         with self.assertRaises(ValueError):
             PipelineElement('ResampleImages', hyperparameters={}, voxel_size=[4,4,4,42])
 
+    def test_target_mask(self):
+        for interpolation in ['nearest', 'linear']:
+            resampled = ResampleImages(voxel_size=4, interpolation=interpolation, output_img=True).transform(self.X[:3])
+            expected = BrainMask(mask_image='MNI_ICBM152_WholeBrain', extract_mode='vec').transform(resampled)
+            masked = ResampleImages(voxel_size=4, interpolation=interpolation,
+                                    target_mask='MNI_ICBM152_WholeBrain').transform(self.X[:3])
+            self.assertEqual(masked.shape, np.asarray(expected).shape)
+            np.testing.assert_allclose(masked, expected, rtol=1e-4, atol=1e-4)
+
 
 class PatchImagesTests(NeuroBaseTest):
 
@@ -0,0 +1,73 @@
+import warnings
+
+import numpy as np
+from nilearn.image import smooth_img, resample_img
+
+from photonai.base import PipelineElement
+
+from photonai_neuro import BrainAtlas, BrainMask, set_precision, get_precision
+from photonai_neuro.precision import Precision
+from test.test_neuro import NeuroBaseTest
+
+
+class PrecisionTests(NeuroBaseTest):
+
+    def tearDown(self):
+        Precision.reset()
+        super(PrecisionTests, self).tearDown()
+
+    def test_module_setting(self):
+        set_precision('float32', 'float16')
+        self.assertEqual(get_precision(), ('float32', 'float16'))
+        self.assertEqual(Precision.compute_dtype('float64'), 'float64')
+        self.assertEqual(Precision.resolve_storage_dtype(), 'float16')
+        with self.assertRaises(ValueError):
+            set_precision('int8')
+
+    def test_smoothing_accuracy(self):
+        reference = smooth_img(self.X[0], fwhm=[3, 3, 3]).get_fdata()
+        for dtype in ['float32', 'float64']:
+            smoother = PipelineElement('SmoothImages', fwhm=3, dtype=dtype)
+            smoothed, _, _ = smoother.transform(self.X[0])
+            self.assertEqual(np.asarray(smoothed).dtype, np.dtype(dtype))
+            np.testing.assert_allclose(np.asarray(smoothed), reference, rtol=1e-4, atol=1e-5)
+
+    def test_resampling_accuracy(self):
+        reference = resample_img(self.X[0], target_affine=np.diag([3, 3, 3]), interpolation='linear').get_fdata()
+        resampler = PipelineElement('ResampleImages', voxel_size=3, interpolation='linear', dtype='float32')
+        resampled, _, _ = resampler.transform(self.X[0])
+        self.assertEqual(np.asarray(resampled).dtype, np.float32)
+        np.testing.assert_allclose(np.asarray(resampled), reference, rtol=1e-4, atol=1e-5)
+
+    def test_brain_atlas_storage(self):
+        reference = BrainAtlas(self.atlas_name, rois=self.roi_list, dtype='float64').transform(self.X[:3])
+        self.assertEqual(reference.dtype, np.float64)
+
+        for storage_dtype, atol in [('float32', 1e-6), ('float16', 1e-3), ('int16', 1e-4)]:
+            atlas = BrainAtlas(self.atlas_name, rois=self.roi_list, storage_dtype=storage_dtype)
+            stored = atlas.transform(self.X[:3])
+            self.assertEqual(stored.dtype, np.dtype(storage_dtype))
+            restored = Precision.from_storage(stored, atlas.storage_scale)
+            np.testing.assert_allclose(restored, reference, atol=atol)
+
+    def test_brain_mask_storage(self):
+        reference = BrainMask(mask_image='MNI_ICBM152_WholeBrain', dtype='float64').transform(self.X[:2])
+        mask = BrainMask(mask_image='MNI_ICBM152_WholeBrain', storage_dtype='int16')
+        stored = mask.transform(self.X[:2])
+        self.assertEqual(stored.dtype, np.int16)
+        np.testing.assert_allclose(Precision.from_storage(stored, mask.storage_scale), reference, atol=1e-4)
+        # inverse transform undoes the scaling
+        back = mask.inverse_transform(stored)
+        np.testing.assert_allclose(BrainMask(mask_image='MNI_ICBM152_WholeBrain').transform(back)[0],
+                                   reference[0], atol=1e-4)
+
+    def test_int16_clipping(self):
+        stored, scale = Precision.to_storage(np.array([-1., 0.5, 1.]), 'int16')
+        np.testing.assert_allclose(Precision.from_storage(stored, scale), [-1., 0.5, 1.], atol=1e-4)
+        # later batches are stored on the scale of the first one, values beyond it are clipped with a warning
+        with self.assertWarns(UserWarning):
+            stored, _ = Precision.to_storage(np.array([0.5, 2.]), 'int16', scale)
+        np.testing.assert_allclose(Precision.from_storage(stored, scale), [0.5, 1.], atol=1e-4)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            Precision.to_storage(np.array([0.5, -1.]), 'int16', scale)
@@ -0,0 +1,110 @@
+import unittest
+import numpy as np
+from sklearn.linear_model import Ridge, RidgeClassifier
+from sklearn.model_selection import KFold
+
+from photonai_neuro import RidgeEngine
+
+
+class RidgeEngineTests(unittest.TestCase):
+
+    def setUp(self):
+        rnd = np.random.RandomState(0)
+        self.X = rnd.randn(30, 25)
+        self.roi_columns = [(0, 5), (5, 6), (6, 25)]
+        self.y_regression = self.X[:, 0] * 2 + rnd.randn(30) * 0.1 + 3
+        self.y_classification = np.array(['a', 'b', 'c'])[rnd.randint(0, 3, 30)]
+
+    def _compare(self, engine, sklearn_estimator, y):
+        Y, decode = engine.encode_targets(y)
+        K = engine.gram_matrices(self.X, self.roi_columns)
+        for train, test in engine.get_folds(y):
+            predictions = decode(engine.fit_predict(K, Y, train, test))
+            for i, (start, stop) in enumerate(self.roi_columns):
+                model = sklearn_estimator.fit(self.X[train, start:stop], y[train])
+                expected = model.predict(self.X[test, start:stop])
+                if y.dtype.kind in 'fc':
+                    np.testing.assert_allclose(predictions[i], expected, rtol=1e-6, atol=1e-8)
+                else:
+                    np.testing.assert_array_equal(predictions[i], expected)
+
+    def test_regression(self):
+        for alpha in [0.1, 1., 10.]:
+            self._compare(RidgeEngine(alpha=alpha, cv=KFold(n_splits=3)), Ridge(alpha=alpha), self.y_regression)
+
+    def test_classification(self):
+        self._compare(RidgeEngine(alpha=1., cv=3), RidgeClassifier(alpha=1.), self.y_classification)
+        y_binary = np.where(self.X[:, 1] > 0, 'x', 'y')
+        self._compare(RidgeEngine(alpha=1., cv=3), RidgeClassifier(alpha=1.), y_binary)
+
+    def test_task(self):
+        # whole-numbered float targets, e.g. ages, are regression targets
+        y_age = np.round(self.y_regression * 10)
+        self.assertFalse(RidgeEngine().is_classification(y_age))
+        self._compare(RidgeEngine(alpha=1., cv=2), Ridge(alpha=1.), y_age)
+        results = RidgeEngine(cv=2, metrics=['mean_absolute_error']).fit(self.X, self.roi_columns, y_age)
+        self.assertEqual(len(results), len(self.roi_columns))
+
+        # an explicit task overrides the targets
+        y_codes = np.where(self.X[:, 1] > 0, 1., 0.)
+        self.assertTrue(RidgeEngine(task='classification').is_classification(y_codes))
+        self._compare(RidgeEngine(alpha=1., cv=3, task='classification'), RidgeClassifier(alpha=1.), y_codes)
+        self.assertTrue(RidgeEngine().is_classification(self.y_classification))
+        with self.assertRaises(ValueError):
+            RidgeEngine(task='clustering')
+
+    def test_primal(self):
+        # ROIs with fewer voxels than subjects: the zero padded primal form predicts as the dual form
+        y = self.y_regression.reshape(-1, 1)
+        K = RidgeEngine.gram_matrices(self.X, self.roi_columns)
+        voxels = RidgeEngine.padded_voxels(self.X, self.roi_columns)
+        self.assertEqual(voxels.shape, (len(self.roi_columns), 30, 19))
+        for alpha in [0., 1.]:
+            engine = RidgeEngine(alpha=alpha)
+            for train, test in RidgeEngine(cv=KFold(n_splits=3)).get_folds(self.y_regression):
+                np.testing.assert_allclose(engine.fit_predict(voxels, y, train, test, primal=True),
+                                           engine.fit_predict(K, y, train, test), rtol=1e-6, atol=1e-8)
+
+    def test_roi_batches(self):
+        roi_columns = [(0, 20), (20, 60), (60, 65), (65, 100)]
+        batches = RidgeEngine(roi_batch_size=1).roi_batches(30, roi_columns)
+        self.assertListEqual(batches, [([2], True), ([0], True), ([1], False), ([3], False)])
+        # the memory budget of two Gram matrices of 30 subjects
+        engine = RidgeEngine(memory_budget=2 * 8 * 5 * 30 ** 2)
+        self.assertListEqual(engine.roi_batches(30, roi_columns), [([2, 0], True), ([1, 3], False)])
+        self.assertEqual(len(RidgeEngine(memory_budget=1).roi_batches(30, roi_columns)), 4)
+
+        # any batching gives the same results
+        X = np.random.RandomState(1).randn(30, 100)
+        results = [RidgeEngine(cv=KFold(n_splits=3), metrics=['r2'], memory_budget=budget).fit(
+            X, roi_columns, self.y_regression) for budget in [1, 1024 ** 3]]
+        np.testing.assert_allclose([r['r2'] for r in results[0]], [r['r2'] for r in results[1]], rtol=1e-10)
+
+    def test_fit(self):
+        engine = RidgeEngine(alpha=1., cv=KFold(n_splits=3), metrics=['mean_squared_error'], roi_batch_size=2)
+        results = engine.fit(self.X, self.roi_columns, self.y_regression)
+        self.assertEqual(len(results), len(self.roi_columns))
+        # only the first ROI holds the informative voxel
+        self.assertLess(results[0]['mean_squared_error'], results[1]['mean_squared_error'])
+
+    def test_alpha(self):
+        with self.assertRaises(ValueError):
+            RidgeEngine(alpha=-1)
+
+    def test_permutation_scores(self):
+        y_binary = np.where(self.X[:, 1] > 0, 'x', 'y')
+        for y, metric in [(self.y_regression, 'mean_absolute_error'), (self.y_regression, 'r2'),
+                          (self.y_classification, 'accuracy'), (y_binary, 'balanced_accuracy')]:
+            engine = RidgeEngine(cv=KFold(n_splits=3), metrics=[metric], roi_batch_size=2)
+            scores, null_scores = engine.permutation_scores(self.X, self.roi_columns, y, metric, n_permutations=15,
+                                                            permutation_batch_size=4, random_state=1)
+            self.assertEqual(null_scores.shape, (15, len(self.roi_columns)))
+            # unpermuted scores equal the vectorized cross-validation
+            expected = [r[metric] for r in engine.fit(self.X, self.roi_columns, y)]
+            np.testing.assert_allclose(scores, expected, rtol=1e-6)
+
+        with self.assertRaises(ValueError):
+            RidgeEngine().permutation_scores(self.X, self.roi_columns, self.y_regression, 'pearson_correlation')
+        # photonai's balanced_accuracy is binary only
+        with self.assertRaises(ValueError):
+            RidgeEngine().permutation_scores(self.X, self.roi_columns, self.y_classification, 'balanced_accuracy')
@@ -0,0 +1,68 @@
+import os
+import numpy as np
+import pandas as pd
+from nilearn import image
+from nibabel.affines import apply_affine
+
+from photonai.base import PipelineElement
+
+from photonai_neuro import SearchlightMapper, RidgeEngine, NeuroBranch
+from test.test_neuro import NeuroBaseTest
+
+
+class SearchlightMapperTests(NeuroBaseTest):
+
+    def setUp(self):
+        super(SearchlightMapperTests, self).setUp()
+        self.custom_mask = os.path.join(self.atlas_folder, 'Cerebellum/P_08_Cere.nii.gz')
+        self.engine = RidgeEngine(cv=2, metrics=['mean_absolute_error'], best_config_metric='mean_absolute_error')
+
+    def create_neuro_branch(self):
+        neuro_branch = NeuroBranch('NeuroBranch')
+        neuro_branch += PipelineElement('BrainMask', mask_image=self.custom_mask, extract_mode='vec')
+        return neuro_branch
+
+    def test_sphere_neighbours(self):
+        mask_img = image.load_img(self.custom_mask)
+        indptr, indices = SearchlightMapper.sphere_neighbours(mask_img, radius=4.)
+        coordinates = apply_affine(mask_img.affine, np.argwhere(np.asanyarray(mask_img.dataobj).astype(bool)))
+        self.assertEqual(len(indptr) - 1, len(coordinates))
+        for voxel in [0, len(coordinates) // 2, len(coordinates) - 1]:
+            distances = np.linalg.norm(coordinates - coordinates[voxel], axis=1)
+            np.testing.assert_array_equal(np.sort(indices[indptr[voxel]:indptr[voxel + 1]]),
+                                          np.where(distances <= 4.)[0])
+
+    def test_sphere_gram_matrices(self):
+        rnd = np.random.RandomState(0)
+        X = rnd.randn(5, 6)
+        neighbours = (np.array([0, 2, 5, 6]), np.array([0, 1, 1, 2, 5, 3]))
+        K = SearchlightMapper.sphere_gram_matrices(X, neighbours, (0, 3))
+        for sphere, voxels in enumerate([[0, 1], [1, 2, 5], [3]]):
+            np.testing.assert_allclose(K[sphere], X[:, voxels].dot(X[:, voxels].T))
+
+    def test_fit(self):
+        serial_folder = os.path.join(self.tmp_folder_path, 'searchlight')
+        searchlight = SearchlightMapper(self.create_neuro_branch(), self.engine, radius=6., folder=serial_folder,
+                                        sphere_batch_size=100)
+        searchlight.fit(self.X, self.y)
+        self.assertTrue(os.path.exists(os.path.join(serial_folder, 'searchlight_performances.nii.gz')))
+        results = pd.read_csv(os.path.join(serial_folder, 'searchlight_results.csv'))
+        self.assertEqual(len(results), len(searchlight.neighbours[0]) - 1)
+
+        performances = image.load_img(os.path.join(serial_folder, 'searchlight_performances.nii.gz')).get_fdata()
+        np.testing.assert_allclose(performances[results['i'], results['j'], results['k']],
+                                   results['mean_absolute_error'], rtol=1e-5)
+
+        parallel_folder = os.path.join(self.tmp_folder_path, 'searchlight_parallel')
+        parallel = SearchlightMapper(self.create_neuro_branch(), self.engine, radius=6., folder=parallel_folder,
+                                     sphere_batch_size=100, n_jobs=2)
+        parallel.fit(self.X, self.y)
+        np.testing.assert_allclose(parallel.results.values, searchlight.results.values)
+
+    def test_no_brain_mask(self):
+        neuro_branch = NeuroBranch('NeuroBranch')
+        neuro_branch += PipelineElement('BrainAtlas', atlas_name=self.atlas_name, rois=self.roi_list)
+        with self.assertRaises(ValueError):
+            SearchlightMapper(neuro_branch, self.engine)
+        with self.assertRaises(ValueError):
+            SearchlightMapper(self.create_neuro_branch(), RidgeEngine())
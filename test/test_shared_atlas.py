@@ -0,0 +1,89 @@
+import os
+import numpy as np
+from nilearn import image
+
+from photonai_neuro import AtlasLibrary, BrainAtlas, SharedAtlasStore
+from test.test_neuro import NeuroBaseTest
+
+
+class SharedAtlasTests(NeuroBaseTest):
+
+    def setUp(self):
+        super(SharedAtlasTests, self).setUp()
+        self.store_folder = os.path.join(self.tmp_folder_path, 'shared_atlases')
+        img = image.load_img(self.X[0])
+        self.affine, self.shape = img.affine, img.shape
+
+    def tearDown(self):
+        SharedAtlasStore.deactivate()
+        AtlasLibrary.clear_cache()
+        super(SharedAtlasTests, self).tearDown()
+
+    def test_publish_attach(self):
+        AtlasLibrary.clear_cache()
+        atlas_obj = AtlasLibrary().get_atlas(self.atlas_name, self.affine, self.shape)
+        mask_obj = AtlasLibrary().get_mask('MNI_ICBM152_WholeBrain', self.affine, self.shape)
+        expected = BrainAtlas(self.atlas_name, rois=self.roi_list).transform(self.X[:3])
+
+        store = AtlasLibrary.share(self.store_folder)
+        self.assertIsNotNone(SharedAtlasStore.active())
+
+        # a fresh library, as in a worker process, attaches instead of building the atlas
+        AtlasLibrary.clear_cache()
+        attached = AtlasLibrary().get_atlas(self.atlas_name, self.affine, self.shape)
+        self.assertIsInstance(attached.map, np.memmap)
+        self.assertFalse(attached.map.flags.writeable)
+        self.assertListEqual([roi.label for roi in attached.roi_list], [roi.label for roi in atlas_obj.roi_list])
+        for roi, shared_roi in zip(atlas_obj.roi_list, attached.roi_list):
+            np.testing.assert_array_equal(roi.voxel_indices, shared_roi.voxel_indices)
+        # shared memory does not count against the memory budget of the library
+        self.assertEqual(AtlasLibrary.cache_stats()['nbytes'], 0)
+        np.testing.assert_array_equal(np.asarray(atlas_obj.roi_list[1].mask.dataobj),
+                                      np.asarray(attached.roi_list[1].mask.dataobj))
+
+        attached_mask = AtlasLibrary().get_mask('MNI_ICBM152_WholeBrain', self.affine, self.shape)
+        np.testing.assert_array_equal(np.asarray(attached_mask.mask.dataobj), np.asarray(mask_obj.mask.dataobj))
+
+        np.testing.assert_array_equal(BrainAtlas(self.atlas_name, rois=self.roi_list).transform(self.X[:3]),
+                                      expected)
+
+        store.clear()
+        AtlasLibrary.clear_cache()
+        self.assertIsNone(store.attach(AtlasLibrary.library_key('atlas', self.atlas_name, self.affine, self.shape)))
+
+    def test_lazy_roi_masks(self):
+        AtlasLibrary.clear_cache()
+        atlas_obj = AtlasLibrary().get_atlas(self.atlas_name, self.affine, self.shape)
+        roi = atlas_obj.roi_list[1]
+        self.assertIsNone(roi._mask)
+        np.testing.assert_array_equal(np.flatnonzero(np.asarray(roi.mask.dataobj)), roi.voxel_indices)
+        np.testing.assert_array_equal(np.asarray(roi.mask.dataobj) != 0, atlas_obj.map == roi.index)
+
+    def test_precompute(self):
+        bundle_folder = os.path.join(self.tmp_folder_path, 'atlas_bundles')
+        os.environ[AtlasLibrary.CACHE_ENVIRONMENT_VARIABLE] = bundle_folder
+        try:
+            self.assertEqual(AtlasLibrary.mni152_grid(2)[1], (91, 109, 91))
+            self.assertEqual(AtlasLibrary.mni152_grid(3)[1], (61, 73, 61))
+
+            AtlasLibrary.clear_cache()
+            expected = BrainAtlas(self.atlas_name, rois=self.roi_list).transform(self.X[:3])
+            keys = AtlasLibrary.precompute([self.X[0]], atlases=[self.atlas_name], masks=['MNI_ICBM152_WholeBrain'])
+            self.assertEqual(len(keys), 2)
+            self.assertEqual(len(os.listdir(bundle_folder)), 2)
+
+            # the grid of the data matches: no resampling, the library attaches to the bundle
+            AtlasLibrary.clear_cache()
+            atlas_obj = AtlasLibrary().get_atlas(self.atlas_name, self.affine, self.shape)
+            self.assertIsInstance(atlas_obj.map, np.memmap)
+            mask_obj = AtlasLibrary().get_mask('MNI_ICBM152_WholeBrain', self.affine, self.shape)
+            self.assertIsInstance(mask_obj.mask.dataobj, np.memmap)
+            np.testing.assert_array_equal(BrainAtlas(self.atlas_name, rois=self.roi_list).transform(self.X[:3]),
+                                          expected)
+
+            # other grids are still resampled on the fly
+            AtlasLibrary.clear_cache()
+            affine, shape = AtlasLibrary.mni152_grid(5)
+            self.assertNotIsInstance(AtlasLibrary().get_atlas(self.atlas_name, affine, shape).map, np.memmap)
+        finally:
+            os.environ.pop(AtlasLibrary.CACHE_ENVIRONMENT_VARIABLE)
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+from multiprocessing import Pool
+
+from photonai_neuro.task_queue import RoiTaskQueue
+
+
+def _claim_all(file):
+    queue = RoiTaskQueue(file)
+    claimed = list()
+    while True:
+        task = queue.claim()
+        if task is None:
+            return claimed
+        queue.finish(task['roi_name'], task['worker'])
+        claimed.append(task['roi_name'])
+
+
+class RoiTaskQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.queue = RoiTaskQueue(os.path.join(self.folder, 'queue.db'))
+        self.tasks = [('roi_{}'.format(i), i, 'roi_{}.pkl'.format(i), i * 10, (i + 1) * 10) for i in range(50)]
+        self.queue.publish(self.tasks)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_claim(self):
+        task = self.queue.claim('worker_a')
+        self.assertEqual(task['roi_name'], 'roi_0')
+        self.assertEqual(task['roi_columns'], (0, 10))
+        self.assertEqual(self.queue.status()['running'], 1)
+
+        self.queue.fail('roi_0', 'worker_a', 'error')
+        self.assertEqual(self.queue.tasks('failed')[0][4], 'error')
+        self.assertEqual(self.queue.claim('worker_a')['roi_name'], 'roi_1')
+
+    def test_stale(self):
+        self.queue.claim('worker_a')
+        self.assertEqual(self.queue.claim('worker_b')['roi_name'], 'roi_1')
+        # abandoned tasks are handed out again, the old worker can not finish them anymore
+        task = self.queue.claim('worker_c', stale_after=0)
+        self.assertEqual(task['roi_name'], 'roi_0')
+        self.queue.finish('roi_0', 'worker_a')
+        self.assertEqual(self.queue.status()['done'], 0)
+        self.queue.finish('roi_0', 'worker_c')
+        self.assertEqual(self.queue.status()['done'], 1)
+
+    def test_requeue(self):
+        # a crashed worker leaves its task running, merge could never start
+        self.queue.claim('worker_a')
+        self.assertEqual(self.queue.requeue(stale_after=3600), 0)
+        self.assertEqual(self.queue.requeue(), 1)
+        self.assertEqual(self.queue.status()['running'], 0)
+        task = self.queue.claim('worker_b')
+        self.assertEqual(task['roi_name'], 'roi_0')
+        self.queue.finish('roi_0', 'worker_a')
+        self.assertEqual(self.queue.status()['done'], 0)
+        # by default abandoned tasks are taken over after a finite time
+        self.assertIsNotNone(RoiTaskQueue.STALE_AFTER)
+
+    def test_concurrent_claims(self):
+        with Pool(4) as pool:
+            claimed = pool.map(_claim_all, [self.queue.file] * 4)
+        all_claimed = [roi for worker in claimed for roi in worker]
+        self.assertEqual(sorted(all_claimed), sorted(t[0] for t in self.tasks))
+        self.assertEqual(self.queue.status()['done'], len(self.tasks))
@@ -1,3 +1,4 @@
+import os
 import unittest
 from photonai_neuro.util import register_photonai_neuro, delete_photonai_neuro
 
@@ -7,18 +8,21 @@ class UtilTest(unittest.TestCase):
 
     def test_register_photonai_neuro(self):
         register_photonai_neuro()
-        self.assertIn('photonai_neuro', PhotonRegistry.PHOTON_REGISTRIES)
-        # multiple register should work
+        self.assertIn('photonai_neuro', PhotonRegistry().PHOTON_REGISTRIES)
+        # multiple register should work, an unchanged registration is not written again
+        registered_file = os.path.join(PhotonRegistry().module_path, 'photonai_neuro.json')
+        registered_mtime = os.path.getmtime(registered_file)
         register_photonai_neuro()
-        self.assertIn('photonai_neuro', PhotonRegistry.PHOTON_REGISTRIES)
+        self.assertIn('photonai_neuro', PhotonRegistry().PHOTON_REGISTRIES)
+        self.assertEqual(os.path.getmtime(registered_file), registered_mtime)
 
         delete_photonai_neuro()
-        self.assertNotIn('photonai_neuro', PhotonRegistry.PHOTON_REGISTRIES)
+        self.assertNotIn('photonai_neuro', PhotonRegistry().PHOTON_REGISTRIES)
         # multiple deletions
         delete_photonai_neuro()
-        self.assertNotIn('photonai_neuro', PhotonRegistry.PHOTON_REGISTRIES)
+        self.assertNotIn('photonai_neuro', PhotonRegistry().PHOTON_REGISTRIES)
 
         register_photonai_neuro()
-        self.assertIn('photonai_neuro', PhotonRegistry.PHOTON_REGISTRIES)
+        self.assertIn('photonai_neuro', PhotonRegistry().PHOTON_REGISTRIES)
 
         delete_photonai_neuro()